@@ -0,0 +1,165 @@
+# This file is part of Reflex
+# Copyright (C) 2010 European Southern Observatory
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""
+Verification of the CHECKSUM and DATASUM keywords of FITS files.
+
+DATASUM is the 32-bit ones' complement sum of the data unit, read as
+big-endian unsigned integers, and CHECKSUM makes the sum of the whole
+HDU, header included, equal to negative zero (all bits set). The data
+units are memory mapped and summed chunk by chunk with numpy, so that
+the memory used does not depend on the size of the files, and several
+files are verified at the same time on threads.
+"""
+
+import mmap
+import os
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from reflexy.base import fits_header
+
+NEGATIVE_ZERO = 0xffffffff
+
+
+def _fold(total):
+    # end-around carry of a ones' complement sum
+    while total > NEGATIVE_ZERO:
+        total = (total & NEGATIVE_ZERO) + (total >> 32)
+    return total
+
+
+def ones_complement_sum(words, chunk_size=4 * 1024 ** 2, total=0):
+    """
+    32-bit ones' complement sum of an array of words.
+
+    :param words: array of big-endian unsigned 32-bit integers ('>u4'),
+     for example memory mapped
+    :param chunk_size: number of words summed at once; the chunks are
+     accumulated on 64 bits, which cannot overflow below 2**32 words
+    :param total: sum to add the words to
+    """
+    for start in range(0, len(words), chunk_size):
+        total = _fold(total + int(words[start:start + chunk_size].sum(
+            dtype=np.uint64)))
+    return total
+
+
+def _bytes_sum(data):
+    return ones_complement_sum(np.frombuffer(data, dtype='>u4'))
+
+
+def verify_file(filename, chunk_size=4 * 1024 ** 2):
+    """
+    Verify the CHECKSUM and DATASUM keywords of every HDU of a file.
+
+    :return: list of one dict per HDU, with the index of the HDU,
+     'hdu', the DATASUM computed, 'datasum', and whether DATASUM and
+     CHECKSUM match, 'datasum_ok' and 'checksum_ok' (None for a missing
+     keyword)
+    :raise ValueError: if the file is truncated
+    """
+    results = list()
+    file_size = os.path.getsize(filename)
+    with open(filename, 'rb') as fileobj:
+        mapped = None
+        if file_size > 0:
+            mapped = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            position = 0
+            while position < file_size:
+                fileobj.seek(position)
+                cards, header_size = fits_header.read_header_cards(fileobj)
+                data_size = fits_header.data_size(cards)
+                data_start = position + header_size
+                if data_start + data_size > file_size:
+                    raise ValueError('Truncated data unit in HDU %d of %s'
+                                     % (len(results), filename))
+                datasum = 0
+                if data_size > 0:
+                    words = np.frombuffer(mapped, dtype='>u4',
+                                          count=data_size // 4,
+                                          offset=data_start)
+                    datasum = ones_complement_sum(words, chunk_size)
+                    # the map cannot be closed while an array uses it
+                    del words
+
+                fileobj.seek(position)
+                header_sum = _bytes_sum(fileobj.read(header_size))
+                values = fits_header.header_values(cards,
+                                                   ['CHECKSUM', 'DATASUM'])
+                result = dict(hdu=len(results), datasum=datasum,
+                              datasum_ok=None, checksum_ok=None)
+                if values.get('DATASUM') is not None:
+                    try:
+                        expected = int(str(values['DATASUM']).strip())
+                    except ValueError:
+                        expected = None
+                    result['datasum_ok'] = expected == datasum
+                if values.get('CHECKSUM') is not None:
+                    result['checksum_ok'] = \
+                        _fold(header_sum + datasum) == NEGATIVE_ZERO
+                results.append(result)
+                position = data_start + data_size
+        finally:
+            if mapped is not None:
+                mapped.close()
+    return results
+
+
+def mismatches(results):
+    """
+    Messages describing the failed verifications of verify_file
+    results.
+    """
+    messages = list()
+    for result in results:
+        for keyword in ('DATASUM', 'CHECKSUM'):
+            if result[keyword.lower() + '_ok'] is False:
+                messages.append('%s mismatch in HDU %d'
+                                % (keyword, result['hdu']))
+    return messages
+
+
+def _verify(args):
+    filename, chunk_size = args
+    try:
+        return mismatches(verify_file(filename, chunk_size))
+    except (IOError, OSError, ValueError) as error:
+        return [str(error)]
+
+
+def verify_files(filenames, threads=4, chunk_size=4 * 1024 ** 2):
+    """
+    Verify the CHECKSUM and DATASUM keywords of many files, several at
+    the same time on a pool of threads.
+
+    :return: dict file name -> list of the mismatches and errors found,
+     empty if the file is valid
+    """
+    items = [(filename, chunk_size) for filename in filenames]
+    if threads > 1 and len(items) > 1:
+        pool = ThreadPool(min(threads, len(items)))
+        try:
+            problems = pool.map(_verify, items)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        problems = [_verify(item) for item in items]
+    return dict(zip(filenames, problems))
@@ -0,0 +1,313 @@
+# This file is part of Reflex
+# Copyright (C) 2010 European Southern Observatory
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""
+Minimal access to the primary header of FITS files, without pyfits.
+
+The header is read block by block until the END card, and the cards are
+parsed only for the requested keywords. Updates are written in place
+inside the existing header blocks when there is room for them, so the
+data units are never read nor rewritten.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+END_CARD = 'END'.ljust(CARD_SIZE)
+
+_NUMBER = re.compile(r'^[+-]?(\d+\.?\d*|\.\d+)([EeDd][+-]?\d+)?$')
+
+
+def read_header_cards(fileobj):
+    """
+    Read the cards of the header starting at the current position of
+    fileobj, up to the END card.
+
+    :return: list of the 80 characters cards, without END, and the size
+     of the header in bytes
+    """
+    cards = list()
+    size = 0
+    while True:
+        block = fileobj.read(BLOCK_SIZE)
+        if len(block) < BLOCK_SIZE:
+            raise ValueError('Truncated FITS header: no END card')
+        size += BLOCK_SIZE
+        block = block.decode('ascii')
+        for i in range(0, BLOCK_SIZE, CARD_SIZE):
+            card = block[i:i + CARD_SIZE]
+            if card == END_CARD:
+                return cards, size
+            cards.append(card)
+
+
+def card_keyword(card):
+    """
+    Keyword of a card; HIERARCH keywords keep the HIERARCH prefix and
+    have their blanks normalized, e.g. 'HIERARCH ESO DPR TYPE'.
+    """
+    if card.startswith('HIERARCH ') and '=' in card:
+        return ' '.join(card[:card.index('=')].split()).upper()
+    return card[:8].strip().upper()
+
+
+def normalize_keyword(keyword):
+    """
+    Keyword as returned by card_keyword: keywords longer than 8
+    characters or with blanks are HIERARCH keywords.
+    """
+    keyword = ' '.join(keyword.split()).upper()
+    if keyword.startswith('HIERARCH '):
+        return keyword
+    if len(keyword) > 8 or ' ' in keyword:
+        return 'HIERARCH ' + keyword
+    return keyword
+
+
+def _split_card(card):
+    """
+    Value and comment fields of a card, or (None, None) for a card
+    without value.
+    """
+    if card.startswith('HIERARCH '):
+        if '=' not in card:
+            return None, None
+        field = card[card.index('=') + 1:]
+    elif card[8:10] == '= ':
+        field = card[10:]
+    else:
+        return None, None
+
+    stripped = field.lstrip()
+    if stripped.startswith("'"):
+        # a quote inside a string is written as two quotes
+        i = 1
+        while i < len(stripped):
+            if stripped[i] == "'":
+                if stripped[i + 1:i + 2] == "'":
+                    i += 2
+                    continue
+                break
+            i += 1
+        value = stripped[:i + 1]
+        rest = stripped[i + 1:]
+    elif '/' in stripped:
+        value = stripped[:stripped.index('/')]
+        rest = stripped[stripped.index('/'):]
+    else:
+        value = stripped
+        rest = ''
+    rest = rest.strip()
+    comment = rest[1:].strip() if rest.startswith('/') else None
+    return value.strip(), comment
+
+
+def parse_value(card):
+    """
+    Value of a card: str, bool, int, float, or None if the card has no
+    value or an undefined one.
+    """
+    value = _split_card(card)[0]
+    if value is None or value == '':
+        return None
+    if value.startswith("'"):
+        return value[1:-1].replace("''", "'").rstrip()
+    if value == 'T':
+        return True
+    if value == 'F':
+        return False
+    if _NUMBER.match(value):
+        if re.match(r'^[+-]?\d+$', value):
+            return int(value)
+        return float(value.replace('D', 'E').replace('d', 'e'))
+    return value
+
+
+def parse_comment(card):
+    """
+    Comment of a card with a value, or None.
+    """
+    return _split_card(card)[1]
+
+
+def _format_value(value):
+    if isinstance(value, bool) or type(value).__name__ == 'bool_':
+        return 'T' if value else 'F'
+    if isinstance(value, str) or type(value).__name__ == 'unicode':
+        return "'%-8s'" % value.replace("'", "''")
+    if hasattr(value, 'dtype') and value.dtype.kind in 'iu':
+        return str(int(value))
+    if isinstance(value, int) or type(value).__name__ == 'long':
+        return str(value)
+    # repr is the shortest text read back as the same float
+    text = repr(float(value)).upper()
+    if '.' not in text and 'E' not in text and 'N' not in text:
+        text += '.0'
+    elif 'E' in text and '.' not in text:
+        text = text.replace('E', '.0E')
+    return text
+
+
+def format_card(keyword, value, comment=None):
+    """
+    Format a card with a value, in fixed format for the standard
+    keywords and as a HIERARCH card for the others.
+
+    :raise ValueError: if the keyword and value do not fit in a card;
+     a comment that does not fit is truncated
+    """
+    keyword = normalize_keyword(keyword)
+    text = _format_value(value)
+    if keyword.startswith('HIERARCH '):
+        card = keyword + ' = ' + text
+    elif text.startswith("'"):
+        card = keyword.ljust(8) + '= ' + text.ljust(20)
+    else:
+        card = keyword.ljust(8) + '= ' + text.rjust(20)
+    if len(card) > CARD_SIZE:
+        raise ValueError('Value of ' + keyword + ' does not fit in a card')
+    if comment:
+        card = card + ' / ' + comment
+    return card[:CARD_SIZE].ljust(CARD_SIZE)
+
+
+def data_size(cards):
+    """
+    Size in bytes of the data unit following a header, padded to whole
+    blocks.
+    """
+    values = dict()
+    for card in cards:
+        keyword = card_keyword(card)
+        if keyword in ('BITPIX', 'NAXIS', 'PCOUNT', 'GCOUNT') or \
+                keyword.startswith('NAXIS'):
+            values[keyword] = parse_value(card)
+    naxis = values.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+    size = 1
+    for i in range(1, naxis + 1):
+        size *= values['NAXIS%d' % i]
+    size = (abs(values['BITPIX']) // 8 * values.get('GCOUNT', 1) *
+            (values.get('PCOUNT', 0) + size))
+    return (size + BLOCK_SIZE - 1) // BLOCK_SIZE * BLOCK_SIZE
+
+
+def read_header(filename, hdu=0):
+    """
+    Read the cards of the header of an HDU; the data units of the
+    preceding HDUs are skipped, not read.
+
+    :param hdu: index of the HDU, 0 for the primary header
+
+    :return: list of the 80 characters cards, without END
+    """
+    with open(filename, 'rb') as fileobj:
+        for i in range(hdu + 1):
+            cards = read_header_cards(fileobj)[0]
+            if i < hdu:
+                fileobj.seek(data_size(cards), os.SEEK_CUR)
+    return cards
+
+
+def header_values(cards, keywords):
+    """
+    Values of some keywords in a list of cards.
+
+    :param keywords: list of keywords, HIERARCH ones with or without
+     the HIERARCH prefix
+
+    :return: dict keyword -> value, for the keywords found (the first
+     occurrence for repeated keywords)
+    """
+    wanted = dict((normalize_keyword(k), k) for k in keywords)
+    values = dict()
+    for card in cards:
+        keyword = card_keyword(card)
+        if keyword in wanted and wanted[keyword] not in values:
+            values[wanted[keyword]] = parse_value(card)
+    return values
+
+
+def read_keywords(filename, keywords, hdu=0):
+    """
+    Read the values of some keywords of the header of an HDU, the
+    primary one by default.
+
+    :return: dict keyword -> value, see header_values
+    """
+    return header_values(read_header(filename, hdu), keywords)
+
+
+def update_header(filename, updates):
+    """
+    Update or add cards of the primary header of a FITS file.
+
+    The cards are changed in place in the existing header blocks when
+    the padding leaves room for the new ones. Otherwise the file is
+    rewritten with a larger header into a temporary file, which then
+    atomically replaces the original. The data units are copied as
+    bytes, never parsed.
+
+    :param updates: list of (keyword, value, comment) tuples; a None
+     comment keeps the comment of an existing card
+
+    :return: True if the header was updated in place
+    """
+    with open(filename, 'r+b') as fileobj:
+        cards, header_size = read_header_cards(fileobj)
+        keywords = [card_keyword(card) for card in cards]
+        for keyword, value, comment in updates:
+            keyword = normalize_keyword(keyword)
+            if keyword in keywords:
+                i = keywords.index(keyword)
+                if comment is None:
+                    comment = parse_comment(cards[i])
+                cards[i] = format_card(keyword, value, comment)
+            else:
+                cards.append(format_card(keyword, value, comment))
+                keywords.append(keyword)
+
+        cards.append(END_CARD)
+        header = ''.join(cards)
+        n_blocks = (len(header) + BLOCK_SIZE - 1) // BLOCK_SIZE
+        header = header.ljust(n_blocks * BLOCK_SIZE).encode('ascii')
+
+        if len(header) == header_size:
+            fileobj.seek(0)
+            fileobj.write(header)
+            return True
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    handle, tmp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as tmp_file:
+            tmp_file.write(header)
+            with open(filename, 'rb') as fileobj:
+                fileobj.seek(header_size)
+                shutil.copyfileobj(fileobj, tmp_file, 16 * 1024 * 1024)
+        shutil.copymode(filename, tmp_name)
+        os.rename(tmp_name, filename)
+    except Exception:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+    return False
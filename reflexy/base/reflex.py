@@ -21,29 +21,155 @@ import re
 import sys
 import json
 import os
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
-try:
-    import pyfits
-
-    def evalChecksum(filename):
-        (mode, ino, dev, nlink, uid, gid, size,
-         atime, mtime, ctime) = os.stat(filename.name)
-        checksum = str(mtime*1000) + str(
-            size)  # times 1000 to be compatible with java
-        header = pyfits.open(filename.name)[0].header
-        md5 = header.get('DATAMD5')
-        if md5 is not None:
-            checksum = checksum + str(md5).strip()
-        cksum = header.get('CHECKSUM')
-        if cksum is not None:
-            checksum = checksum + str(cksum).strip()
-            datasum = header.get('DATASUM')
-            if datasum is not None:
-                checksum = checksum + str(datasum).strip()
-        return checksum
-except:
-    def evalChecksum(filename):
-        return None
+from reflexy.base import fits_header
+
+# keywords of the primary header identifying the content of a file
+CHECKSUM_KEYWORDS = ['DATAMD5', 'CHECKSUM', 'DATASUM']
+
+
+def evalChecksum(filename, stat=None):
+    """
+    Identity of a file, as computed by Reflex: its modification time
+    and size, and the DATAMD5, CHECKSUM and DATASUM keywords of its
+    primary header. Only the header blocks are read.
+
+    :param filename: ~FitsFile
+    :param stat: result of os.stat for the file, if already known
+    """
+    if stat is None:
+        stat = os.stat(filename.name)
+    (mode, ino, dev, nlink, uid, gid, size,
+     atime, mtime, ctime) = stat
+    checksum = str(mtime*1000) + str(
+        size)  # times 1000 to be compatible with java
+    header = fits_header.read_keywords(filename.name, CHECKSUM_KEYWORDS)
+    md5 = header.get('DATAMD5')
+    if md5 is not None:
+        checksum = checksum + str(md5).strip()
+    cksum = header.get('CHECKSUM')
+    if cksum is not None:
+        checksum = checksum + str(cksum).strip()
+        datasum = header.get('DATASUM')
+        if datasum is not None:
+            checksum = checksum + str(datasum).strip()
+    return checksum
+
+
+def verifyChecksum(filename):
+    """
+    Verify the CHECKSUM and DATASUM keywords of every HDU of a file
+    against its content, streaming its data units from a memory map,
+    see reflexy.base.fits_checksum (needs numpy).
+
+    :param filename: ~FitsFile
+
+    :return: list of the mismatches and errors found, empty if the file
+     is valid or has no checksum keyword
+    """
+    from reflexy.base import fits_checksum
+    return fits_checksum.verify_files([filename.name], threads=1)[filename.name]
+
+
+class ChecksumCache(object):
+    """
+    Persistent cache of the checksums computed by evalChecksum, in a
+    JSON file shared by the invocations of the actors.
+
+    The checksum of a file is stored under its path, inode,
+    modification time and size, so an unchanged file gets its checksum
+    back from a stat, without opening it. At most max_entries entries
+    are kept, the most recently used ones.
+    """
+
+    def __init__(self, filename, max_entries=100000):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.entries = self._load()
+        self._changed = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return dict()
+        if not isinstance(entries, dict):
+            return dict()
+        return entries
+
+    @staticmethod
+    def key(name, stat):
+        return '%s|%d|%r|%d' % (os.path.abspath(name), stat.st_ino,
+                                stat.st_mtime, stat.st_size)
+
+    def get(self, name, stat):
+        """
+        :return: the checksum of the file, or None if not cached
+        """
+        entry = self.entries.get(self.key(name, stat))
+        if entry is None:
+            return None
+        with self._lock:
+            entry[1] = time.time()
+            self._changed = True
+        return entry[0]
+
+    def put(self, name, stat, checksum):
+        with self._lock:
+            self.entries[self.key(name, stat)] = [checksum, time.time()]
+            self._changed = True
+
+    def save(self):
+        """
+        Write the cache, merged with the entries saved meanwhile by
+        other processes, atomically.
+        """
+        if not self._changed:
+            return
+        with self._lock:
+            entries = self._load()
+            for key, entry in self.entries.items():
+                if key not in entries or entries[key][1] < entry[1]:
+                    entries[key] = entry
+            if len(entries) > self.max_entries:
+                recent = sorted(entries.items(), key=lambda item: item[1][1])
+                entries = dict(recent[-self.max_entries:])
+            directory = os.path.dirname(os.path.abspath(self.filename))
+            handle, tmp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'w') as tmp_file:
+                    json.dump(entries, tmp_file)
+                os.rename(tmp_name, self.filename)
+            except Exception:
+                if os.path.exists(tmp_name):
+                    os.remove(tmp_name)
+                raise
+            self.entries = entries
+            self._changed = False
+
+
+class _Interned(object):
+    """
+    Table sharing one string between the files of a SoF for the values
+    repeated in many of them: categories and purposes. Every file still
+    gets its own list of purposes, which callers may modify.
+    """
+
+    def __init__(self):
+        self._strings = dict()
+
+    def category(self, category):
+        return self._strings.setdefault(category, category)
+
+    def purposes(self, purposes):
+        return [self._strings.setdefault(purpose, purpose)
+                for purpose in purposes]
 
 
 def parseSof(sof):
@@ -61,12 +187,12 @@ def parseSof(sof):
     only_sof = sof[sof.index('|')+1:]
     if len(only_sof) == 0:
         return SetOfFiles(dataset_name, files)
-    sof_splitted = only_sof.split(',')
-    for frame in sof_splitted:
-        name = frame[0:frame.find(";")]
-        category = frame[(frame.find(";")+1):(frame.rfind(";"))]
-        purposes = frame[(frame.rfind(";"))+1:].split(':')
-        files.append(FitsFile(name, category, None, purposes))
+    interned = _Interned()
+    for frame in only_sof.split(','):
+        name, _, rest = frame.partition(';')
+        category, _, purposes = rest.rpartition(';')
+        files.append(FitsFile(name, interned.category(category), None,
+                              interned.purposes(purposes.split(':'))))
     return SetOfFiles(dataset_name, files)
 
 
@@ -76,10 +202,10 @@ def parseSofJson(sof):
     a SetOfFiles object.
     Use this method if the sof comes from within Reflex.
     """
-    files = list()
-    for f in sof['files']:
-        files.append(FitsFile(f['name'], f['category'],
-                              f['checksum'], f['purposes']))
+    interned = _Interned()
+    files = [FitsFile(f['name'], interned.category(f['category']),
+                      f['checksum'], interned.purposes(f['purposes']))
+             for f in sof['files']]
     return SetOfFiles(sof['datasetName'], files)
 
 
@@ -121,11 +247,12 @@ def parseSopJson(sop):
     return params
 
 
-class SetOfFiles:
+class SetOfFiles(object):
     """
     Simple class that contains information about a set of files,
     its category and the dataset name they belong to.
     """
+    __slots__ = ('datasetName', 'files')
 
     def __init__(self, datasetName, files):
         self.datasetName = datasetName
@@ -136,7 +263,64 @@ class SetOfFiles:
 
     def __eq__(self, other):
         return isinstance(other, SetOfFiles) and \
-               vars(self) == vars(other)
+               self.datasetName == other.datasetName and \
+               list(self.files) == list(other.files)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def evalChecksums(self, threads=8, cache=None):
+        """
+        Compute the checksum of every file with evalChecksum,
+        concurrently on a pool of threads, and store it in the checksum
+        attribute of the files.
+
+        :param threads: number of files checked at the same time
+        :param cache: ~ChecksumCache
+         if given, the unchanged files get their checksum from the cache,
+         and the cache is saved with the new ones
+
+        :return: list of the checksums, in the order of the files
+        """
+        def checksum(fits_file):
+            stat = os.stat(fits_file.name)
+            if cache is not None:
+                value = cache.get(fits_file.name, stat)
+                if value is not None:
+                    return value
+            value = evalChecksum(fits_file, stat)
+            if cache is not None:
+                cache.put(fits_file.name, stat, value)
+            return value
+
+        if threads > 1 and len(self.files) > 1:
+            pool = ThreadPool(min(threads, len(self.files)))
+            try:
+                checksums = pool.map(checksum, self.files)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            checksums = [checksum(fits_file) for fits_file in self.files]
+        for fits_file, value in zip(self.files, checksums):
+            fits_file.checksum = value
+        if cache is not None:
+            cache.save()
+        return checksums
+
+    def verifyChecksums(self, threads=4):
+        """
+        Verify the CHECKSUM and DATASUM keywords of every file, several
+        files at the same time on a pool of threads, see verifyChecksum.
+
+        :return: dict file name -> list of the mismatches and errors
+         found, only for the files with problems
+        """
+        from reflexy.base import fits_checksum
+        problems = fits_checksum.verify_files(
+            [fits_file.name for fits_file in self.files], threads)
+        return dict((name, messages) for name, messages in problems.items()
+                    if messages)
 
     def toJSON(self):
         ret = dict()
@@ -151,11 +335,15 @@ class SetOfFiles:
         return val
 
 
-class FitsFile:
+class FitsFile(object):
     """
     Simple class that contains information about the filename
     and its category
+
+    The files of the SoFs parsed by parseSof and parseSofJson share their
+    category and purpose strings.
     """
+    __slots__ = ('name', 'category', 'purposes', 'checksum')
 
     def __init__(self, name, category, checksum=None, purposes=None):
         if purposes is None:
@@ -167,14 +355,20 @@ class FitsFile:
 
     def __eq__(self, other):
         return isinstance(other, FitsFile) and \
-               vars(self) == vars(other)
+               self.name == other.name and \
+               self.category == other.category and \
+               self.checksum == other.checksum and \
+               list(self.purposes) == list(other.purposes)
+
+    def __ne__(self, other):
+        return not self == other
 
     def toJSON(self):
         ret = dict()
         ret['class'] = 'org.eso.domain.FitsFile'
         ret['name'] = self.name
         ret['category'] = self.category
-        ret['purposes'] = self.purposes
+        ret['purposes'] = list(self.purposes)
         ret['checksum'] = self.checksum
         return ret
 
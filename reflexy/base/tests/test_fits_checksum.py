@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from astropy.io import fits
+
+from reflexy.base import fits_checksum, fits_header, reflex
+
+
+class TestFitsChecksum(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'product.fits')
+        np.random.seed(3)
+        primary = fits.PrimaryHDU(
+            np.random.normal(size=(60, 77)).astype(np.float32))
+        table = fits.BinTableHDU.from_columns(
+            [fits.Column(name='data', format='J', array=np.arange(5000))])
+        fits.HDUList([primary, table, fits.ImageHDU()]).writeto(
+            self.filename, checksum=True)
+        with open(self.filename, 'rb') as f:
+            self.content = bytearray(f.read())
+        # primary header and data, then the header of the table
+        self.table_data = (1 + 7 + 1) * fits_header.BLOCK_SIZE
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, content, name='changed.fits'):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'wb') as f:
+            f.write(content)
+        return filename
+
+    def test_ones_complement_sum(self):
+        words = np.array([0xffffffff, 2, 0x80000000, 0x80000000], '>u4')
+        # the carries wrap around
+        self.assertEqual(fits_checksum.ones_complement_sum(words), 3)
+        self.assertEqual(fits_checksum.ones_complement_sum(words[:2]), 2)
+        for chunk_size in (1, 3):
+            self.assertEqual(fits_checksum.ones_complement_sum(
+                words, chunk_size=chunk_size), 3)
+
+    def test_valid_file(self):
+        for chunk_size in (7, 4 * 1024 ** 2):
+            results = fits_checksum.verify_file(self.filename, chunk_size)
+            self.assertEqual(len(results), 3)
+            for result, hdu in zip(results, range(3)):
+                header = fits.getheader(self.filename, hdu)
+                self.assertEqual(result['datasum'], int(header['DATASUM']))
+                self.assertTrue(result['datasum_ok'])
+                self.assertTrue(result['checksum_ok'])
+
+    def test_corrupted_data(self):
+        content = bytearray(self.content)
+        content[3 * fits_header.BLOCK_SIZE + 10] ^= 4
+        filename = self.write(content)
+        self.assertEqual(fits_checksum.verify_files([filename]), {
+            filename: ['DATASUM mismatch in HDU 0',
+                       'CHECKSUM mismatch in HDU 0']})
+
+    def test_corrupted_header(self):
+        content = bytes(self.content).replace(b"'IMAGE   '", b"'IMAGF   '")
+        filename = self.write(content)
+        self.assertEqual(fits_checksum.verify_files([filename]), {
+            filename: ['CHECKSUM mismatch in HDU 2']})
+
+    def test_no_checksum(self):
+        filename = os.path.join(self.directory, 'raw.fits')
+        fits.PrimaryHDU(np.ones(10)).writeto(filename)
+        results = fits_checksum.verify_file(filename)
+        self.assertIsNone(results[0]['datasum_ok'])
+        self.assertIsNone(results[0]['checksum_ok'])
+        self.assertEqual(fits_checksum.mismatches(results), [])
+
+    def test_truncated(self):
+        filename = self.write(
+            self.content[:self.table_data + fits_header.BLOCK_SIZE])
+        problems = fits_checksum.verify_files([filename, self.filename],
+                                              threads=2)
+        self.assertEqual(problems[self.filename], [])
+        self.assertEqual(len(problems[filename]), 1)
+        self.assertIn('Truncated', problems[filename][0])
+
+    def test_set_of_files(self):
+        content = bytearray(self.content)
+        content[self.table_data + 10] ^= 1
+        changed = self.write(content)
+        sof = reflex.SetOfFiles('dataset', [
+            reflex.FitsFile(self.filename, 'PRODUCT'),
+            reflex.FitsFile(changed, 'PRODUCT')])
+        self.assertEqual(reflex.verifyChecksum(sof.files[0]), [])
+        self.assertEqual(sof.verifyChecksums(threads=2), {
+            changed: ['DATASUM mismatch in HDU 1',
+                      'CHECKSUM mismatch in HDU 1']})
@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from astropy.io import fits
+
+from reflexy.base import fits_header
+
+
+class TestFitsHeader(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'table.fits')
+        primary = fits.PrimaryHDU()
+        primary.header['RA'] = (150.25, 'pointing RA')
+        primary.header['DEC'] = (-2.5, 'pointing DEC')
+        primary.header['HIERARCH ESO DPR TYPE'] = 'OBJECT'
+        primary.header['OBJECT'] = "NGC 'x'"
+        table = fits.BinTableHDU.from_columns(
+            [fits.Column(name='data', format='E',
+                         array=np.arange(5000, dtype=np.float32))])
+        fits.HDUList([primary, table]).writeto(self.filename)
+        with open(self.filename, 'rb') as f:
+            self.content = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def header_size(self):
+        with open(self.filename, 'rb') as f:
+            return fits_header.read_header_cards(f)[1]
+
+    def data(self):
+        with open(self.filename, 'rb') as f:
+            return f.read()[self.header_size():]
+
+    def test_read_keywords(self):
+        values = fits_header.read_keywords(
+            self.filename, ['RA', 'DEC', 'ESO DPR TYPE', 'OBJECT', 'MISSING'])
+        self.assertEqual(values, {'RA': 150.25, 'DEC': -2.5,
+                                  'ESO DPR TYPE': 'OBJECT',
+                                  'OBJECT': "NGC 'x'"})
+
+    def test_read_extension_keywords(self):
+        values = fits_header.read_keywords(self.filename,
+                                           ['XTENSION', 'NAXIS2', 'RA'], hdu=1)
+        self.assertEqual(values, {'XTENSION': 'BINTABLE', 'NAXIS2': 5000})
+
+    def test_format_card(self):
+        card = fits_header.format_card('RA', 150.25, 'pointing')
+        self.assertEqual(len(card), 80)
+        self.assertEqual(fits_header.parse_value(card), 150.25)
+        self.assertEqual(fits_header.parse_comment(card), 'pointing')
+        card = fits_header.format_card('REFLEX ALIGNED', True)
+        self.assertTrue(card.startswith('HIERARCH REFLEX ALIGNED = T'))
+        self.assertIs(fits_header.parse_value(card), True)
+        card = fits_header.format_card('EXPONENT', 1e-20)
+        self.assertEqual(fits_header.parse_value(card), 1e-20)
+
+    def test_update_in_place(self):
+        data = self.data()
+        in_place = fits_header.update_header(self.filename, [
+            ('RA', 150.5, None),
+            ('HIERARCH REFLEX ALIGNED', 1, None),
+            ('HIERARCH REFLEX APPOFFRA', 0.25, 'Median offset in RA (deg)')])
+        self.assertTrue(in_place)
+        self.assertEqual(os.path.getsize(self.filename), len(self.content))
+        self.assertEqual(self.data(), data)
+
+        header = fits.getheader(self.filename)
+        self.assertEqual(header['RA'], 150.5)
+        self.assertEqual(header.comments['RA'], 'pointing RA')
+        self.assertEqual(header['DEC'], -2.5)
+        self.assertEqual(header['HIERARCH REFLEX ALIGNED'], 1)
+        self.assertEqual(header['HIERARCH REFLEX APPOFFRA'], 0.25)
+        self.assertEqual(header.comments['HIERARCH REFLEX APPOFFRA'],
+                         'Median offset in RA (deg)')
+
+    def test_update_grows_header(self):
+        data = self.data()
+        size = self.header_size()
+        updates = [('HIERARCH REFLEX KEY%d' % i, float(i), 'comment')
+                   for i in range(40)]
+        in_place = fits_header.update_header(self.filename, updates)
+        self.assertFalse(in_place)
+        self.assertEqual(self.header_size(), size + fits_header.BLOCK_SIZE)
+        self.assertEqual(self.data(), data)
+        self.assertEqual(os.listdir(self.directory), ['table.fits'])
+
+        with fits.open(self.filename) as hdulist:
+            self.assertEqual(hdulist[0].header['HIERARCH REFLEX KEY39'], 39.)
+            np.testing.assert_array_equal(hdulist[1].data['data'],
+                                          np.arange(5000))
+
+    def test_truncated_header(self):
+        with open(self.filename, 'wb') as f:
+            f.write(self.content[:fits_header.CARD_SIZE * 3])
+        self.assertRaises(ValueError, fits_header.read_keywords,
+                          self.filename, ['RA'])
@@ -1,4 +1,12 @@
+import json
+import os
+import shutil
+import tempfile
 import unittest
+
+import numpy as np
+from astropy.io import fits
+
 from reflexy.base import reflex
 
 
@@ -32,6 +40,43 @@ class TestReflexModule(unittest.TestCase):
         r2 = reflex.parseSofJson(j)
         self.assertEqual(r, r2)
 
+    def test_parseSofShared(self):
+        sof = 'dataset|' + ','.join(
+            'PIXTABLE_OBJECT_%04d-%02d.fits;PIXTABLE_OBJECT;PURPOSE1:PURPOSE2'
+            % (i, ifu) for i in range(3) for ifu in range(1, 25))
+        for r in (reflex.parseSof(sof),
+                  reflex.parseSofJson(json.loads(json.dumps(
+                      reflex.parseSof(sof), cls=reflex.ReflexEncoder)))):
+            self.assertEqual(len(r), 72)
+            first = r.files[0]
+            self.assertEqual(first.purposes, ['PURPOSE1', 'PURPOSE2'])
+            # the files have no __dict__, only their four fields
+            self.assertFalse(hasattr(first, '__dict__'))
+            self.assertFalse(hasattr(r, '__dict__'))
+            self.assertRaises(AttributeError, setattr, first, 'extra', 1)
+            for f in r.files[1:]:
+                self.assertIs(f.category, first.category)
+                self.assertIsNot(f.purposes, first.purposes)
+                for purpose, first_purpose in zip(f.purposes,
+                                                  first.purposes):
+                    self.assertIs(purpose, first_purpose)
+            # the purposes of a file can be modified on their own
+            first.purposes.append('PURPOSE3')
+            self.assertEqual(r.files[1].purposes, ['PURPOSE1', 'PURPOSE2'])
+
+    def test_equality(self):
+        f = reflex.FitsFile('a.fits', 'RAW', None, ['PURPOSE1'])
+        self.assertEqual(f, reflex.FitsFile('a.fits', 'RAW', None,
+                                            ('PURPOSE1',)))
+        self.assertNotEqual(f, reflex.FitsFile('a.fits', 'RAW', 'sum',
+                                               ['PURPOSE1']))
+        self.assertNotEqual(f, reflex.FitsFile('b.fits', 'RAW', None,
+                                               ['PURPOSE1']))
+        self.assertEqual(reflex.SetOfFiles('d', [f]),
+                         reflex.SetOfFiles('d', (f,)))
+        self.assertNotEqual(reflex.SetOfFiles('d', [f]),
+                            reflex.SetOfFiles('e', [f]))
+
     def test_parseSop(self):
         r = reflex.parseSop(self.sop)
         self.assertEqual(len(r), len(self.sopexp))
@@ -40,5 +85,108 @@ class TestReflexModule(unittest.TestCase):
             self.assertEqual(p.displayName, ep[0])
             self.assertEqual(p.value, ep[1])
 
+
+class TestEvalChecksum(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def identity(self, filename):
+        stat = os.stat(filename)
+        return str(int(stat.st_mtime) * 1000) + str(stat.st_size)
+
+    def test_checksum_keywords(self):
+        filename = os.path.join(self.directory, 'product.fits')
+        primary = fits.PrimaryHDU(np.arange(100, dtype=np.int16))
+        primary.header['DATAMD5'] = 'd41d8cd98f00b204e9800998ecf8427e'
+        primary.writeto(filename, checksum=True)
+        header = fits.getheader(filename)
+
+        checksum = reflex.evalChecksum(reflex.FitsFile(filename, 'RAW'))
+        self.assertEqual(checksum, self.identity(filename) +
+                         header['DATAMD5'] + header['CHECKSUM'] +
+                         header['DATASUM'])
+
+    def test_no_checksum_keywords(self):
+        filename = os.path.join(self.directory, 'raw.fits')
+        fits.PrimaryHDU().writeto(filename)
+        checksum = reflex.evalChecksum(reflex.FitsFile(filename, 'RAW'))
+        self.assertEqual(checksum, self.identity(filename))
+
+    def test_not_fits(self):
+        filename = os.path.join(self.directory, 'notes.txt')
+        with open(filename, 'w') as f:
+            f.write('not a FITS file')
+        self.assertRaises(ValueError, reflex.evalChecksum,
+                          reflex.FitsFile(filename, 'NOTES'))
+
+
+class TestChecksums(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        files = list()
+        for k in range(5):
+            name = os.path.join(self.directory, 'raw%d.fits' % k)
+            fits.PrimaryHDU(np.zeros(k + 1)).writeto(name, checksum=True)
+            files.append(reflex.FitsFile(name, 'RAW'))
+        self.sof = reflex.SetOfFiles('dataset', files)
+        self.cache_file = os.path.join(self.directory, 'checksums.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_eval_checksums(self):
+        expected = [reflex.evalChecksum(f) for f in self.sof.files]
+        self.assertEqual(self.sof.evalChecksums(threads=3), expected)
+        self.assertEqual([f.checksum for f in self.sof.files], expected)
+        self.assertEqual(self.sof.evalChecksums(threads=1), expected)
+
+    def test_cache(self):
+        expected = self.sof.evalChecksums(
+            cache=reflex.ChecksumCache(self.cache_file))
+        self.assertTrue(os.path.exists(self.cache_file))
+
+        calls = list()
+
+        def counting(filename, stat=None):
+            calls.append(filename.name)
+            return evalChecksum(filename, stat)
+        evalChecksum = reflex.evalChecksum
+        reflex.evalChecksum = counting
+        try:
+            cache = reflex.ChecksumCache(self.cache_file)
+            self.assertEqual(self.sof.evalChecksums(cache=cache), expected)
+            self.assertEqual(calls, [])
+
+            # a modified file is checked again
+            changed = self.sof.files[2].name
+            os.utime(changed, (1e9, 1e9))
+            checksums = self.sof.evalChecksums(cache=cache)
+            self.assertEqual(calls, [changed])
+            self.assertNotEqual(checksums[2], expected[2])
+        finally:
+            reflex.evalChecksum = evalChecksum
+
+    def test_cache_merge(self):
+        first = reflex.ChecksumCache(self.cache_file, max_entries=4)
+        second = reflex.ChecksumCache(self.cache_file, max_entries=4)
+        reflex.SetOfFiles('a', self.sof.files[:2]).evalChecksums(cache=first)
+        reflex.SetOfFiles('b', self.sof.files[2:4]).evalChecksums(
+            cache=second)
+        self.assertEqual(len(reflex.ChecksumCache(self.cache_file).entries),
+                         4)
+        reflex.SetOfFiles('c', self.sof.files[4:]).evalChecksums(cache=first)
+        entries = reflex.ChecksumCache(self.cache_file).entries
+        self.assertEqual(len(entries), 4)
+        # one of the least recently used entries is dropped
+        for fits_file in self.sof.files[2:]:
+            self.assertTrue(any(key.startswith(fits_file.name + '|')
+                                for key in entries))
+
+
 if __name__ == "__main__":
     unittest.main()
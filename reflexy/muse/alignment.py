@@ -1,420 +1,2110 @@
-#!/usr/bin/env python
-from reflexy.base import reflex
-
-import sys 
-import os
-import math
-import json
-from optparse import OptionParser
-import warnings
-import time
-
-try:
-    from optparse import OptionParser
-    from astropy.io import fits
-    import numpy as np
-    from numpy import array
-    from photutils import datasets
-    from photutils import daofind
-    from astropy.stats import median_absolute_deviation as mad
-    from astropy.io import fits as pyfits
-    from astropy import wcs as pywcs
-#import scikit-image
-    import astropy
-    import scipy
-#    import pywcs # WCS conversion routines NOT NEEDED ANYMORE
-#    import pyfits # NOT NEEDED ANYMORE
-    import copy
-    import matplotlib.pyplot as plt
-    import_ok = 1
-#except ImportError:
-except ImportError as e:
-    import_ok = 0
-    import_error = e
-
-def find_closest(id_,x,y,idlist,xlist,ylist,dist_max):
-    """
-
-    :param id_:
-     id
-    :param x: ~float
-
-    :param y: ~float
-    :param idlist:
-    :param xlist: ~numpy.ndarray
-    :param ylist: ~numpy.ndarray
-    :param dist_max: ~float
-
-    :return:
-    """
-
-    distances = ((x-xlist)**2. + (y-ylist)**2.)**0.5
-    indici, = np.where(distances == distances.min())
-    D = distances.min()
-    Dx=x-xlist[indici[0]]  #offset in X (RA) of the matched source
-    Dy=y-ylist[indici[0]]  #offset in Y (DEC) of the matched source
-    if D <= dist_max:
-        id_sel = idlist[indici[0]]+0.
-        x_sel = xlist[indici[0]]+0.
-        y_sel = ylist[indici[0]]+0.
-    else:
-        id_sel = []    
-        x_sel=[]#0./0.
-        y_sel=[]#0./0.
-        D=[]#0./0.
-        Dx=[]#0./0.
-        Dy=[]#0./0.
-
-    return(Dx,Dy,D,x_sel,y_sel,id_sel)
-
-
-def find_matches(id_,x_,y_,id_ref,x_ref,y_ref,dist_max):
-    """
-
-    :param id_: ~numpy.ndarray
-    :param x_: ~numpy.ndarray
-
-    :param y_: ~numpy.ndarray
-
-    :param id_ref: ~numpy.ndarray
-
-    :param x_ref: ~numpy.ndarray
-
-    :param y_ref: ~numpy.ndarray
-    :param dist_max: ~float
-    :return:
-    """
-
-    i=0
-    offset_x=[0]
-    offset_y=[0]
-    n_matches=[0]
-    id_match_test=[-1]
-    id_match = [-1]
-    offset_x_ =[]
-    offset_y_ =[]
-    while (i < len(id_)):
-       search=range(len(id_ref))
-       id_match_test=[-1]
-       while (id_[i] != id_match_test):
-          id_match_test=[-1]  
-          Dx,Dy,D,x_sel,y_sel,id_sel = find_closest(id_[i],x_[i],y_[i],id_ref[search],x_ref[search],y_ref[search],dist_max)
-          if id_sel == []: 
-             break
-            # print id_[i], ' has no matches'
-             
-          ind_match, = np.where(id_sel == id_ref)
-          Dx_test,Dy_test,D_test,x_sel_test,y_sel_test,id_match_test = find_closest(id_ref[ind_match],x_ref[ind_match],y_ref[ind_match],id_,x_,y_,dist_max)
-          if id_match_test == id_[i]:
-             offset_x_.append(Dx)
-             offset_y_.append(Dy)
-          else:
-             if len(search) == 1:
-                break
-             search.remove(ind_match)
-       i = i+1
-    
-    if (offset_x_ == []):
-       offset_x=[0]
-       offset_y=[0]
-       rms_x=[0]
-       rms_y=[0]
-       n_matches=0 
-    else:
-       offset_x = np.median(offset_x_)   # median offsets in X, considering all the matched sources
-       offset_y = np.median(offset_y_)   # median offsets in Y, considering all the matched sources
-       rms_x=np.std(offset_x_)
-       rms_y=np.std(offset_y_)
-       n_matches=len(offset_x_)
-    return(offset_x,offset_y,n_matches,rms_x,rms_y)
-
-
-def compute_offsets(id_,x,y,id_ref,x_ref,y_ref):
-    nBIAS=31 #51
-    step = 1.4#70./(nBIAS-1.) 
-    max_dist_arcs = step/2.*1.6   
-    max_dist=max_dist_arcs/3600.
-
-    # ...
-    ra_bias_offset=  (np.arange(nBIAS)*step -(nBIAS-1)*step/2.)/3600.0
-    dec_bias_offset= (np.arange(nBIAS)*step -(nBIAS-1)*step/2.)/3600.0
-    
-    ncommon_matrix  = np.zeros([nBIAS,nBIAS],float)
-    offset_x_matrix = np.zeros([nBIAS,nBIAS],float)
-    offset_y_matrix = np.zeros([nBIAS,nBIAS],float)
-    rms_ra_matrix   = np.zeros([nBIAS,nBIAS],float)
-    rms_dec_matrix  = np.zeros([nBIAS,nBIAS],float)
-    offset_x=0.
-    offset_y=0.
-    n_matches=0.
-    rms_ra=-1.
-    rms_dec=-1.
-    id_common=0
-    x_original=x+0
-    y_original=y+0
-
-    for I_RA in range(nBIAS):
-        for I_DEC in range(nBIAS):
-
-            x_ = x_original+ra_bias_offset[I_RA]
-            y_ = y_original+dec_bias_offset[I_DEC]
-            small_off_x,small_off_y,n_matches,rms_x,rms_y = find_matches(id_,x_,y_,id_ref,x_ref,y_ref,max_dist)
-            ncommon_matrix[I_RA,I_DEC] = n_matches
-
-            offset_x_matrix[I_RA,I_DEC]  = ra_bias_offset[I_RA]-small_off_x
-            offset_y_matrix[I_RA,I_DEC]  = dec_bias_offset[I_DEC]-small_off_y
-            rms_ra_matrix[I_RA,I_DEC]  = np.array(rms_x)
-            rms_dec_matrix[I_RA,I_DEC]  = np.array(rms_y)
-                
- 
-    (indxx,indyy) = np.where(ncommon_matrix == ncommon_matrix.max())
-
-    if len(indxx) == 0:
-        offset_x=0.
-        offset_y=0.
-        n_match=0.
-        rms_ra=-1.
-        rms_dec=-1.
-        id_common=0
-        
-
-    
-    if len(indxx) == 1:
-        n_match = ncommon_matrix[indxx[0],indyy[0]]+0.
-        rms_ra = rms_ra_matrix[indxx[0],indyy[0]]+0.
-        rms_dec = rms_dec_matrix[indxx[0],indyy[0]]+0.
-        offset_x = -offset_x_matrix[indxx[0],indyy[0]]+0.
-        offset_y = -offset_y_matrix[indxx[0],indyy[0]]+0.
-
-    if len(indxx) > 1:
-
-        tmp_offset_x_matrix = offset_x_matrix[indxx,indyy]+0.
-        tmp_offset_y_matrix = offset_y_matrix[indxx,indyy]+0.
-        dist_ = (tmp_offset_x_matrix**2.+tmp_offset_y_matrix**2.)**0.5
-        
-        (new_indxx,new_indyy) = np.where((offset_x_matrix**2+offset_y_matrix**2)**0.5 == dist_.min() )
-
-        n_match = ncommon_matrix[new_indxx[0],new_indyy[0]]+0.
-        rms_ra = rms_ra_matrix[new_indxx[0],new_indyy[0]]+0.
-        rms_dec = rms_dec_matrix[new_indxx[0],new_indyy[0]]+0.
-        offset_x = -offset_x_matrix[new_indxx[0],new_indyy[0]]+0.
-        offset_y = -offset_y_matrix[new_indxx[0],new_indyy[0]]+0.
-
-
-
-    return(offset_x,offset_y,n_match,rms_ra,rms_dec)
-
-
-
-if __name__ == '__main__':
-
-#  from astropy.io import fits
-#  import numpy as np
-#  from numpy import array
-#  from photutils import datasets
-#  from photutils import daofind
-#  from astropy.stats import median_absolute_deviation as mad
-#  #import scikit-image
-#  import astropy
-#  import scipy
-#  import pywcs # WCS conversion routines
-#  import pyfits
-#  import copy 
-#  import matplotlib.pyplot as plt
-#  import time
-
-  
-#   MAIN MODULE --- to be interfaced with REFLEX ---
-  warnings.filterwarnings("ignore")
- #getting the inputs and defyning the outputs
-  parser = reflex.ReflexIOParser()
-  parser.add_option("-i", "--in_sof", dest="in_sof")
-#  parser.add_option("-j", "--in_dir", dest="in_dir")
-  parser.add_output("-o", "--out_sof", dest="out_sof")
-  parser.add_output("-p", "--messages", dest="messages")
-  inputs  = parser.get_inputs()
-  outputs = parser.get_outputs()
-  in_sof = inputs.in_sof#reflex.parseSofJson(json.loads(inputs.in_sof))
-  files=in_sof.files
-  images=[]
-  tables=[]
-  if import_ok == 0:
-     # print 'bu'
-     # time.sleep(6)
-      #raw_input("Press enter to continue")
-#      time.sleep(6)
-      outputs.out_sof = inputs.in_sof
-      outputs.messages = ('Warning: Failing in importing some required Python modules.\n Check software requirements at:\n '
-            ' https://www.eso.org/sci/software/pipelines/reflex_workflows/#software_prerequisites\n'
-            ' or in the MUSE Reflex tutorial.\n\n '
-            'Coordinates in the header will be used for alignment.\n' + str(import_error))
-      parser.write_outputs()
-      sys.exit()
- 
-  for file in files:
- 
-      if file.category == 'IMAGE_FOV':
-          images.append(str(file.name))
-      if file.category == 'PIXTABLE_REDUCED':    
-          tables.append(str(file.name))
-
-# GETTING THE CATALOGUES, SORTING THE IMAGES IN TIME, COMPUTING 2D DISTANCE MATRIX
-  sources = []
-  RA=np.zeros(len(images),float)
-  DEC=np.zeros(len(images),float)
-  MJD=np.zeros(len(images),float)
-  MJD_tbl=np.zeros(len(images),float)
-  FLAGS=np.zeros(len(images),float)
-  FLAGS[0] = 1.
-  OFFSETS_RA=np.zeros(len(images),float)
-  OFFSETS_DEC=np.zeros(len(images),float)
-  distances=np.zeros([len(images),len(images)],float)
-
-  for i in range(len(images)):
-     # print images[i], tables[i]
-      hdu  = pyfits.open(images[i])
-      image = hdu[1].data 
-  
-      # REPLACE NaN values with 0
-      where_are_NaNs = np.isnan(image)
-      image[where_are_NaNs] = 0.
-  
-      header = hdu[0] 
-      RA[i] = header.header['RA']
-      DEC[i] = header.header['DEC']
-      MJD[i] = header.header['MJD-OBS']
-      wcs = pywcs.WCS(hdu[0].header)
-
-      hdu_tbl  = pyfits.open(tables[i])
-      header_tbl = hdu_tbl[0] 
-      MJD_tbl[i] = header_tbl.header['MJD-OBS']
-
-    
-      thr = 15.
-      junk =  daofind(image, fwhm=5.0, threshold=thr) 
-      len_junk = len(junk)
-      while len_junk > 80:
-          thr=thr+5.
-          junk =  daofind(image, fwhm=5.0, threshold=thr) 
-          len_junk = len(junk)
-        
-      if len(junk) <= 5: 
-         junk =  daofind(image, fwhm=5.0, threshold=10.) 
-      if len(junk) <= 5: 
-         junk =  daofind(image, fwhm=5.0, threshold=5.) 
-
-      try:
-          x=np.array(junk['xcentroid'])
-          y=np.array(junk['ycentroid'])
-          id_=np.array(junk['id'])
- #         sky = wcs.wcs_pix2sky(x,y,1)
-          sky = wcs.wcs_pix2world(x,y,1)
-          sources.append([id_,sky[0],sky[1]])
-      except KeyError:
-          sources.append([np.array([-1]),np.array([-999]),np.array([-999])])
-
-  sorted=np.argsort(MJD)
-  sorted_tbl=np.argsort(MJD_tbl)
-  RA_sorted=RA[sorted]
-  DEC_sorted=DEC[sorted]
-  MJD_sorted=MJD[sorted]
-  MJD_tbl_sorted=MJD_tbl[sorted_tbl]
-  images_array = np.array(images)
-  tables_array=np.array(tables)
-  images_array_sorted=images_array[sorted]
-  tables_array_sorted=tables_array[sorted_tbl]
-  images_sorted = np.ndarray.tolist(images_array_sorted)
-  tables_sorted = np.ndarray.tolist(tables_array_sorted)
- 
-
-  for i in range(len(images)):
-      for j in range(len(images)):
-          distances[i,j] = ((RA_sorted[i] - RA_sorted[j])**2. + (DEC_sorted[i] - DEC_sorted[j])**2.)**0.5
-
-
-  # SELECTION OF WHICH CATALOGUE (of an image whose offsets are unknown) NEEDS TO BE COMPARED TO WHICH CATALOGUE (of an image whose offsets are known)
-  # THE REFERENCE IMAGE (OLDEST) HAS KNOWN OFFSETS (0,0)
-
-
-  offsets_to_the_reference_RA = np.zeros(len(images))
-  offsets_to_the_reference_DEC = np.zeros(len(images))
-
-  for i in range(1,len(images),1):
-    #  print FLAGS
-      processed, = np.where(FLAGS == 1.)
-      not_processed, = np.where(FLAGS == 0.)
-
-      replace = distances*0-1.
-
-
-      for k1 in processed:
-          for k2 in not_processed:
-              replace[k1,k2] = distances[k1,k2]
-            
-
- 
-      MIN_dist = distances[processed][:,[not_processed]].min()
-      (ic,jc) = np.where((replace == MIN_dist) & (replace >= 0) )
-
-
-      sel_i = ic[0]   # sel_i is the index of an image with known offsets, that I will use as reference to compute the offsets for the image(sel_j)
-      sel_j = jc[0]   # sel_j is the index of a non processed image, which has a minimum distance from the images that have known offsets
-                    # the comparison will be done between the catalogues sel_i (reference) and sel_j.
-
-      #  Cross matching catalogues (i: unknown offsets; j known offsets / reference image)
-      offset_x,offset_y,n_match,rms_ra,rms_dec = compute_offsets(sources[sel_i][0],sources[sel_i][1],sources[sel_i][2],sources[sel_j][0],sources[sel_j][1],sources[sel_j][2])
-
-     # print
-
-      FLAGS[sel_j] = 1.  # now I know the offsets of the image sel_j-th image, and I can consider it as processed
-      #print sel_i, sel_j, images[sel_j],offset_x,offset_y
-      offsets_to_the_reference_RA[sel_j]  = offsets_to_the_reference_RA[sel_i]  + offset_x
-      offsets_to_the_reference_DEC[sel_j] = offsets_to_the_reference_DEC[sel_i] + offset_y
-
-     # print 'reference: ' , images_sorted[0]
-     # print 'image to align:', images_sorted[sel_j],'; using ', images_sorted[sel_i]
-     # print 'RA_off, DEC_off',offsets_to_the_reference_RA[sel_j], offsets_to_the_reference_DEC[sel_j]
-
-
-      hdu = pyfits.open(tables_sorted[sel_j],mode='update')
-      hdu[0].header['RA'] = hdu[0].header['RA'] + offsets_to_the_reference_RA[sel_j]
-      hdu[0].header['DEC'] = hdu[0].header['DEC'] + offsets_to_the_reference_DEC[sel_j]
-      hdu[0].header['HIERARCH REFLEX ALIGNED'] = 1
-      hdu[0].header['HIERARCH REFLEX APPOFFRA'] = (offsets_to_the_reference_RA[sel_j],'Median offset in RA (deg)')
-      hdu[0].header['HIERARCH REFLEX APPOFFDEC'] = (offsets_to_the_reference_DEC[sel_j],'Median offset in DEC (deg)')
-      hdu[0].header['HIERARCH REFLEX RMSOFFRA'] = (rms_ra,'STDDEV of RA offset [deg]')
-      hdu[0].header['HIERARCH REFLEX RMSOFFDEC'] = (rms_dec,'STDDEV of DEC offset [deg]')
-      hdu[0].header['HIERARCH REFLEX NUMSTARS'] = (n_match,'N. of sources used for alignment')
-      hdu.flush() 
-  #  tables_sorted[sel_j] ToDo
-      hdu = pyfits.open(images_sorted[sel_j],mode='update')
-      hdu[0].header['CRVAL1'] = hdu[0].header['CRVAL1'] + offsets_to_the_reference_RA[sel_j]
-      hdu[0].header['CRVAL2'] = hdu[0].header['CRVAL2'] + offsets_to_the_reference_DEC[sel_j]
-      hdu[0].header['HIERARCH REFLEX ALIGNED'] = 1
-      hdu[0].header['HIERARCH REFLEX APPOFFRA'] = (offsets_to_the_reference_RA[sel_j],'Median offset in RA (deg)')
-      hdu[0].header['HIERARCH REFLEX APPOFFDEC'] = (offsets_to_the_reference_DEC[sel_j],'Median offset in DEC (deg)')
-      hdu[0].header['HIERARCH REFLEX RMSOFFRA'] = (rms_ra,'STDDEV of RA offset [deg]')
-      hdu[0].header['HIERARCH REFLEX RMSOFFDEC'] = (rms_dec,'STDDEV of DEC offset [deg]')
-      hdu[0].header['HIERARCH REFLEX NUMSTARS'] = (n_match,'N. of sources used for alignment')
-      hdu.flush()
-
-
-#      fig1 = plt.figure()
-#      plt.plot(sources[sel_i][1], sources[sel_i][2],'bs',sources[sel_j][1],sources[sel_j][2],'g^')
-#      plt.show()
-#      plt.plot(sources[sel_i][1], sources[sel_i][2],'bs',sources[sel_j][1]+offset_x,sources[sel_j][2]+offset_y,'g^')
-#      plt.show()
-   
-
-  #for i in range(1,len(images),1):
-  #  print tables_sorted[i], offsets_to_the_reference_RA[i], offsets_to_the_reference_DEC[i] #
-#  for i in range(len(images)):
-#      print images_sorted[i], tables_sorted[i],MJD_sorted[i],MJD_tbl_sorted[i]
-
-#  raw_input("Press enter to continue")
-  outputs.out_sof = inputs.in_sof
-  parser.write_outputs()
-  sys.exit()
- 
-
-
+#!/usr/bin/env python
+from reflexy.base import reflex
+
+import sys 
+import os
+import math
+import json
+from optparse import OptionParser
+import warnings
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+try:
+    from optparse import OptionParser
+    from astropy.io import fits
+    import numpy as np
+    from numpy import array
+    from photutils import datasets
+    from photutils import daofind
+    from astropy.stats import median_absolute_deviation as mad
+    from astropy.io import fits as pyfits
+    from astropy import wcs as pywcs
+#import scikit-image
+    import astropy
+    import scipy
+    from scipy.spatial import cKDTree
+    from scipy import sparse
+    from scipy.sparse import csgraph
+    from scipy.sparse import linalg as sparse_linalg
+    from reflexy.muse.detection import find_sources, sky_statistics
+    from reflexy.muse.asterism import match_asterisms
+    from reflexy.muse.cache import AlignmentCache
+    from reflexy.muse.metrics import StageClock, peak_memory, write_metrics
+    from reflexy.base import fits_header
+#    import pywcs # WCS conversion routines NOT NEEDED ANYMORE
+#    import pyfits # NOT NEEDED ANYMORE
+    import copy
+    import matplotlib.pyplot as plt
+    import_ok = 1
+#except ImportError:
+except ImportError as e:
+    import_ok = 0
+    import_error = e
+
+def find_closest(id_,x,y,idlist,xlist,ylist,dist_max):
+    """
+
+    :param id_:
+     id
+    :param x: ~float
+
+    :param y: ~float
+    :param idlist:
+    :param xlist: ~numpy.ndarray
+    :param ylist: ~numpy.ndarray
+    :param dist_max: ~float
+
+    :return:
+    """
+
+    distances = ((x-xlist)**2. + (y-ylist)**2.)**0.5
+    indici, = np.where(distances == distances.min())
+    D = distances.min()
+    Dx=x-xlist[indici[0]]  #offset in X (RA) of the matched source
+    Dy=y-ylist[indici[0]]  #offset in Y (DEC) of the matched source
+    if D <= dist_max:
+        id_sel = idlist[indici[0]]+0.
+        x_sel = xlist[indici[0]]+0.
+        y_sel = ylist[indici[0]]+0.
+    else:
+        id_sel = []    
+        x_sel=[]#0./0.
+        y_sel=[]#0./0.
+        D=[]#0./0.
+        Dx=[]#0./0.
+        Dy=[]#0./0.
+
+    return(Dx,Dy,D,x_sel,y_sel,id_sel)
+
+
+def find_mutual_pairs(x_,y_,x_ref,y_ref,dist_max):
+    """
+    Find all the mutual nearest-neighbour pairs between two catalogues.
+
+    A source and a reference source are paired when each one is the
+    nearest neighbour of the other and their distance is <= dist_max.
+    Both nearest-neighbour queries are done with a KD-tree.
+
+    :param x_: ~numpy.ndarray
+    :param y_: ~numpy.ndarray
+    :param x_ref: ~numpy.ndarray
+    :param y_ref: ~numpy.ndarray
+    :param dist_max: ~float
+
+    :return: indices in the catalogue and in the reference catalogue
+     of the matched sources
+    """
+
+    x_ = np.asarray(x_,float)
+    y_ = np.asarray(y_,float)
+    x_ref = np.asarray(x_ref,float)
+    y_ref = np.asarray(y_ref,float)
+    if len(x_) == 0 or len(x_ref) == 0:
+        return(np.zeros(0,int),np.zeros(0,int))
+
+    points = np.column_stack([x_,y_])
+    points_ref = np.column_stack([x_ref,y_ref])
+
+    # cKDTree excludes neighbours exactly at distance_upper_bound,
+    # while the matching radius is inclusive
+    D,ind_ref = cKDTree(points_ref).query(points,
+                    distance_upper_bound=np.nextafter(dist_max,np.inf))
+    ind, = np.where(np.isfinite(D))
+    ind_ref = ind_ref[ind]
+
+    # a pair is kept only if the reference source points back to it
+    D_back,ind_back = cKDTree(points).query(points_ref[ind_ref])
+    mutual = ind_back == ind
+    return(ind[mutual],ind_ref[mutual])
+
+
+def find_matches(id_,x_,y_,id_ref,x_ref,y_ref,dist_max):
+    """
+
+    :param id_: ~numpy.ndarray
+    :param x_: ~numpy.ndarray
+
+    :param y_: ~numpy.ndarray
+
+    :param id_ref: ~numpy.ndarray
+
+    :param x_ref: ~numpy.ndarray
+
+    :param y_ref: ~numpy.ndarray
+    :param dist_max: ~float
+    :return:
+    """
+
+    ind,ind_ref = find_mutual_pairs(x_,y_,x_ref,y_ref,dist_max)
+
+    if len(ind) == 0:
+       offset_x=[0]
+       offset_y=[0]
+       rms_x=[0]
+       rms_y=[0]
+       n_matches=0
+    else:
+       offset_x_ = np.asarray(x_,float)[ind] - np.asarray(x_ref,float)[ind_ref]
+       offset_y_ = np.asarray(y_,float)[ind] - np.asarray(y_ref,float)[ind_ref]
+       offset_x = np.median(offset_x_)   # median offsets in X, considering all the matched sources
+       offset_y = np.median(offset_y_)   # median offsets in Y, considering all the matched sources
+       rms_x=np.std(offset_x_)
+       rms_y=np.std(offset_y_)
+       n_matches=len(offset_x_)
+    return(offset_x,offset_y,n_matches,rms_x,rms_y)
+
+
+def _first_of_groups(key):
+    """
+    Flag the first element of each group of equal keys in an array
+    already sorted by key.
+    """
+    first = np.ones(len(key),bool)
+    first[1:] = key[1:] != key[:-1]
+    return first
+
+
+def evaluate_bias_grid(x,y,x_ref,y_ref,ra_bias_offset,dec_bias_offset,max_dist,stats=None,max_pairs=250000):
+    """
+    Run find_matches for every cell of a grid of bias offsets in a
+    few batched passes.
+
+    The candidate pairs of a block of cells are collected with a KD-tree
+    query that covers the block. A pair is assigned to every cell whose
+    bias brings the two sources within max_dist, then the mutual nearest
+    neighbours and their statistics are computed for all the cells of
+    the block together with sorting and grouping, instead of shifting
+    the catalogue and matching it again cell by cell. The grid is split
+    into blocks of about max_pairs candidate pairs, so that the memory
+    used is bounded whatever the density of the catalogues.
+
+    :param x: ~numpy.ndarray
+    :param y: ~numpy.ndarray
+    :param x_ref: ~numpy.ndarray
+    :param y_ref: ~numpy.ndarray
+    :param ra_bias_offset: ~numpy.ndarray
+     increasing bias offsets added to x
+    :param dec_bias_offset: ~numpy.ndarray
+     increasing bias offsets added to y
+    :param max_dist: ~float
+    :param stats: ~dict
+     if given, the number of cells evaluated is added to stats['cells'],
+     and the number of candidate pairs of sources, whose separation
+     falls in the box covered by the grid, to stats['pairs']
+    :param max_pairs: ~int
+     number of candidate pairs processed at once
+
+    :return: number of matches, offsets and rms matrices, with the same
+     content that the loop over find_matches used to fill
+    """
+
+    x = np.asarray(x,float)
+    y = np.asarray(y,float)
+    x_ref = np.asarray(x_ref,float)
+    y_ref = np.asarray(y_ref,float)
+    ra_bias_offset = np.asarray(ra_bias_offset,float)
+    dec_bias_offset = np.asarray(dec_bias_offset,float)
+    n_ra = len(ra_bias_offset)
+    n_dec = len(dec_bias_offset)
+    if stats is not None:
+        stats['cells'] = stats.get('cells',0)+n_ra*n_dec
+
+    ncommon_matrix  = np.zeros([n_ra,n_dec],float)
+    offset_x_matrix = np.zeros([n_ra,n_dec],float) + ra_bias_offset[:,None]
+    offset_y_matrix = np.zeros([n_ra,n_dec],float) + dec_bias_offset[None,:]
+    rms_ra_matrix   = np.zeros([n_ra,n_dec],float)
+    rms_dec_matrix  = np.zeros([n_ra,n_dec],float)
+    matrices = (ncommon_matrix,offset_x_matrix,offset_y_matrix,rms_ra_matrix,rms_dec_matrix)
+    if len(x) == 0 or len(x_ref) == 0:
+        return matrices
+
+    # the blocks are squares of cells, sized from the number of pairs
+    # whose separation falls in the box covered by the whole grid
+    tree_ref = cKDTree(np.column_stack([x_ref,y_ref]))
+    center_x,center_y,half_size = _bias_box(ra_bias_offset,dec_bias_offset,max_dist)
+    n_pairs = cKDTree(np.column_stack([x+center_x,y+center_y])).count_neighbors(
+        tree_ref,half_size,p=np.inf)
+    if stats is not None:
+        stats['pairs'] = stats.get('pairs',0)+int(n_pairs)
+    n_blocks = int(np.ceil((n_pairs/float(max_pairs))**0.5))
+    ra_blocks = np.linspace(0,n_ra,min(max(n_blocks,1),n_ra)+1).astype(int)
+    dec_blocks = np.linspace(0,n_dec,min(max(n_blocks,1),n_dec)+1).astype(int)
+    for ra_start,ra_stop in zip(ra_blocks[:-1],ra_blocks[1:]):
+        for dec_start,dec_stop in zip(dec_blocks[:-1],dec_blocks[1:]):
+            block = _evaluate_bias_block(x,y,x_ref,y_ref,tree_ref,
+                                         ra_bias_offset[ra_start:ra_stop],
+                                         dec_bias_offset[dec_start:dec_stop],max_dist)
+            for matrix,block_matrix in zip(matrices,block):
+                matrix[ra_start:ra_stop,dec_start:dec_stop] = block_matrix
+    return matrices
+
+
+def _bias_box(ra_bias_offset,dec_bias_offset,max_dist):
+    """
+    Centre and half size of the square box of separations covered by a
+    grid of bias offsets, slightly enlarged so that rounding cannot lose
+    a pair at the border.
+    """
+    tolerance = max_dist*(1.+1e-9)+1e-12
+    center_x = (ra_bias_offset[0]+ra_bias_offset[-1])/2.
+    center_y = (dec_bias_offset[0]+dec_bias_offset[-1])/2.
+    half_size = max(ra_bias_offset[-1]-center_x,dec_bias_offset[-1]-center_y)+tolerance
+    return center_x,center_y,half_size
+
+
+def _evaluate_bias_block(x,y,x_ref,y_ref,tree_ref,ra_bias_offset,dec_bias_offset,max_dist):
+    """
+    Matrices of evaluate_bias_grid for a block of the grid of bias
+    offsets, with the KD-tree of the reference catalogue.
+    """
+    n_ra = len(ra_bias_offset)
+    n_dec = len(dec_bias_offset)
+    ncommon_matrix  = np.zeros([n_ra,n_dec],float)
+    offset_x_matrix = np.zeros([n_ra,n_dec],float) + ra_bias_offset[:,None]
+    offset_y_matrix = np.zeros([n_ra,n_dec],float) + dec_bias_offset[None,:]
+    rms_ra_matrix   = np.zeros([n_ra,n_dec],float)
+    rms_dec_matrix  = np.zeros([n_ra,n_dec],float)
+
+    # all the pairs whose separation falls in the box covered by the block
+    tolerance = max_dist*(1.+1e-9)+1e-12
+    center_x,center_y,half_size = _bias_box(ra_bias_offset,dec_bias_offset,max_dist)
+    neighbours = tree_ref.query_ball_point(
+        np.column_stack([x+center_x,y+center_y]),half_size,p=np.inf)
+    n_neighbours = np.array([len(n) for n in neighbours],int)
+    pair_i = np.repeat(np.arange(len(x)),n_neighbours)
+    pair_r = np.array([r for n in neighbours for r in n],int)
+    if len(pair_i) == 0:
+        return(ncommon_matrix,offset_x_matrix,offset_y_matrix,rms_ra_matrix,rms_dec_matrix)
+
+    # expand every pair over the range of cells it can fall in,
+    # first along RA and then along DEC
+    u = x_ref[pair_r]-x[pair_i]
+    v = y_ref[pair_r]-y[pair_i]
+    ra_lo = np.searchsorted(ra_bias_offset,u-tolerance,'left')
+    ra_n = np.searchsorted(ra_bias_offset,u+tolerance,'right')-ra_lo
+    dec_lo = np.searchsorted(dec_bias_offset,v-tolerance,'left')
+    dec_n = np.searchsorted(dec_bias_offset,v+tolerance,'right')-dec_lo
+
+    entry = np.repeat(np.arange(len(pair_i)),ra_n)
+    I_RA = ra_lo[entry]+np.arange(len(entry))-np.repeat(np.cumsum(ra_n)-ra_n,ra_n)
+    n_cells = dec_n[entry]
+    entry_dec = np.repeat(np.arange(len(entry)),n_cells)
+    I_DEC = dec_lo[entry[entry_dec]]+np.arange(len(entry_dec))-np.repeat(np.cumsum(n_cells)-n_cells,n_cells)
+    I_RA = I_RA[entry_dec]
+    entry = entry[entry_dec]
+    i = pair_i[entry]
+    r = pair_r[entry]
+
+    # same arithmetic as shifting the catalogue and calling find_closest
+    Dx = (x[i]+ra_bias_offset[I_RA])-x_ref[r]
+    Dy = (y[i]+dec_bias_offset[I_DEC])-y_ref[r]
+    D = (Dx**2.+Dy**2.)**0.5
+    keep = D <= max_dist
+    cell = (I_RA*n_dec+I_DEC)[keep]
+    i = i[keep]
+    r = r[keep]
+    Dx = Dx[keep]
+    Dy = Dy[keep]
+    D = D[keep]
+
+    # nearest reference of each source and nearest source of each
+    # reference, cell by cell: a mutual pair is the closest in both
+    by_distance = np.argsort(D,kind='mergesort')
+    mutual = np.ones(len(D),bool)
+    for key in (cell.astype(np.int64)*len(x)+i,cell.astype(np.int64)*len(x_ref)+r):
+        order = by_distance[np.argsort(key[by_distance],kind='mergesort')]
+        closest = np.zeros(len(D),bool)
+        closest[order[_first_of_groups(key[order])]] = True
+        mutual &= closest
+    cell = cell[mutual]
+    i = i[mutual]
+    Dx = Dx[mutual]
+    Dy = Dy[mutual]
+    if len(cell) == 0:
+        return(ncommon_matrix,offset_x_matrix,offset_y_matrix,rms_ra_matrix,rms_dec_matrix)
+
+    n_matches = np.bincount(cell,minlength=n_ra*n_dec)
+    matched, = np.where(n_matches > 0)
+    n = n_matches[matched]
+    start = np.cumsum(n)-n
+    ncommon_matrix.flat[matched] = n
+
+    for values,offset_matrix,rms_matrix in ((Dx,offset_x_matrix,rms_ra_matrix),
+                                            (Dy,offset_y_matrix,rms_dec_matrix)):
+        # median, as the mean of the two central values of each sorted cell
+        sorted_values = values[np.lexsort((values,cell))]
+        median = (sorted_values[start+(n-1)//2]+sorted_values[start+n//2])/2.
+        offset_matrix.flat[matched] -= median
+        # standard deviation, with the sources in catalogue order
+        grouped = values[np.lexsort((i,cell))]
+        mean = np.add.reduceat(grouped,start)/n
+        deviation = (grouped-np.repeat(mean,n))**2.
+        rms_matrix.flat[matched] = (np.add.reduceat(deviation,start)/n)**0.5
+
+    return(ncommon_matrix,offset_x_matrix,offset_y_matrix,rms_ra_matrix,rms_dec_matrix)
+
+
+def select_offset(ncommon_matrix,offset_x_matrix,offset_y_matrix,rms_ra_matrix,rms_dec_matrix):
+    """
+    Select the offset from the matrices filled by evaluate_bias_grid:
+    the cell with the largest number of matches wins, and ties are
+    broken in favour of the smallest offset.
+
+    :return: offset_x, offset_y, n_match, rms_ra, rms_dec
+    """
+
+    offset_x=0.
+    offset_y=0.
+    n_match=0.
+    rms_ra=-1.
+    rms_dec=-1.
+
+    (indxx,indyy) = np.where(ncommon_matrix == ncommon_matrix.max())
+
+    if len(indxx) == 0:
+        offset_x=0.
+        offset_y=0.
+        n_match=0.
+        rms_ra=-1.
+        rms_dec=-1.
+        id_common=0
+        
+
+    
+    if len(indxx) == 1:
+        n_match = ncommon_matrix[indxx[0],indyy[0]]+0.
+        rms_ra = rms_ra_matrix[indxx[0],indyy[0]]+0.
+        rms_dec = rms_dec_matrix[indxx[0],indyy[0]]+0.
+        offset_x = -offset_x_matrix[indxx[0],indyy[0]]+0.
+        offset_y = -offset_y_matrix[indxx[0],indyy[0]]+0.
+
+    if len(indxx) > 1:
+
+        tmp_offset_x_matrix = offset_x_matrix[indxx,indyy]+0.
+        tmp_offset_y_matrix = offset_y_matrix[indxx,indyy]+0.
+        dist_ = (tmp_offset_x_matrix**2.+tmp_offset_y_matrix**2.)**0.5
+        
+        (new_indxx,new_indyy) = np.where((offset_x_matrix**2+offset_y_matrix**2)**0.5 == dist_.min() )
+
+        n_match = ncommon_matrix[new_indxx[0],new_indyy[0]]+0.
+        rms_ra = rms_ra_matrix[new_indxx[0],new_indyy[0]]+0.
+        rms_dec = rms_dec_matrix[new_indxx[0],new_indyy[0]]+0.
+        offset_x = -offset_x_matrix[new_indxx[0],new_indyy[0]]+0.
+        offset_y = -offset_y_matrix[new_indxx[0],new_indyy[0]]+0.
+
+    return(offset_x,offset_y,n_match,rms_ra,rms_dec)
+
+
+def compute_offsets_grid(id_,x,y,id_ref,x_ref,y_ref,search_radius=21.,step=1.4,max_dist_arcs=None,stats=None):
+    """
+    Brute-force solver: match the catalogues for every cell of a fixed
+    grid of bias offsets and keep the cell with most matches.
+
+    :param search_radius: ~float
+     half size of the grid (arcsec)
+    :param step: ~float
+     grid step (arcsec)
+    :param max_dist_arcs: ~float
+     matching radius (arcsec), step/2.*1.6 by default
+    :param stats: ~dict
+     see evaluate_bias_grid
+
+    :return: offset_x, offset_y, n_match, rms_ra, rms_dec
+    """
+    nBIAS = 2*int(round(search_radius/step))+1
+    if max_dist_arcs is None:
+        max_dist_arcs = step/2.*1.6
+    max_dist=max_dist_arcs/3600.
+
+    # ...
+    ra_bias_offset=  (np.arange(nBIAS)*step -(nBIAS-1)*step/2.)/3600.0
+    dec_bias_offset= (np.arange(nBIAS)*step -(nBIAS-1)*step/2.)/3600.0
+
+    matrices = evaluate_bias_grid(x,y,x_ref,y_ref,ra_bias_offset,dec_bias_offset,max_dist,stats)
+    return select_offset(*matrices)
+
+
+def compute_offsets_hierarchical(id_,x,y,id_ref,x_ref,y_ref,search_radius=21.,step=1.4,max_dist_arcs=None,n_levels=None,zoom=3,n_coarse=40,stats=None):
+    """
+    Coarse-to-fine solver: a coarse grid with a large matching radius
+    finds the basin of the offset, then successively finer grids
+    centred on the best cell of the previous level refine it.
+
+    The step of each level is zoom times the step of the next one, and
+    the last level uses step. Every level after the first spans one
+    step of the previous level around its best cell, so the number of
+    evaluated cells grows with the logarithm of the search radius. The
+    coarse levels match the brightest sources only: with their large
+    matching radius, the candidate pairs of the whole catalogues would
+    be too many, and mostly chance ones.
+
+    :param search_radius: ~float
+     half size of the coarse grid (arcsec)
+    :param step: ~float
+     step of the finest grid (arcsec)
+    :param max_dist_arcs: ~float
+     matching radius of the finest grid (arcsec), step/2.*1.6 by
+     default; coarser levels scale it with their step
+    :param n_levels: ~int
+     number of levels, by default the smallest number for which the
+     coarse grid has at most 2*zoom+1 cells per side
+    :param zoom: ~int
+     ratio between the steps of two consecutive levels
+    :param n_coarse: ~int
+     number of sources of each catalogue matched by the levels before
+     the last one, the first ones (the brightest ones for
+     detect_sources)
+    :param stats: ~dict
+     see evaluate_bias_grid, the cells and pairs of all the levels are
+     counted
+
+    :return: offset_x, offset_y, n_match, rms_ra, rms_dec
+    """
+    if max_dist_arcs is None:
+        max_dist_arcs = step/2.*1.6
+    if n_levels is None:
+        n_levels = max(1,int(np.ceil(np.log(search_radius/step)/np.log(zoom))))
+
+    center_x = 0.
+    center_y = 0.
+    for level in range(n_levels):
+        level_scale = zoom**(n_levels-1-level)
+        level_step = step*level_scale/3600.
+        max_dist = max_dist_arcs*level_scale/3600.
+        if level == 0:
+            n_half = int(np.ceil(search_radius/3600./level_step))
+        else:
+            n_half = zoom
+        n = None if level == n_levels-1 else n_coarse
+        grid = np.arange(-n_half,n_half+1)*level_step
+        matrices = evaluate_bias_grid(x[:n],y[:n],x_ref[:n],y_ref[:n],center_x+grid,center_y+grid,max_dist,stats)
+        offset_x,offset_y,n_match,rms_ra,rms_dec = select_offset(*matrices)
+        if n_match == 0:
+            break
+        center_x = -offset_x
+        center_y = -offset_y
+
+    return(offset_x,offset_y,n_match,rms_ra,rms_dec)
+
+
+def compute_offsets_histogram(id_,x,y,id_ref,x_ref,y_ref,search_radius=21.,step=1.4,max_dist_arcs=None,n_iter=2,n_vote=100,stats=None):
+    """
+    Voting solver: build the histogram of all the pairwise (RA, DEC)
+    differences between the brightest sources of the two catalogues
+    within the search box, take its peak as first guess of the offset,
+    and refine it with the mutual-match step of find_matches on the
+    whole catalogues.
+
+    The cost is a single pass over the pairs, whatever the size of the
+    search box. The vote is limited to the brightest sources because
+    the chance pairs grow with the square of the number of sources:
+    for dense catalogues, they would bury the peak under the slope of
+    the overlap of the two fields, and fill the memory.
+
+    :param search_radius: ~float
+     half size of the search box (arcsec)
+    :param step: ~float
+     bin size of the histogram (arcsec)
+    :param max_dist_arcs: ~float
+     matching radius of the refinement (arcsec), step/2.*1.6 by default
+    :param n_iter: ~int
+     number of refinement iterations
+    :param n_vote: ~int
+     number of sources of each catalogue used for the histogram, the
+     first ones (the brightest ones for detect_sources)
+    :param stats: ~dict
+     if given, the number of bins of the histogram is added to
+     stats['cells']
+
+    :return: offset_x, offset_y, n_match, rms_ra, rms_dec
+    """
+    x = np.asarray(x,float)
+    y = np.asarray(y,float)
+    x_ref = np.asarray(x_ref,float)
+    y_ref = np.asarray(y_ref,float)
+    if max_dist_arcs is None:
+        max_dist_arcs = step/2.*1.6
+    max_dist = max_dist_arcs/3600.
+    radius = search_radius/3600.
+    bin_size = step/3600.
+
+    if len(x) == 0 or len(x_ref) == 0:
+        return(0.,0.,0.,-1.,-1.)
+    neighbours = cKDTree(np.column_stack([x_ref[:n_vote],y_ref[:n_vote]])).query_ball_point(
+        np.column_stack([x[:n_vote],y[:n_vote]]),radius,p=np.inf)
+    n_neighbours = np.array([len(n) for n in neighbours],int)
+    pair_i = np.repeat(np.arange(len(n_neighbours)),n_neighbours)
+    pair_r = np.array([r for n in neighbours for r in n],int)
+    if len(pair_i) == 0:
+        return(0.,0.,0.,-1.,-1.)
+    u = x_ref[pair_r]-x[pair_i]
+    v = y_ref[pair_r]-y[pair_i]
+
+    # the histogram is smoothed with a 3x3 box, so that a cluster of
+    # differences split across bin edges still gives a single peak
+    n_bins = 2*int(np.ceil(radius/bin_size))+1
+    if stats is not None:
+        stats['cells'] = stats.get('cells',0)+n_bins**2
+    edges = (np.arange(n_bins+1)-n_bins/2.)*bin_size
+    histogram = np.histogram2d(u,v,bins=[edges,edges])[0]
+    padded = np.zeros([n_bins+2,n_bins+2],float)
+    padded[1:-1,1:-1] = histogram
+    votes = sum(padded[i:i+n_bins,j:j+n_bins] for i in range(3) for j in range(3))
+    I_RA,I_DEC = np.unravel_index(np.argmax(votes),votes.shape)
+    peak = ((np.abs(u-(edges[I_RA]+edges[I_RA+1])/2.) <= 1.5*bin_size) &
+            (np.abs(v-(edges[I_DEC]+edges[I_DEC+1])/2.) <= 1.5*bin_size))
+    bias_x = np.median(u[peak])
+    bias_y = np.median(v[peak])
+
+    for iteration in range(n_iter):
+        small_off_x,small_off_y,n_match,rms_ra,rms_dec = find_matches(
+            id_,x+bias_x,y+bias_y,id_ref,x_ref,y_ref,max_dist)
+        if n_match == 0:
+            return(0.,0.,0.,-1.,-1.)
+        bias_x = bias_x-small_off_x
+        bias_y = bias_y-small_off_y
+
+    return(-bias_x,-bias_y,n_match+0.,rms_ra,rms_dec)
+
+
+def compute_offsets_asterism(id_,x,y,id_ref,x_ref,y_ref,search_radius=None,step=1.4,max_dist_arcs=None,n_max=80,n_neighbours=5,tolerance=0.01,stats=None):
+    """
+    Asterism solver: match triangles of the brightest sources with
+    match_asterisms, which finds offsets of any size and tolerates a
+    small rotation between the catalogues.
+
+    The catalogues are projected on a plane tangent at the reference
+    catalogue for the triangle matching, and the offset is the median
+    of the differences of the matched sources, as in find_matches; with
+    a rotation, it is the offset at the centre of the matched sources.
+
+    :param search_radius: ~float
+     not used, the search is not limited
+    :param step: ~float
+     grid step of the other solvers (arcsec), sets the default matching
+     radius
+    :param max_dist_arcs: ~float
+     matching radius (arcsec), step/2.*1.6 by default
+    :param n_max: ~int
+     number of sources of each catalogue used for the triangles, the
+     first ones (the brightest ones for detect_sources); the default
+     keeps the whole catalogue of detect_sources
+    :param n_neighbours: ~int
+     number of neighbours of each source used for its triangles
+    :param tolerance: ~float
+     tolerance on the side ratios of two matching triangles
+    :param stats: ~dict
+     not used, no grid cell is evaluated
+
+    :return: offset_x, offset_y, n_match, rms_ra, rms_dec
+    """
+    x = np.asarray(x,float)
+    y = np.asarray(y,float)
+    x_ref = np.asarray(x_ref,float)
+    y_ref = np.asarray(y_ref,float)
+    if max_dist_arcs is None:
+        max_dist_arcs = step/2.*1.6
+    if len(x) < 3 or len(x_ref) < 3:
+        return(0.,0.,0.,-1.,-1.)
+
+    ra0 = np.median(x_ref)
+    dec0 = np.median(y_ref)
+    cos_dec = np.cos(np.radians(dec0))
+    match = match_asterisms((x-ra0)*cos_dec,y-dec0,(x_ref-ra0)*cos_dec,y_ref-dec0,
+                            max_dist_arcs/3600.,n_max=n_max,n_neighbours=n_neighbours,
+                            tolerance=tolerance)
+    if match is None:
+        return(0.,0.,0.,-1.,-1.)
+    ind,ind_ref = match[2],match[3]
+    offset_x_ = x[ind]-x_ref[ind_ref]
+    offset_y_ = y[ind]-y_ref[ind_ref]
+    return(np.median(offset_x_),np.median(offset_y_),len(ind)+0.,
+           np.std(offset_x_),np.std(offset_y_))
+
+
+OFFSET_SOLVERS = {'grid': compute_offsets_grid,
+                  'hierarchical': compute_offsets_hierarchical,
+                  'histogram': compute_offsets_histogram,
+                  'asterism': compute_offsets_asterism}
+
+
+def chance_matches(x,y,x_ref,y_ref,max_dist):
+    """
+    Expected number of chance matches between two unrelated catalogues
+    at a given offset: the number of sources with a reference source
+    within max_dist, for reference sources spread uniformly over their
+    bounding box.
+
+    :param max_dist: ~float
+     matching radius (deg)
+
+    :return: mean and standard deviation of the number of chance
+     matches
+    """
+    if len(x) == 0 or len(x_ref) < 2:
+        return(0.,0.)
+    cos_dec = np.cos(np.radians(np.median(y_ref)))
+    area = np.ptp(x_ref)*cos_dec*np.ptp(y_ref)
+    if area <= 0:
+        return(0.,0.)
+    # probability for a source to have at least one reference source
+    # within max_dist
+    p = 1.-np.exp(-len(x_ref)*np.pi*max_dist**2/area)
+    return(len(x)*p,(len(x)*p*(1.-p))**0.5)
+
+
+def compute_offsets(id_,x,y,id_ref,x_ref,y_ref,method='grid',fallback='asterism',min_matches=5,significance=5.,stats=None,**kwargs):
+    """
+    Compute the offset between a catalogue and a reference catalogue.
+
+    :param method: ~str
+     'grid' for the brute-force bias grid, 'hierarchical' for the
+     coarse-to-fine grids, 'histogram' for the pair-offset histogram
+     voting, 'asterism' for the triangle matching; the additional
+     keyword arguments (search_radius, step, max_dist_arcs, ...) are
+     passed to the selected solver
+    :param fallback: ~str
+     solver run when the matches found by method are not significant,
+     for example because the offset is outside the search radius; its
+     result is kept if it has more matches. None to disable it
+    :param min_matches: ~int
+    :param significance: ~float
+     the matches are significant when there are at least min_matches
+     of them and they exceed the chance_matches of the catalogues by
+     significance times their standard deviation: a grid solver always
+     finds a few chance matches in its best cell
+    :param stats: ~dict
+     if given, filled with the number of grid cells (or histogram bins)
+     evaluated by the solvers run, 'cells', the candidate pairs of
+     sources of the grid solvers, 'pairs', and the solver whose result
+     is returned, 'method'
+
+    :return: offset_x, offset_y, n_match, rms_ra, rms_dec
+    """
+    try:
+        solver = OFFSET_SOLVERS[method]
+    except KeyError:
+        raise ValueError("Unknown offset method: " + str(method))
+    if stats is not None:
+        stats.update(cells=0,method=method)
+    result = solver(id_,x,y,id_ref,x_ref,y_ref,stats=stats,**kwargs)
+    if fallback is None or fallback == method:
+        return result
+    max_dist_arcs = kwargs.get('max_dist_arcs')
+    if max_dist_arcs is None:
+        max_dist_arcs = kwargs.get('step',1.4)/2.*1.6
+    n_chance,sigma_chance = chance_matches(np.asarray(x,float),np.asarray(y,float),np.asarray(x_ref,float),
+                              np.asarray(y_ref,float),max_dist_arcs/3600.)
+    if result[2] >= max(min_matches,n_chance+significance*sigma_chance):
+        return result
+
+    # only the matching parameters are shared by all the solvers
+    fallback_kwargs = dict((key,kwargs[key]) for key in ('step','max_dist_arcs') if key in kwargs)
+    alternative = OFFSET_SOLVERS[fallback](id_,x,y,id_ref,x_ref,y_ref,stats=stats,**fallback_kwargs)
+    if alternative[2] > result[2]:
+        if stats is not None:
+            stats['method'] = fallback
+        return alternative
+    return result
+
+
+def detect_sources(image,method='daofind',n_max=80,bin_factor=None,tile_size=None,threads=None,
+                   overwrite_input=False):
+    """
+    Detect the sources used for the alignment of an exposure.
+
+    :param image: ~numpy.ndarray
+     image without NaN values
+    :param method: ~str
+     'daofind' raises the daofind threshold until at most n_max sources
+     are found; 'builtin' uses find_sources, which convolves the image
+     once and keeps the n_max brightest sources directly
+    :param n_max: ~int
+    :param bin_factor: ~int
+     binning of the pre-pass locating the bright sources ('builtin' only)
+    :param tile_size: ~int
+     size of the tiles detected in parallel on threads ('builtin' only,
+     not with bin_factor)
+    :param threads: ~int
+     number of threads for the tiles, all the CPUs by default
+    :param overwrite_input: ~bool
+     let find_sources subtract the sky in place of image ('builtin'
+     only)
+
+    :return: table (or structured array) with the columns id,
+     xcentroid and ycentroid, sorted by decreasing flux
+    """
+    if method == 'builtin':
+        return find_sources(image,fwhm=5.0,n_max=n_max,bin_factor=bin_factor,
+                            tile_size=tile_size,threads=threads,overwrite_input=overwrite_input)
+    if method != 'daofind':
+        raise ValueError("Unknown detection method: " + str(method))
+
+    thr = 15.
+    junk =  daofind(image, fwhm=5.0, threshold=thr) 
+    len_junk = len(junk)
+    while len_junk > n_max:
+        thr=thr+5.
+        junk =  daofind(image, fwhm=5.0, threshold=thr) 
+        len_junk = len(junk)
+
+    if len(junk) <= 5: 
+       junk =  daofind(image, fwhm=5.0, threshold=10.) 
+    if len(junk) <= 5: 
+       junk =  daofind(image, fwhm=5.0, threshold=5.) 
+    # brightest first, as find_sources: the asterism solver keeps the
+    # first sources of the catalogues
+    if len(junk) > 0:
+       junk = junk[np.argsort(-np.asarray(junk['flux']),kind='mergesort')]
+    return junk
+
+
+def _failed_catalogue():
+    return [np.array([-1]),np.array([-999]),np.array([-999])]
+
+
+def load_image(image_name,chunk_size=4*1024**2):
+    """
+    Read the image of an IMAGE_FOV in single precision, with the NaN
+    values replaced by the sky level.
+
+    The data are memory mapped and converted chunk by chunk, so that
+    only the float32 copy is held in memory, without a full size NaN
+    mask, and the file is closed on return. The sky level is the median
+    of the finite pixels of a subsample of the image: NaN values
+    replaced by 0 would bias the sky and noise estimates of the
+    detection.
+
+    :param image_name: ~str
+    :param chunk_size: ~int
+     number of pixels converted at once
+
+    :return: image (~numpy.ndarray), primary header
+    """
+    with pyfits.open(image_name,memmap=True) as hdulist:
+        header = hdulist[0].header.copy()
+        data = hdulist[1].data
+        sky = np.float32(sky_statistics(data)[0])
+        image = np.empty(data.shape,np.float32)
+        flat_data = data.reshape(-1)
+        flat_image = image.reshape(-1)
+        for start in range(0,flat_data.size,chunk_size):
+            chunk = flat_image[start:start+chunk_size]
+            chunk[:] = flat_data[start:start+chunk_size]
+            # REPLACE NaN values with the sky
+            chunk[np.isnan(chunk)] = sky
+        del data,flat_data
+    return image,header
+
+
+def build_catalogue(args,stats=None):
+    """
+    Detect the sources of an IMAGE_FOV and convert them to world
+    coordinates.
+
+    :param args: (image name, detection method, bin_factor, tile_size,
+     threads), see detect_sources
+    :param stats: ~dict
+     if given, filled with the time spent reading the image,
+     'read_seconds', and detecting the sources, 'detect_seconds'
+
+    :return: [id, ra, dec] arrays; [-1], [-999], [-999] if no source
+     was found
+    """
+    image_name,method,bin_factor,tile_size,threads = args
+    start = time.time()
+    image,header = load_image(image_name)
+    wcs = pywcs.WCS(header)
+    read = time.time()
+
+    # the image is not used after the detection
+    junk = detect_sources(image,method=method,bin_factor=bin_factor,tile_size=tile_size,threads=threads,
+                          overwrite_input=True)
+    if stats is not None:
+        stats.update(read_seconds=read-start,detect_seconds=time.time()-read)
+    if len(junk) == 0:
+        return _failed_catalogue()
+    try:
+        x=np.array(junk['xcentroid'])
+        y=np.array(junk['ycentroid'])
+        id_=np.array(junk['id'])
+ #       sky = wcs.wcs_pix2sky(x,y,1)
+        sky = wcs.wcs_pix2world(x,y,1)
+        return [id_,np.asarray(sky[0]),np.asarray(sky[1])]
+    except KeyError:
+        return _failed_catalogue()
+
+
+def _build_indexed_catalogue(args):
+    i,args = args
+    stats = dict()
+    catalogue = build_catalogue(args,stats)
+    return i,catalogue,stats
+
+
+def n_sources(catalogue):
+    """
+    Number of sources of an [id, ra, dec] catalogue, 0 for a failed one.
+    """
+    if len(catalogue[0]) == 1 and catalogue[0][0] == -1:
+        return 0
+    return len(catalogue[0])
+
+
+def iter_catalogues(images,processes=1,method='daofind',bin_factor=None,tile_size=None,cache=None,indices=None,stats=None):
+    """
+    Build the catalogues of many exposures on a process pool, and yield
+    each of them as soon as it is available: first the ones found in the
+    cache, then the detected ones in completion order. Only the compact
+    [id, ra, dec] arrays are sent back from the workers.
+
+    :param images: list of IMAGE_FOV file names
+    :param processes: ~int
+     size of the process pool, see parallel_map; the tiles of each
+     exposure are then detected on its share of the CPUs
+    :param cache: ~reflexy.muse.cache.AlignmentCache
+     if given, the exposures already in the cache are not detected again
+    :param indices: indices of the images to process, all by default
+    :param stats: ~dict
+     if given, filled with index -> dict of the number of sources,
+     'n_sources', whether the catalogue was in the cache, 'cached', and
+     the times of build_catalogue
+
+    :return: generator of (index in images, [id, ra, dec] catalogue)
+    """
+    if indices is None:
+        indices = range(len(images))
+    params = dict(method=method,bin_factor=bin_factor)
+    keys = dict()
+    missing = []
+    for i in indices:
+        if cache is not None:
+            keys[i] = cache.catalogue_key(images[i],params)
+            catalogue = cache.get_catalogue(keys[i])
+            if catalogue is not None:
+                if stats is not None:
+                    stats[i] = dict(n_sources=n_sources(catalogue),cached=True)
+                yield i,catalogue
+                continue
+        missing.append(i)
+
+    # the CPUs are shared by the workers, rather than each one starting
+    # a thread per CPU for its tiles
+    threads = None
+    if len(missing) > 1 and processes != 1:
+        n_workers = min(processes or multiprocessing.cpu_count(),len(missing))
+        threads = max(1,multiprocessing.cpu_count()//n_workers)
+    for i,catalogue,build_stats in parallel_imap(_build_indexed_catalogue,
+                                                 [(i,(images[i],method,bin_factor,tile_size,threads)) for i in missing],
+                                                 processes):
+        if cache is not None:
+            cache.put_catalogue(keys[i],catalogue)
+        if stats is not None:
+            stats[i] = dict(build_stats,n_sources=n_sources(catalogue),cached=False)
+        yield i,catalogue
+
+
+def build_catalogues(images,processes=1,method='daofind',bin_factor=None,tile_size=None,cache=None):
+    """
+    Build the catalogues of many exposures, see iter_catalogues.
+
+    :return: list of [id, ra, dec] catalogues, in the order of images
+    """
+    sources = [None]*len(images)
+    for i,catalogue in iter_catalogues(images,processes,method,bin_factor,tile_size,cache):
+        sources[i] = catalogue
+    return sources
+
+
+def update_alignment_header(filename,ra_key,dec_key,offset_ra,offset_dec,rms_ra,rms_dec,n_match):
+    """
+    Apply the offsets to the pointing keywords of the primary header of
+    an exposure and record the alignment keywords.
+
+    Only the header is rewritten, in place when its padding leaves room
+    for the new cards, so the data of the (large) pixel tables are never
+    read nor copied.
+
+    :param filename: ~str
+     FITS file to update
+    :param ra_key: ~str
+     keyword of the RA of the pointing, e.g. RA or CRVAL1
+    :param dec_key: ~str
+     keyword of the DEC of the pointing, e.g. DEC or CRVAL2
+    :param offset_ra: ~float
+     offset to add in RA (deg)
+    :param offset_dec: ~float
+     offset to add in DEC (deg)
+    """
+    header = fits_header.read_keywords(filename,[ra_key,dec_key])
+    fits_header.update_header(filename,[
+        (ra_key,header[ra_key]+offset_ra,None),
+        (dec_key,header[dec_key]+offset_dec,None),
+        ('HIERARCH REFLEX ALIGNED',1,None),
+        ('HIERARCH REFLEX APPOFFRA',float(offset_ra),'Median offset in RA (deg)'),
+        ('HIERARCH REFLEX APPOFFDEC',float(offset_dec),'Median offset in DEC (deg)'),
+        ('HIERARCH REFLEX RMSOFFRA',float(rms_ra),'STDDEV of RA offset [deg]'),
+        ('HIERARCH REFLEX RMSOFFDEC',float(rms_dec),'STDDEV of DEC offset [deg]'),
+        ('HIERARCH REFLEX NUMSTARS',int(n_match),'N. of sources used for alignment')])
+
+
+def write_offset_list(filename,exposures,date_obs,mjd_obs,offsets_ra,offsets_dec,n_match,rms_ra,rms_dec):
+    """
+    Write the offsets of the exposures in a FITS binary table, in the
+    layout of the OFFSET_LIST of the MUSE pipeline, with the statistics
+    of the matches as additional columns.
+
+    :param filename: ~str
+     FITS file to write, replaced if it exists
+    :param exposures: ~list
+     identifier of each exposure (name of its pixel table)
+    :param date_obs: ~list
+     DATE-OBS of each exposure
+    :param mjd_obs: ~numpy.ndarray
+     MJD-OBS of each exposure
+    :param offsets_ra: ~numpy.ndarray
+     offset added to the RA of each exposure (deg)
+    :param offsets_dec: ~numpy.ndarray
+     offset added to the DEC of each exposure (deg)
+    """
+    n_chars = max([1]+[len(name) for name in exposures])
+    n_date = max([1]+[len(date) for date in date_obs])
+    columns = [fits.Column(name='EXPOSURE',format='%dA'%n_chars,array=np.array(exposures)),
+               fits.Column(name='DATE_OBS',format='%dA'%n_date,array=np.array(date_obs)),
+               fits.Column(name='MJD_OBS',format='D',array=np.asarray(mjd_obs,float)),
+               fits.Column(name='RA_OFFSET',format='D',unit='deg',array=np.asarray(offsets_ra,float)),
+               fits.Column(name='DEC_OFFSET',format='D',unit='deg',array=np.asarray(offsets_dec,float)),
+               fits.Column(name='N_MATCH',format='J',array=np.asarray(n_match,int)),
+               fits.Column(name='RMS_RA',format='D',unit='deg',array=np.asarray(rms_ra,float)),
+               fits.Column(name='RMS_DEC',format='D',unit='deg',array=np.asarray(rms_dec,float))]
+    primary = fits.PrimaryHDU()
+    primary.header['HIERARCH ESO PRO CATG'] = 'OFFSET_LIST'
+    table = fits.BinTableHDU.from_columns(columns)
+    table.header['EXTNAME'] = 'OFFSET_LIST'
+    if os.path.exists(filename):
+        os.remove(filename)
+    fits.HDUList([primary,table]).writeto(filename)
+
+
+METADATA_DTYPE = [('image',object),('table',object),('ra',float),('dec',float),
+                  ('mjd',float),('mjd_table',float),('date_obs',object),
+                  ('ra_corners',float,(4,)),('dec_corners',float,(4,)),
+                  ('previous',float,(5,))]
+
+# keywords of a previous alignment in the headers, see update_alignment_header
+PREVIOUS_KEYWORDS = ['HIERARCH REFLEX APPOFFRA','HIERARCH REFLEX APPOFFDEC','HIERARCH REFLEX NUMSTARS',
+                     'HIERARCH REFLEX RMSOFFRA','HIERARCH REFLEX RMSOFFDEC']
+
+
+def image_footprint(image_name,cards=None):
+    """
+    Corners of the image of an IMAGE_FOV on the sky, from the WCS of its
+    primary header and the size of its first extension; only headers
+    are read.
+
+    :param cards: cards of the primary header, if already read
+
+    :return: RA and DEC of the 4 corners (deg), NaN if the footprint
+     cannot be computed
+    """
+    try:
+        if cards is None:
+            cards = fits_header.read_header(image_name)
+        size = fits_header.read_keywords(image_name,['NAXIS1','NAXIS2'],hdu=1)
+        wcs = pywcs.WCS(pyfits.Header.fromstring(''.join(cards)))
+        x = np.array([0.5,size['NAXIS1']+0.5,size['NAXIS1']+0.5,0.5])
+        y = np.array([0.5,0.5,size['NAXIS2']+0.5,size['NAXIS2']+0.5])
+        ra,dec = wcs.wcs_pix2world(x,y,1)
+        return np.asarray(ra,float),np.asarray(dec,float)
+    except (KeyError,ValueError,IOError):
+        return np.zeros(4)+np.nan,np.zeros(4)+np.nan
+
+
+def _read_header_metadata(args):
+    filename,kind = args
+    if kind == 'table':
+        return fits_header.read_keywords(filename,['MJD-OBS','DATE-OBS'])
+    cards = fits_header.read_header(filename)
+    return (fits_header.header_values(cards,['RA','DEC','MJD-OBS','HIERARCH REFLEX ALIGNED']+PREVIOUS_KEYWORDS),
+            image_footprint(filename,cards))
+
+
+def read_metadata(images,tables,threads=16):
+    """
+    Read the metadata of the exposures from their headers only,
+    concurrently on a pool of threads, before any pixel is read.
+
+    The IMAGE_FOV are sorted by MJD-OBS, and each of them is paired with
+    the PIXTABLE_REDUCED of the same rank in MJD-OBS order.
+
+    :param images: list of IMAGE_FOV file names
+    :param tables: list of PIXTABLE_REDUCED file names, at least as many
+     as images
+    :param threads: ~int
+     number of headers read at the same time
+
+    :return: ~numpy.ndarray
+     structured array of METADATA_DTYPE, one row per exposure, sorted by
+     MJD-OBS; previous holds offset_ra, offset_dec, n_match, rms_ra and
+     rms_dec of an alignment already applied to the header of the
+     IMAGE_FOV, NaN if it is not aligned
+    """
+    n_images = len(images)
+    items = ([(name,'image') for name in images]+
+             [(name,'table') for name in tables[:n_images]])
+    headers = parallel_map(_read_header_metadata,items,threads,threads=True)
+    headers_img,headers_tbl = headers[:n_images],headers[n_images:]
+    if len(headers_tbl) < n_images:
+        raise IndexError('Fewer PIXTABLE_REDUCED than IMAGE_FOV')
+
+    mjd = np.array([header['MJD-OBS'] for header,footprint in headers_img],float)
+    mjd_tbl = np.array([header['MJD-OBS'] for header in headers_tbl],float)
+    sorted_img = np.argsort(mjd)
+    sorted_tbl = np.argsort(mjd_tbl)
+
+    metadata = np.zeros(n_images,dtype=METADATA_DTYPE)
+    for row,(i,j) in enumerate(zip(sorted_img,sorted_tbl)):
+        header,(ra_corners,dec_corners) = headers_img[i]
+        previous = np.zeros(5)+np.nan
+        if header.get('HIERARCH REFLEX ALIGNED'):
+            previous = [header.get(key,np.nan) for key in PREVIOUS_KEYWORDS]
+        metadata[row] = (images[i],tables[j],header['RA'],header['DEC'],
+                         mjd[i],mjd_tbl[j],str(headers_tbl[j].get('DATE-OBS','')),
+                         ra_corners,dec_corners,previous)
+    return metadata
+
+
+def _tangent_x(ra,ra0,dec0):
+    return ((np.asarray(ra,float)-ra0+180.)%360.-180.)*np.cos(np.radians(dec0))
+
+
+def _footprint_boxes(ra_corners,dec_corners,ra0,dec0):
+    """
+    Bounding boxes of footprints on a plane tangent at (ra0, dec0).
+
+    :return: x_min, x_max, y_min, y_max (deg)
+    """
+    x = _tangent_x(ra_corners,ra0,dec0)
+    return (x.min(axis=-1),x.max(axis=-1),
+            np.min(dec_corners,axis=-1),np.max(dec_corners,axis=-1))
+
+
+def clip_to_overlap(source,source_ref,footprint,footprint_ref,margin=0.):
+    """
+    Keep only the sources of two catalogues inside the intersection of
+    the footprints of their exposures, the only ones which can match.
+
+    :param source: [id, ra, dec] catalogue
+    :param source_ref: [id, ra, dec] catalogue
+    :param footprint: (ra_corners, dec_corners) of the exposure of source,
+     see image_footprint
+    :param footprint_ref: (ra_corners, dec_corners) of the exposure of
+     source_ref
+    :param margin: ~float
+     enlargement of the intersection (deg), at least the largest offset
+     searched
+
+    :return: the clipped catalogues; they are returned unchanged if a
+     footprint is unknown
+    """
+    corners = np.array([footprint[0],footprint_ref[0]],float)
+    corners_dec = np.array([footprint[1],footprint_ref[1]],float)
+    if not np.all(np.isfinite(corners)&np.isfinite(corners_dec)):
+        return source,source_ref
+    ra0,dec0 = corners[0].mean(),corners_dec[0].mean()
+    x_min,x_max,y_min,y_max = _footprint_boxes(corners,corners_dec,ra0,dec0)
+    x_min,x_max = x_min.max()-margin,x_max.min()+margin
+    y_min,y_max = y_min.max()-margin,y_max.min()+margin
+
+    clipped = []
+    for catalogue in (source,source_ref):
+        id_,ra,dec = catalogue
+        if len(id_) == 1 and id_[0] == -1:
+            # failed detection, see _failed_catalogue
+            clipped.append(catalogue)
+            continue
+        x = _tangent_x(ra,ra0,dec0)
+        inside = (x >= x_min)&(x <= x_max)&(dec >= y_min)&(dec <= y_max)
+        clipped.append([np.asarray(id_)[inside],np.asarray(ra)[inside],np.asarray(dec)[inside]])
+    return clipped[0],clipped[1]
+
+
+def find_footprint_overlaps(ra_corners,dec_corners):
+    """
+    Pairs of exposures whose footprints overlap, with the area of the
+    overlap.
+
+    The footprints are approximated by their bounding boxes on a plane
+    tangent at the first exposure. Each box is hashed on a grid of cells
+    as large as the largest box, so it lies on at most 2x2 cells, and
+    only the boxes sharing a cell are compared: the cost grows with the
+    number of overlaps instead of the square of the number of exposures.
+
+    :param ra_corners: ~numpy.ndarray
+     (n, 4) RA of the corners of the footprints (deg), see image_footprint
+    :param dec_corners: ~numpy.ndarray
+     (n, 4) DEC of the corners (deg)
+
+    :return: list of (i, j) index pairs with i < j, and ~numpy.ndarray of
+     the overlap areas (deg^2)
+    """
+    ra_corners = np.asarray(ra_corners,float).reshape(-1,4)
+    dec_corners = np.asarray(dec_corners,float).reshape(-1,4)
+    valid, = np.where(np.all(np.isfinite(ra_corners)&np.isfinite(dec_corners),axis=1))
+    if len(valid) == 0:
+        return [],np.zeros(0)
+    x_min,x_max,y_min,y_max = _footprint_boxes(ra_corners,dec_corners,
+                                               ra_corners[valid[0]].mean(),dec_corners[valid[0]].mean())
+    cell = max((x_max-x_min)[valid].max(),(y_max-y_min)[valid].max(),1e-9)
+
+    cells = dict()
+    for i in valid:
+        for cx in range(int(np.floor(x_min[i]/cell)),int(np.floor(x_max[i]/cell))+1):
+            for cy in range(int(np.floor(y_min[i]/cell)),int(np.floor(y_max[i]/cell))+1):
+                cells.setdefault((cx,cy),[]).append(i)
+    candidates = set()
+    for members in cells.values():
+        for k,i in enumerate(members):
+            for j in members[k+1:]:
+                candidates.add((int(i),int(j)))
+    if len(candidates) == 0:
+        return [],np.zeros(0)
+
+    pairs = np.array(sorted(candidates))
+    i,j = pairs[:,0],pairs[:,1]
+    width = np.minimum(x_max[i],x_max[j])-np.maximum(x_min[i],x_min[j])
+    height = np.minimum(y_max[i],y_max[j])-np.maximum(y_min[i],y_min[j])
+    overlap, = np.where((width > 0)&(height > 0))
+    return ([(int(i[k]),int(j[k])) for k in overlap],
+            (width*height)[overlap])
+
+
+def plan_footprint_alignment(n_images,pairs,areas,reference=0,solved=None):
+    """
+    Plan the order in which the exposures are aligned on the graph of
+    their footprint overlaps: the spanning tree with the largest
+    overlaps is walked breadth first from the reference exposure.
+
+    :param n_images: ~int
+    :param pairs: list of (i, j) pairs of overlapping exposures
+    :param areas: ~numpy.ndarray
+     overlap area of each pair
+    :param reference: ~int
+    :param solved: list of the indices of the exposures with known
+     offsets, from a previous alignment; they are merged in a single
+     node of the graph, from which the tree is walked, and each
+     exposure linked to that node is aligned on the solved exposure it
+     overlaps most
+
+    :return: list of (reference, target) index pairs, in processing
+     order, as plan_alignment; the exposures that are not connected to
+     the reference by overlaps are not planned
+    """
+    if len(pairs) == 0:
+        return []
+    pairs = np.asarray(pairs,int)
+    areas = np.asarray(areas,float)
+    label = np.arange(n_images)
+    if solved is not None and len(solved):
+        solved = np.unique(solved)
+        reference = solved[0]
+        label[solved] = reference
+    i,j = label[pairs[:,0]],label[pairs[:,1]]
+    keep, = np.where(i != j)
+    if len(keep) == 0:
+        return []
+    # of several pairs merged in the same edge, the largest overlap wins
+    first,second = np.minimum(i,j)[keep],np.maximum(i,j)[keep]
+    order = np.lexsort((np.arange(len(keep)),-areas[keep],second,first))
+    unique = order[_first_of_groups(first[order]*n_images+second[order])]
+    edge_pairs = keep[unique]
+
+    # the minimum spanning tree of the inverse areas keeps the largest overlaps
+    graph = sparse.coo_matrix((1./areas[edge_pairs],(first[unique],second[unique])),
+                              shape=(n_images,n_images)).tocsr()
+    tree = csgraph.minimum_spanning_tree(graph)
+    order,predecessors = csgraph.breadth_first_order(tree,reference,directed=False)
+    edges = []
+    for k in order[1:]:
+        parent = int(predecessors[k])
+        if parent == reference and solved is not None and len(solved):
+            # the actual exposure of the merged node
+            edge = edge_pairs[(first[unique] == min(parent,k))&(second[unique] == max(parent,k))][0]
+            parent = int(pairs[edge,0] if pairs[edge,1] == k else pairs[edge,1])
+        edges.append((parent,int(k)))
+    return edges
+
+
+def pointing_distances(ra,dec):
+    """
+    Matrix of the distances between the pointings of the exposures.
+
+    :param ra: ~numpy.ndarray
+    :param dec: ~numpy.ndarray
+
+    :return: ~numpy.ndarray
+    """
+    ra = np.asarray(ra,float)
+    dec = np.asarray(dec,float)
+    return ((ra[:,None]-ra[None,:])**2. + (dec[:,None]-dec[None,:])**2.)**0.5
+
+
+def plan_alignment(ra,dec,reference=0,solved=None):
+    """
+    Plan the order in which the exposures are aligned.
+
+    Starting from the reference exposure, the next exposure to align is
+    always the one closest to an exposure with known offsets, which is
+    Prim's construction of the minimum spanning tree of the pointing
+    distances. The distance to the tree and the closest exposure of the
+    tree are kept for every exposure and updated as the tree grows, and
+    ties are resolved as the lowest (reference, target) indices.
+
+    :param ra: ~numpy.ndarray
+    :param dec: ~numpy.ndarray
+    :param reference: ~int
+     index of the exposure with known offsets (0,0)
+    :param solved: list of the indices of the exposures with known
+     offsets, from a previous alignment; the tree grows from all of
+     them, instead of the reference only
+
+    :return: list of (reference, target) index pairs, in processing
+     order; the offsets of target are computed from the catalogue of
+     reference
+    """
+    distances = pointing_distances(ra,dec)
+    n_images = len(distances)
+    if n_images == 0:
+        return []
+    if solved is None or len(solved) == 0:
+        solved = [reference]
+    solved = np.unique(solved)
+    processed = np.zeros(n_images,bool)
+    processed[solved] = True
+    nearest = np.argmin(distances[solved],axis=0)
+    closest = distances[solved[nearest],np.arange(n_images)]
+    parent = solved[nearest]
+
+    edges = []
+    for i in range(n_images-len(solved)):
+        candidates = np.where(processed,np.inf,closest)
+        targets, = np.where(candidates == candidates.min())
+        sel_j = targets[np.lexsort((targets,parent[targets]))[0]]
+        edges.append((int(parent[sel_j]),int(sel_j)))
+        processed[sel_j] = True
+
+        closer = (distances[sel_j] < closest) | ((distances[sel_j] == closest) & (parent > sel_j))
+        closest[closer] = distances[sel_j][closer]
+        parent[closer] = sel_j
+
+    return edges
+
+
+
+def parallel_map(function,items,processes=1,threads=False):
+    """
+    Apply function to every item, on a pool of processes (or threads).
+
+    :param processes: ~int
+     size of the pool; 1 runs serially, 0 or None uses all the CPUs
+    :param threads: ~bool
+     use a pool of threads instead of processes, for I/O bound work
+
+    :return: list of the results, in the order of items
+    """
+    items = list(items)
+    if not processes:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes,len(items))
+    if processes <= 1:
+        return [function(item) for item in items]
+    if threads:
+        pool = ThreadPool(processes)
+    else:
+        pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(function,items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def parallel_imap(function,items,processes=1,threads=False):
+    """
+    Apply function to every item on a pool of processes (or threads),
+    as parallel_map, but yield the results as soon as they are
+    computed, in completion order.
+    """
+    items = list(items)
+    if not processes:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes,len(items))
+    if processes <= 1:
+        for item in items:
+            yield function(item)
+        return
+    if threads:
+        pool = ThreadPool(processes)
+    else:
+        pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(function,items):
+            yield result
+    except GeneratorExit:
+        pool.terminate()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+
+def find_overlapping_pairs(ra,dec,max_separation=1./60.,max_neighbours=None):
+    """
+    Pairs of exposures whose pointings are closer than max_separation.
+
+    :param max_separation: ~float
+     maximum pointing distance (deg), by default the MUSE WFM field
+    :param max_neighbours: ~int
+     if given, each exposure is paired with its max_neighbours closest
+     exposures only, and along the edges of plan_alignment, which keep
+     all the exposures connected: the number of pairs grows linearly
+     with the number of exposures, instead of quadratically for a
+     dense dither pattern
+
+    :return: list of (i, j) index pairs with i < j
+    """
+    distances = pointing_distances(ra,dec)
+    close = distances <= max_separation
+    if max_neighbours is not None:
+        candidates = np.where(close,distances,np.inf)
+        np.fill_diagonal(candidates,np.inf)
+        nearest = np.argsort(candidates,axis=1,kind='mergesort')[:,:max_neighbours]
+        rows = np.repeat(np.arange(len(distances)),nearest.shape[1])
+        keep = np.zeros(close.shape,bool)
+        keep[rows,nearest.ravel()] = np.isfinite(candidates[rows,nearest.ravel()])
+        for i,j in plan_alignment(ra,dec):
+            keep[i,j] = close[i,j]
+        close = keep|keep.T
+    (ic,jc) = np.where(np.triu(close,1))
+    return [(int(i),int(j)) for i,j in zip(ic,jc)]
+
+
+def _compute_pair_offsets(args):
+    source_i,source_j,method,kwargs = args
+    start = time.time()
+    stats = dict()
+    result = compute_offsets(source_i[0],source_i[1],source_i[2],
+                             source_j[0],source_j[1],source_j[2],
+                             method=method,stats=stats,**kwargs)
+    stats['seconds'] = time.time()-start
+    return result,stats
+
+
+def _scalar(value):
+    # find_matches returns [0] instead of 0 without matches
+    return float(np.ravel(value)[0])
+
+
+def iter_pair_offsets(catalogues,pairs,processes=1,method='grid',cache=None,footprints=None,overlap_margin=0.,stats=None,**kwargs):
+    """
+    Compute the offsets of many pairs of catalogues on a process pool,
+    starting each pair as soon as both of its catalogues are available.
+
+    :param catalogues: iterable of (index, [id, ra, dec]), for example
+     iter_catalogues
+    :param pairs: list of (i, j) index pairs
+    :param processes: ~int
+     size of the process pool, see parallel_map
+    :param cache: ~reflexy.muse.cache.AlignmentCache
+     if given, the pairs already in the cache are not matched again
+    :param footprints: (ra_corners, dec_corners) arrays of the exposures;
+     if given, the catalogues of each pair are clipped to the overlap of
+     their footprints enlarged by overlap_margin (deg), see
+     clip_to_overlap
+    :param stats: ~dict
+     if given, filled with index in pairs -> dict of the numbers of
+     sources matched in the two catalogues, 'n_sources', whether the
+     offsets were in the cache, 'cached', the result, and the stats of
+     compute_offsets with the time of the solver, 'seconds'
+
+    :return: generator of (index in pairs, compute_offsets result), in
+     completion order
+    """
+    pairs_of = dict()
+    for k,(i,j) in enumerate(pairs):
+        pairs_of.setdefault(i,[]).append(k)
+        pairs_of.setdefault(j,[]).append(k)
+    params = dict(kwargs,method=method)
+    if not processes:
+        processes = multiprocessing.cpu_count()
+    pool = None
+    if processes > 1 and len(pairs) > 1:
+        pool = multiprocessing.Pool(min(processes,len(pairs)))
+
+    def finished(pending,wait):
+        done = [item for item in pending if wait or item[3].ready()]
+        for item in done:
+            pending.remove(item)
+        return done
+
+    def finish(k,key,pair_stats,result):
+        if cache is not None and not pair_stats['cached']:
+            cache.put_offsets(key,result)
+        if stats is not None:
+            stats[k] = dict(pair_stats,offset_ra=_scalar(result[0]),offset_dec=_scalar(result[1]),
+                            n_match=_scalar(result[2]),rms_ra=_scalar(result[3]),
+                            rms_dec=_scalar(result[4]))
+        return k,result
+
+    sources = dict()
+    pending = []
+    try:
+        for index,catalogue in catalogues:
+            sources[index] = catalogue
+            for k in pairs_of.get(index,()):
+                i,j = pairs[k]
+                if i not in sources or j not in sources:
+                    continue
+                if footprints is None:
+                    pair_catalogues = (sources[i],sources[j])
+                else:
+                    pair_catalogues = clip_to_overlap(sources[i],sources[j],
+                                                      (footprints[0][i],footprints[1][i]),
+                                                      (footprints[0][j],footprints[1][j]),
+                                                      overlap_margin)
+                pair_stats = dict(n_sources=[n_sources(pair_catalogues[0]),n_sources(pair_catalogues[1])],
+                                  cached=False)
+                key = None
+                if cache is not None:
+                    key = cache.offsets_key(pair_catalogues[0],pair_catalogues[1],params)
+                    result = cache.get_offsets(key)
+                    if result is not None:
+                        pair_stats['cached'] = True
+                        yield finish(k,key,pair_stats,result)
+                        continue
+                args = pair_catalogues+(method,kwargs)
+                if pool is None:
+                    pending.append((k,key,pair_stats,None,_compute_pair_offsets(args)))
+                else:
+                    pending.append((k,key,pair_stats,pool.apply_async(_compute_pair_offsets,(args,)),None))
+            for k,key,pair_stats,async_result,output in finished(pending,pool is None):
+                if async_result is not None:
+                    output = async_result.get()
+                result,solver_stats = output
+                pair_stats.update(solver_stats)
+                yield finish(k,key,pair_stats,result)
+        for k,key,pair_stats,async_result,output in finished(pending,True):
+            if async_result is not None:
+                output = async_result.get()
+            result,solver_stats = output
+            pair_stats.update(solver_stats)
+            yield finish(k,key,pair_stats,result)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def match_pairs(sources,pairs,processes=1,method='grid',cache=None,footprints=None,overlap_margin=0.,**kwargs):
+    """
+    Compute the offsets of many pairs of catalogues, see
+    iter_pair_offsets.
+
+    :param sources: list of [id, ra, dec] catalogues
+
+    :return: list of the compute_offsets results, in the order of pairs
+    """
+    results = [None]*len(pairs)
+    for k,result in iter_pair_offsets(enumerate(sources),pairs,processes,method,cache,
+                                      footprints,overlap_margin,**kwargs):
+        results[k] = result
+    return results
+
+
+def connected_exposures(n_images,pairs,results,reference=0):
+    """
+    Exposures connected to the reference through matched pairs.
+
+    :return: ~numpy.ndarray
+     boolean mask of the exposures, including the reference
+    """
+    good = [k for k in range(len(pairs)) if results[k][2] > 0]
+    connections = sparse.coo_matrix((np.ones(len(good)),([pairs[k][0] for k in good],
+                                                         [pairs[k][1] for k in good])),
+                                    shape=(n_images,n_images))
+    n_groups,group = csgraph.connected_components(connections,directed=False)
+    return group == group[reference]
+
+
+def solve_offsets(n_images,pairs,results,reference=0,rms_floor=0.1/3600.,huber=2.,reject=5.,max_iter=20):
+    """
+    Solve for the offsets of all the exposures at once.
+
+    Every matched pair (i, j) gives an equation
+    offset[j] - offset[i] = offset_ij, weighted by sqrt(n_match) over
+    the rms of the pair, and the reference exposure is held at (0,0).
+    The weighted least-squares system is sparse and is solved through
+    its normal equations, with the anchored exposures removed from the
+    unknowns. Exposures not connected to the reference
+    through matched pairs are held at (0,0) by anchoring the first
+    exposure of their group.
+
+    The pairs are then reweighted iteratively from their residuals, so
+    that a wrong pair offset is left out of the solution instead of
+    being spread over the other exposures: a pair whose residual is
+    more than huber times the scale of the residuals (and than huber
+    times its own rms) has its weight reduced in proportion, and once
+    these weights have converged, a pair beyond reject times the scale
+    is rejected. The rejected pairs keep
+    a negligible weight, so that they still hold the exposures they are
+    the only link of.
+
+    :param n_images: ~int
+    :param pairs: list of (i, j) index pairs
+    :param results: list of (offset_x, offset_y, n_match, rms_ra,
+     rms_dec), as returned by compute_offsets for (sources[i], sources[j])
+    :param reference: ~int
+    :param rms_floor: ~float
+     added in quadrature to the rms of the pairs (deg), so that pairs
+     with a few matches do not get an infinite weight
+    :param huber: ~float
+     threshold of the Huber weights, in units of the normalized
+     residuals; None for a plain weighted least-squares solution
+    :param reject: ~float
+     rejection threshold, in units of the normalized residuals
+    :param max_iter: ~int
+     maximum number of reweighting iterations
+
+    :return: offsets in RA and DEC (deg) of every exposure
+    """
+    good = [k for k in range(len(pairs)) if results[k][2] > 0]
+    pair_i = np.array([pairs[k][0] for k in good],int)
+    pair_j = np.array([pairs[k][1] for k in good],int)
+    n_match = np.array([results[k][2] for k in good],float)
+
+    connections = sparse.coo_matrix((np.ones(len(good)),(pair_i,pair_j)),
+                                    shape=(n_images,n_images))
+    n_groups,group = csgraph.connected_components(connections,directed=False)
+    anchors = [reference]+[int(np.where(group == g)[0][0]) for g in range(n_groups)
+                           if g != group[reference]]
+    free = np.ones(n_images,bool)
+    free[anchors] = False
+    rows = np.concatenate([np.arange(len(good)),np.arange(len(good))])
+    columns = np.concatenate([pair_j,pair_i])
+
+    offset = [np.array([float(results[k][axis]) for k in good]) for axis in (0,1)]
+    weight = []
+    for axis in (0,1):
+        rms = np.array([float(np.array(results[k][3+axis]).ravel()[0]) for k in good])
+        weight.append(n_match**0.5/(rms**2.+rms_floor**2.)**0.5)
+
+    robust = np.ones(len(good))
+    clipping = False
+    for iteration in range(max_iter+1):
+        offsets = []
+        for axis in (0,1):
+            row_weight = weight[axis]*robust**0.5
+            design = sparse.csr_matrix((np.concatenate([row_weight,-row_weight]),(rows,columns)),
+                                       shape=(len(good),n_images))[:,np.where(free)[0]]
+            normal = (design.T*design).tocsc()
+            solution = np.zeros(n_images)
+            if free.any():
+                solution[free] = sparse_linalg.spsolve(normal,design.T*(row_weight*offset[axis]))
+            offsets.append(solution)
+        if huber is None or len(good) == 0:
+            break
+        # residuals in units of the rms of each pair; a residual within
+        # the stated errors of its pair is never down-weighted
+        residual = np.hypot(*[(offsets[axis][pair_j]-offsets[axis][pair_i]-offset[axis])*weight[axis]
+                              for axis in (0,1)])
+        scale = max(np.median(residual)/np.sqrt(2.*np.log(2.)),1.)
+        new_robust = np.minimum(1.,huber*scale/np.maximum(residual,1e-300))
+        # the pairs are rejected once the Huber weights have converged,
+        # when a wrong offset no longer shifts the residuals of the others
+        if clipping:
+            new_robust[residual > reject*scale] = 1e-9
+        if np.allclose(new_robust,robust,rtol=1e-3,atol=1e-12):
+            if clipping:
+                break
+            clipping = True
+        robust = new_robust
+
+    return(offsets[0],offsets[1])
+
+
+
+def plan_pairs(metadata,mode='chain',planning='distance',max_separation=1./60.,reference=0,solved=None,max_neighbours=None):
+    """
+    Plan the pairs of exposures to match.
+
+    :param metadata: ~numpy.ndarray
+     see read_metadata
+    :param mode: ~str
+     'chain' to align each exposure on one already aligned, 'global' to
+     match every pair of neighbouring exposures and solve all the
+     offsets at once
+    :param planning: ~str
+     'distance' to relate the exposures by the distance of their
+     pointings, 'footprint' by the overlap of their footprints
+    :param max_separation: ~float
+     maximum pointing distance of a pair in 'global' mode with
+     'distance' planning (deg)
+    :param solved: indices of the exposures with known offsets ('chain'
+     mode only); only the other exposures are planned
+    :param max_neighbours: ~int
+     maximum number of neighbours of an exposure in 'global' mode with
+     'distance' planning, see find_overlapping_pairs
+
+    :return: list of (i, j) index pairs; in 'chain' mode, they are in
+     processing order and j is aligned on i
+    """
+    if mode not in ('chain','global'):
+        raise ValueError("Unknown alignment mode: " + str(mode))
+    if planning not in ('distance','footprint'):
+        raise ValueError("Unknown planning: " + str(planning))
+    if planning == 'footprint':
+        pairs,areas = find_footprint_overlaps(metadata['ra_corners'],metadata['dec_corners'])
+        if mode == 'global':
+            return pairs
+        return plan_footprint_alignment(len(metadata),pairs,areas,reference,solved)
+    if mode == 'global':
+        return find_overlapping_pairs(metadata['ra'],metadata['dec'],max_separation,max_neighbours)
+    return plan_alignment(metadata['ra'],metadata['dec'],reference,solved)
+
+
+def iter_solutions(n_images,pairs,pair_results,mode='chain',reference=0,solved=None):
+    """
+    Solve the offsets of the exposures to the reference from the offsets
+    of the pairs.
+
+    In 'chain' mode, an exposure is solved and yielded as soon as the
+    offsets of all the pairs linking it to the reference are known. In
+    'global' mode, all the pairs are needed by solve_offsets, and every
+    exposure connected to the reference through matched pairs is
+    yielded, with the statistics of its pair with most matches.
+
+    :param pair_results: iterable of (index in pairs, compute_offsets
+     result), for example iter_pair_offsets
+    :param solved: dict index -> (offset_ra, offset_dec) of the exposures
+     with known offsets, from a previous alignment ('chain' mode only);
+     the offsets are those to add to the offsets measured on their
+     catalogues, by default {reference: (0., 0.)}
+
+    :return: generator of (index, offset_ra, offset_dec, n_match,
+     rms_ra, rms_dec)
+    """
+    if mode == 'global':
+        if solved:
+            raise ValueError("Exposures with known offsets need the chain mode")
+        results = [None]*len(pairs)
+        for k,result in pair_results:
+            results[k] = result
+        offsets_ra,offsets_dec = solve_offsets(n_images,pairs,results,reference)
+        n_match = np.zeros(n_images)
+        rms_ra = np.zeros(n_images)
+        rms_dec = np.zeros(n_images)
+        for (i,j),result in zip(pairs,results):
+            for k in (i,j):
+                if result[2] > n_match[k]:
+                    n_match[k],rms_ra[k],rms_dec[k] = result[2],result[3],result[4]
+        connected = connected_exposures(n_images,pairs,results,reference)
+        for j in range(n_images):
+            if j != reference and connected[j]:
+                yield j,offsets_ra[j],offsets_dec[j],n_match[j],rms_ra[j],rms_dec[j]
+        return
+
+    if solved:
+        solved = dict(solved)
+    else:
+        solved = {reference: (0.,0.)}
+    waiting = dict()
+    for k,result in pair_results:
+        i,j = pairs[k]
+        waiting.setdefault(i,[]).append((j,result))
+        ready = [i] if i in solved else []
+        while ready:
+            i = ready.pop()
+            for j,(offset_x,offset_y,n_match,rms_ra,rms_dec) in waiting.pop(i,[]):
+                solved[j] = (solved[i][0]+offset_x,solved[i][1]+offset_y)
+                yield j,solved[j][0],solved[j][1],n_match,rms_ra,rms_dec
+                ready.append(j)
+
+
+def read_alignment_state(filename):
+    """
+    Read the offsets saved by write_alignment_state.
+
+    :return: dict IMAGE_FOV base name -> (offset_ra, offset_dec, n_match,
+     rms_ra, rms_dec)
+    """
+    with open(filename) as f:
+        state = json.load(f)
+    return dict((str(name),tuple(values)) for name,values in state['exposures'].items())
+
+
+def write_alignment_state(filename,alignment,reference=0):
+    """
+    Save the offsets of the aligned exposures and of the reference, for
+    a later incremental alignment.
+
+    :param alignment: ~numpy.ndarray
+     see align_exposures
+    """
+    exposures = dict()
+    for row in range(len(alignment)):
+        if alignment['aligned'][row] or row == reference:
+            exposures[os.path.basename(alignment['image'][row])] = [
+                float(alignment[name][row]) for name in ('offset_ra','offset_dec','n_match','rms_ra','rms_dec')]
+    tmp_name = filename+'.tmp'
+    with open(tmp_name,'w') as f:
+        json.dump({'exposures': exposures},f,indent=1,sort_keys=True)
+    os.rename(tmp_name,filename)
+
+
+def previous_alignment(metadata,state=None):
+    """
+    Offsets of the exposures aligned by a previous run: from the REFLEX
+    keywords of their IMAGE_FOV headers, or else from a state file.
+
+    :param metadata: ~numpy.ndarray
+     see read_metadata
+    :param state: dict, see read_alignment_state
+
+    :return: dict index -> ((offset_ra, offset_dec, n_match, rms_ra,
+     rms_dec), (applied_ra, applied_dec)), where applied is the part of
+     the offsets already in the WCS of the IMAGE_FOV, and so in its
+     catalogue; empty if no exposure is aligned. The reference (index
+     0) is included with zero offsets.
+    """
+    previous = dict()
+    names = [os.path.basename(name) for name in metadata['image']]
+    for row in range(len(metadata)):
+        values = metadata['previous'][row]
+        if np.all(np.isfinite(values[:2])):
+            previous[row] = (tuple(values),(values[0],values[1]))
+        elif state is not None and names[row] in state:
+            previous[row] = (tuple(state[names[row]]),(0.,0.))
+    if previous and 0 not in previous:
+        previous[0] = ((0.,0.,0.,0.,0.),(0.,0.))
+    return previous
+
+
+def write_headers(solutions,metadata):
+    """
+    Update the headers of the pixel table and the image of each solved
+    exposure, see update_alignment_header, and pass the solutions
+    through.
+
+    :param solutions: iterable of solutions, see iter_solutions
+    :param metadata: ~numpy.ndarray
+     see read_metadata
+    """
+    for solution in solutions:
+        j,offset_ra,offset_dec,n_match,rms_ra,rms_dec = solution
+        update_alignment_header(metadata['table'][j],'RA','DEC',offset_ra,offset_dec,rms_ra,rms_dec,n_match)
+        update_alignment_header(metadata['image'][j],'CRVAL1','CRVAL2',offset_ra,offset_dec,rms_ra,rms_dec,n_match)
+        yield solution
+
+
+ALIGNMENT_DTYPE = METADATA_DTYPE+[('offset_ra',float),('offset_dec',float),('n_match',float),
+                                  ('rms_ra',float),('rms_dec',float),('aligned',bool)]
+
+
+def alignment_metrics(alignment,pairs,clock,catalogue_stats,pair_stats):
+    """
+    Metrics of a run of align_exposures.
+
+    :param alignment: ~numpy.ndarray
+     see align_exposures
+    :param pairs: list of the (i, j) pairs matched
+    :param clock: ~reflexy.muse.metrics.StageClock
+     clock of the stages
+    :param catalogue_stats: ~dict
+     see iter_catalogues
+    :param pair_stats: ~dict
+     see iter_pair_offsets
+
+    :return: dict with the wall time and the peak memory of the run and
+     of the worker processes, the stages (wall and CPU time, peak
+     memory, and the time of the detection and matching workers), and
+     the stats of each exposure and of each pair, whose 'images' and
+     'n_sources' are in the (i, j) order of pairs
+    """
+    stages = dict((name,dict(values)) for name,values in clock.stages.items())
+    detection = stages.setdefault('detection',dict(wall_seconds=0.,cpu_seconds=0.,peak_memory_mb=0.))
+    # the workers read and detect while the main process waits, so
+    # their time shows whether the detection is I/O or compute bound
+    detection['worker_read_seconds'] = sum(stats.get('read_seconds',0.) for stats in catalogue_stats.values())
+    detection['worker_detect_seconds'] = sum(stats.get('detect_seconds',0.) for stats in catalogue_stats.values())
+    matching = stages.setdefault('matching',dict(wall_seconds=0.,cpu_seconds=0.,peak_memory_mb=0.))
+    matching['worker_seconds'] = sum(stats.get('seconds',0.) for stats in pair_stats.values())
+    matching['cells'] = sum(stats.get('cells',0) for stats in pair_stats.values())
+
+    exposures = []
+    for row in range(len(alignment)):
+        exposure = dict(image=os.path.basename(alignment['image'][row]),
+                        aligned=bool(alignment['aligned'][row]))
+        exposure.update(catalogue_stats.get(row,dict()))
+        exposures.append(exposure)
+    pair_metrics = []
+    for k,(i,j) in enumerate(pairs):
+        pair = dict(images=[exposures[i]['image'],exposures[j]['image']])
+        pair.update(pair_stats.get(k,dict()))
+        pair_metrics.append(pair)
+
+    return dict(wall_seconds=clock.elapsed(),peak_memory_mb=peak_memory(),
+                worker_peak_memory_mb=peak_memory(children=True),
+                n_exposures=len(alignment),n_pairs=len(pairs),stages=stages,
+                exposures=exposures,pairs=pair_metrics)
+
+
+def align_exposures(images,tables,mode='chain',planning='distance',method='grid',
+                    detection_method='daofind',detection_binning=None,detection_tile_size=None,
+                    max_pair_separation=60.,max_pair_neighbours=None,clip_overlap=False,processes=1,header_threads=16,
+                    cache=None,update_headers=False,offset_list=None,incremental=False,
+                    state_file=None,metrics=None,**offset_kwargs):
+    """
+    Align a set of exposures on the oldest one.
+
+    The stages are chained generators: the metadata are read from the
+    headers, the pairs to match are planned, the catalogues are built,
+    each pair is matched as soon as its two catalogues are available,
+    and each exposure is solved (and its headers updated) as soon as its
+    pairs are matched.
+
+    :param images: list of IMAGE_FOV file names
+    :param tables: list of PIXTABLE_REDUCED file names
+    :param mode: ~str
+     'chain' or 'global', see plan_pairs
+    :param planning: ~str
+     'distance' or 'footprint', see plan_pairs
+    :param method: ~str
+     offset solver, see compute_offsets
+    :param detection_method: ~str
+     see detect_sources
+    :param max_pair_separation: ~float
+     maximum pointing distance of the pairs in 'global' mode (arcsec)
+    :param max_pair_neighbours: ~int
+     maximum number of neighbours of an exposure in 'global' mode, see
+     plan_pairs
+    :param clip_overlap: ~bool
+     clip the catalogues of each pair to the overlap of the footprints,
+     see clip_to_overlap
+    :param processes: ~int
+     size of the process pools of the detection and of the matching
+    :param header_threads: ~int
+     number of headers read at the same time
+    :param cache: ~reflexy.muse.cache.AlignmentCache
+    :param update_headers: ~bool
+     apply the offsets to the headers of the pixel tables and images
+    :param offset_list: ~str
+     if given, name of the OFFSET_LIST table written, see
+     write_offset_list
+    :param incremental: ~bool
+     keep the offsets of the exposures aligned by a previous run, see
+     previous_alignment, and align only the other ones on them ('chain'
+     mode only); the exposures added must be more recent than the
+     reference
+    :param state_file: ~str
+     if given, the offsets are saved in this file, and read from it in
+     incremental mode, see write_alignment_state
+    :param metrics: ~dict
+     if given, filled with the time and memory used by each stage
+     (metadata, planning, detection, matching, solving, headers and
+     output) and the stats of each exposure and pair, see
+     alignment_metrics
+    :param offset_kwargs: passed to compute_offsets (search_radius,
+     step, fallback, ...)
+
+    :return: ~numpy.ndarray
+     structured array of ALIGNMENT_DTYPE, one row per exposure, sorted
+     by MJD-OBS
+    """
+    if detection_binning and detection_binning > 1 and detection_tile_size:
+        raise ValueError("Detection binning and tiles cannot be combined")
+    clock = StageClock()
+    with clock.stage('metadata'):
+        metadata = read_metadata(images,tables,header_threads)
+    with clock.stage('planning'):
+        previous = dict()
+        if incremental:
+            state = None
+            if state_file is not None and os.path.exists(state_file):
+                state = read_alignment_state(state_file)
+            previous = previous_alignment(metadata,state)
+            if previous and mode != 'chain':
+                raise ValueError("Incremental alignment needs the chain mode")
+        # the offsets measured on a catalogue are relative to its WCS
+        solved = dict((row,(values[0]-applied[0],values[1]-applied[1]))
+                      for row,(values,applied) in previous.items())
+        pairs = plan_pairs(metadata,mode,planning,max_pair_separation/3600.,solved=sorted(solved),
+                           max_neighbours=max_pair_neighbours)
+
+    match_kwargs = dict(offset_kwargs)
+    if clip_overlap:
+        match_kwargs.update(footprints=(metadata['ra_corners'],metadata['dec_corners']),
+                            overlap_margin=offset_kwargs.get('search_radius',21.)/3600.)
+    # only the exposures in a pair need a catalogue
+    needed = sorted(set(i for pair in pairs for i in pair))
+    catalogue_stats = dict()
+    pair_stats = dict()
+    catalogues = clock.timed(iter_catalogues(list(metadata['image']),processes,detection_method,
+                                             detection_binning,detection_tile_size,cache,needed,
+                                             catalogue_stats),'detection')
+    pair_results = clock.timed(iter_pair_offsets(catalogues,pairs,processes,method,cache,
+                                                 stats=pair_stats,**match_kwargs),'matching')
+    solutions = clock.timed(iter_solutions(len(metadata),pairs,pair_results,mode,solved=solved),'solving')
+    if update_headers:
+        solutions = clock.timed(write_headers(solutions,metadata),'headers')
+
+    alignment = np.zeros(len(metadata),dtype=ALIGNMENT_DTYPE)
+    for name in metadata.dtype.names:
+        alignment[name] = metadata[name]
+    for row,(values,applied) in previous.items():
+        for name,value in zip(('offset_ra','offset_dec','n_match','rms_ra','rms_dec'),values):
+            alignment[name][row] = value
+        alignment['aligned'][row] = row != 0
+    for j,offset_ra,offset_dec,n_match,rms_ra,rms_dec in solutions:
+        alignment['offset_ra'][j] = offset_ra
+        alignment['offset_dec'][j] = offset_dec
+        alignment['n_match'][j] = n_match
+        alignment['rms_ra'][j] = rms_ra
+        alignment['rms_dec'][j] = rms_dec
+        alignment['aligned'][j] = True
+
+    with clock.stage('output'):
+        if offset_list is not None:
+            write_offset_list(offset_list,[os.path.basename(name) for name in alignment['table']],
+                              list(alignment['date_obs']),alignment['mjd_table'],alignment['offset_ra'],
+                              alignment['offset_dec'],alignment['n_match'],alignment['rms_ra'],alignment['rms_dec'])
+        if state_file is not None:
+            write_alignment_state(state_file,alignment)
+    if metrics is not None:
+        metrics.update(alignment_metrics(alignment,pairs,clock,catalogue_stats,pair_stats))
+    return alignment
+
+
+if __name__ == '__main__':
+
+#  from astropy.io import fits
+#  import numpy as np
+#  from numpy import array
+#  from photutils import datasets
+#  from photutils import daofind
+#  from astropy.stats import median_absolute_deviation as mad
+#  #import scikit-image
+#  import astropy
+#  import scipy
+#  import pywcs # WCS conversion routines
+#  import pyfits
+#  import copy 
+#  import matplotlib.pyplot as plt
+#  import time
+
+  
+#   MAIN MODULE --- to be interfaced with REFLEX ---
+  warnings.filterwarnings("ignore")
+ #getting the inputs and defyning the outputs
+  parser = reflex.ReflexIOParser()
+  parser.add_option("-i", "--in_sof", dest="in_sof")
+#  parser.add_option("-j", "--in_dir", dest="in_dir")
+  parser.add_option("--offset_method", dest="offset_method", default="grid")
+  parser.add_option("--search_radius", dest="search_radius", default="21.")
+  parser.add_option("--search_step", dest="search_step", default="1.4")
+  parser.add_option("--search_levels", dest="search_levels", default="0")
+  parser.add_option("--offset_fallback", dest="offset_fallback", default="asterism")
+  parser.add_option("--alignment_mode", dest="alignment_mode", default="chain")
+  parser.add_option("--planning", dest="planning", default="distance")
+  parser.add_option("--clip_to_overlap", dest="clip_to_overlap", default="false")
+  parser.add_option("--detection_method", dest="detection_method", default="daofind")
+  parser.add_option("--detection_binning", dest="detection_binning", default="0")
+  parser.add_option("--detection_tile_size", dest="detection_tile_size", default="0")
+  parser.add_option("--max_pair_separation", dest="max_pair_separation", default="60.")
+  parser.add_option("--max_pair_neighbours", dest="max_pair_neighbours", default="0")
+  parser.add_option("--processes", dest="processes", default="0")
+  parser.add_option("--header_threads", dest="header_threads", default="16")
+  parser.add_option("--cache_dir", dest="cache_dir", default="")
+  parser.add_option("--cache_size", dest="cache_size", default="500")
+  parser.add_option("--output_mode", dest="output_mode", default="headers")
+  parser.add_option("--incremental", dest="incremental", default="false")
+  parser.add_option("--state_file", dest="state_file", default="")
+  parser.add_output("-o", "--out_sof", dest="out_sof")
+  parser.add_output("-p", "--messages", dest="messages")
+  parser.add_output("-m", "--metrics", dest="metrics")
+  inputs  = parser.get_inputs()
+  outputs = parser.get_outputs()
+  in_sof = inputs.in_sof#reflex.parseSofJson(json.loads(inputs.in_sof))
+  files=in_sof.files
+  images=[]
+  tables=[]
+  if import_ok == 0:
+     # print 'bu'
+     # time.sleep(6)
+      #raw_input("Press enter to continue")
+#      time.sleep(6)
+      outputs.out_sof = inputs.in_sof
+      outputs.messages = ('Warning: Failing in importing some required Python modules.\n Check software requirements at:\n '
+            ' https://www.eso.org/sci/software/pipelines/reflex_workflows/#software_prerequisites\n'
+            ' or in the MUSE Reflex tutorial.\n\n '
+            'Coordinates in the header will be used for alignment.\n' + str(import_error))
+      parser.write_outputs()
+      sys.exit()
+ 
+  offset_kwargs = dict(search_radius=float(inputs.search_radius),
+                       step=float(inputs.search_step))
+  if inputs.offset_fallback.lower() == 'none':
+      offset_kwargs['fallback'] = None
+  else:
+      offset_kwargs['fallback'] = inputs.offset_fallback
+  if inputs.offset_method == 'hierarchical' and int(inputs.search_levels) > 0:
+      offset_kwargs['n_levels'] = int(inputs.search_levels)
+  detection_binning = int(inputs.detection_binning) or None
+  detection_tile_size = int(inputs.detection_tile_size) or None
+  max_pair_neighbours = int(inputs.max_pair_neighbours) or None
+  processes = int(inputs.processes)
+  cache = None
+  if inputs.cache_dir:
+      cache = AlignmentCache(inputs.cache_dir,int(float(inputs.cache_size)*1024**2))
+
+  for file in files:
+ 
+      if file.category == 'IMAGE_FOV':
+          images.append(str(file.name))
+      if file.category == 'PIXTABLE_REDUCED':    
+          tables.append(str(file.name))
+
+  products_dir = inputs.products_dir if getattr(inputs,'products_dir',None) else os.getcwd()
+  offset_list = None
+  if inputs.output_mode == 'offset_list':
+      # THE OFFSETS GO TO A SMALL TABLE FOR THE COMBINATION, THE PIXEL TABLES AND IMAGES ARE NOT MODIFIED
+      offset_list = os.path.join(products_dir,'OFFSET_LIST.fits')
+
+  metrics = dict()
+  align_exposures(images,tables,mode=inputs.alignment_mode,planning=inputs.planning,
+                  method=inputs.offset_method,detection_method=inputs.detection_method,
+                  detection_binning=detection_binning,detection_tile_size=detection_tile_size,
+                  max_pair_separation=float(inputs.max_pair_separation),max_pair_neighbours=max_pair_neighbours,
+                  clip_overlap=inputs.clip_to_overlap.lower() == 'true',processes=processes,
+                  header_threads=int(inputs.header_threads),cache=cache,
+                  update_headers=offset_list is None,offset_list=offset_list,
+                  incremental=inputs.incremental.lower() == 'true',
+                  state_file=inputs.state_file or None,metrics=metrics,**offset_kwargs)
+  # TIMES, MEMORY AND MATCH QUALITY OF THE RUN, FOR THE DIAGNOSTICS
+  metrics_file = os.path.join(products_dir,'ALIGNMENT_METRICS.json')
+  write_metrics(metrics_file,metrics)
+  outputs.metrics = metrics_file
+
+  if offset_list is not None:
+      purposes = [file.purposes for file in files if file.category == 'PIXTABLE_REDUCED']
+      out_files = list(files)+[reflex.FitsFile(offset_list,'OFFSET_LIST',None,list(purposes[0]) if purposes else None)]
+      outputs.out_sof = reflex.SetOfFiles(in_sof.datasetName,out_files)
+  else:
+      outputs.out_sof = inputs.in_sof
+
+  parser.write_outputs()
+  sys.exit()
+ 
+
+
@@ -0,0 +1,219 @@
+"""
+Asterism matching of two catalogues of point sources.
+
+Triangles are built from each source and its nearest neighbours, and
+indexed in a hash table by their shape: the ratios of their sides,
+which do not change under a translation, a rotation or a change of
+scale. Every pair of triangles of the same shape gives a similarity
+transform, the transform on which most pairs agree is kept, and it is
+refined on the sources it matches. The cost depends on the number
+of sources only, not on the size of the offset.
+"""
+
+from itertools import combinations
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def _triangles(points, n_neighbours):
+    """
+    Triangles made of each point and two of its n_neighbours nearest
+    neighbours, without duplicates.
+
+    :return: (n, 3) array of point indices
+    """
+    n_points = len(points)
+    if n_points < 3:
+        return np.zeros((0, 3), int)
+    k = min(n_neighbours + 1, n_points)
+    neighbours = cKDTree(points).query(points, k)[1]
+    triangles = [np.column_stack([neighbours[:, 0], neighbours[:, a],
+                                  neighbours[:, b]])
+                 for a, b in combinations(range(1, k), 2)]
+    triangles = np.sort(np.concatenate(triangles), axis=1)
+    key = (triangles[:, 0] * n_points + triangles[:, 1]) * n_points + \
+        triangles[:, 2]
+    return triangles[np.unique(key, return_index=True)[1]]
+
+
+def _invariants(points, triangles):
+    """
+    Shape of the triangles, and their vertices in a canonical order.
+
+    The vertices are ordered by decreasing length of their opposite
+    side, so that the same triangle gives the same order in both
+    catalogues.
+
+    :return: (n, 2) array of the middle and shortest sides divided by the
+     longest one, (n, 3) array of the ordered vertices
+    """
+    p0, p1, p2 = [points[triangles[:, k]] for k in range(3)]
+    sides = np.column_stack([np.hypot(*(p1 - p2).T),
+                             np.hypot(*(p0 - p2).T),
+                             np.hypot(*(p0 - p1).T)])
+    order = np.argsort(-sides, axis=1, kind='mergesort')
+    rows = np.arange(len(triangles))[:, None]
+    sides = sides[rows, order]
+    vertices = triangles[rows, order]
+    valid = sides[:, 0] > 0
+    invariants = sides[valid, 1:] / sides[valid, :1]
+    return invariants, vertices[valid]
+
+
+def fit_similarity(points, points_ref):
+    """
+    Least-squares similarity transform (rotation, scale, translation)
+    mapping points onto points_ref, without reflection (Umeyama).
+
+    :return: 2x2 matrix (rotation times scale) and translation
+    """
+    mean = points.mean(axis=0)
+    mean_ref = points_ref.mean(axis=0)
+    centred = points - mean
+    centred_ref = points_ref - mean_ref
+    covariance = np.dot(centred_ref.T, centred) / len(points)
+    u, singular, vt = np.linalg.svd(covariance)
+    sign = np.diag([1., np.sign(np.linalg.det(u) * np.linalg.det(vt))])
+    rotation = np.dot(np.dot(u, sign), vt)
+    variance = (centred ** 2).sum() / len(points)
+    if variance == 0:
+        scale = 1.
+    else:
+        scale = np.trace(np.dot(np.diag(singular), sign)) / variance
+    matrix = scale * rotation
+    return matrix, mean_ref - np.dot(matrix, mean)
+
+
+def _mutual_matches(points, points_ref, radius):
+    """
+    Indices of the mutual nearest neighbours closer than radius.
+    """
+    distance, nearest_ref = cKDTree(points_ref).query(
+        points, distance_upper_bound=radius)
+    nearest = cKDTree(points).query(points_ref,
+                                    distance_upper_bound=radius)[1]
+    ind, = np.where(np.isfinite(distance))
+    ind = ind[nearest[nearest_ref[ind]] == ind]
+    return ind, nearest_ref[ind]
+
+
+def _consensus(points, vertices, points_ref, vertices_ref, radius):
+    """
+    Similarity transform on which most pairs of matching triangles
+    agree.
+
+    Each pair of triangles gives a transform, z -> a * z + b in complex
+    notation. Two transforms agree when they map the points within
+    radius of each other, which is measured at the centre c of the
+    points and at their typical distance scale from it, as the
+    distance between the vectors (a * c + b, a * scale).
+
+    :return: 2x2 matrix and translation of the mean transform of the
+     pairs agreeing with the best one
+    """
+    z = points[vertices, 0] + 1j * points[vertices, 1]
+    z_ref = points_ref[vertices_ref, 0] + 1j * points_ref[vertices_ref, 1]
+    centred = z - z.mean(axis=1)[:, None]
+    centred_ref = z_ref - z_ref.mean(axis=1)[:, None]
+    a = (centred_ref * np.conj(centred)).sum(axis=1) / \
+        (np.abs(centred) ** 2).sum(axis=1)
+    b = z_ref.mean(axis=1) - a * z.mean(axis=1)
+
+    centre = points[:, 0].mean() + 1j * points[:, 1].mean()
+    scale = np.sqrt(np.mean(np.abs(points[:, 0] + 1j * points[:, 1] -
+                                   centre) ** 2))
+    at_centre = a * centre + b
+    features = np.column_stack([at_centre.real, at_centre.imag,
+                                a.real * scale, a.imag * scale])
+    neighbours = cKDTree(features).query_ball_point(features, radius)
+    best = int(np.argmax([len(group) for group in neighbours]))
+    group = neighbours[best]
+    a = a[group].mean()
+    b = b[group].mean()
+    return np.array([[a.real, -a.imag], [a.imag, a.real]]), \
+        np.array([b.real, b.imag])
+
+
+def match_asterisms(x, y, x_ref, y_ref, match_radius, n_max=40,
+                    n_neighbours=5, tolerance=0.01, n_iter=5):
+    """
+    Find the similarity transform between two catalogues of points on a
+    plane by triangle matching.
+
+    :param match_radius: ~float
+     distance below which two sources match once the transform applied
+    :param n_max: ~int
+     number of sources used to build the triangles, the first ones of
+     each catalogue (the brightest ones for detect_sources)
+    :param n_neighbours: ~int
+     number of neighbours of each source used to build its triangles
+    :param tolerance: ~float
+     tolerance on the ratios of the sides of two matching triangles
+    :param n_iter: ~int
+     number of iterations of the transform fit and outlier rejection
+
+    :return: None if no transform is found, otherwise a tuple (matrix,
+     translation, ind, ind_ref): the transform maps (x, y) onto
+     (x_ref, y_ref) as matrix . (x, y) + translation, and ind, ind_ref
+     are the indices of the matching sources
+    """
+    points = np.column_stack([x, y]).astype(float)
+    points_ref = np.column_stack([x_ref, y_ref]).astype(float)
+    invariants, vertices = _invariants(
+        points[:n_max], _triangles(points[:n_max], n_neighbours))
+    invariants_ref, vertices_ref = _invariants(
+        points_ref[:n_max], _triangles(points_ref[:n_max], n_neighbours))
+    if len(invariants) == 0 or len(invariants_ref) == 0:
+        return None
+
+    table = dict()
+    for k, key in enumerate(map(tuple, np.floor(invariants_ref /
+                                                tolerance).astype(int))):
+        table.setdefault(key, []).append(k)
+    candidates = []
+    keys = np.floor(invariants / tolerance).astype(int)
+    for k, (u, v) in enumerate(keys):
+        for du in (-1, 0, 1):
+            for dv in (-1, 0, 1):
+                for k_ref in table.get((u + du, v + dv), ()):
+                    candidates.append((k, k_ref))
+    if len(candidates) == 0:
+        return None
+    candidates = np.array(candidates)
+    close = np.all(np.abs(invariants[candidates[:, 0]] -
+                          invariants_ref[candidates[:, 1]]) <= tolerance,
+                   axis=1)
+    candidates = candidates[close]
+    if len(candidates) == 0:
+        return None
+
+    # the transforms of the true triangle pairs agree, while the chance
+    # ones are scattered: the transform with most others close to it
+    # wins, and its matches among the triangle sources start the fit
+    matrix, translation = _consensus(points[:n_max],
+                                     vertices[candidates[:, 0]],
+                                     points_ref[:n_max],
+                                     vertices_ref[candidates[:, 1]],
+                                     2. * match_radius)
+    ind, ind_ref = _mutual_matches(
+        np.dot(points[:n_max], matrix.T) + translation, points_ref[:n_max],
+        match_radius)
+    if len(ind) < 3:
+        return None
+
+    for iteration in range(n_iter):
+        matrix, translation = fit_similarity(points[ind], points_ref[ind_ref])
+        residuals = np.hypot(*(np.dot(points[ind], matrix.T) + translation -
+                               points_ref[ind_ref]).T)
+        keep = residuals <= max(match_radius, 3. * np.median(residuals))
+        if np.all(keep) or np.sum(keep) < 3:
+            break
+        ind, ind_ref = ind[keep], ind_ref[keep]
+
+    ind, ind_ref = _mutual_matches(np.dot(points, matrix.T) + translation,
+                                   points_ref, match_radius)
+    if len(ind) < 3:
+        return None
+    matrix, translation = fit_similarity(points[ind], points_ref[ind_ref])
+    return matrix, translation, ind, ind_ref
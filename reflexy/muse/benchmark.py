@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the alignment on synthetic exposure sets.
+
+Each case runs on synthetic data with known pointing errors, see
+reflexy.muse.synthetic, and reports its best wall time, the peak memory
+of the process it ran in, and its error against the injected offsets:
+
+- find_closest: the reference catalogue scanned for every source
+- find_matches: the mutual nearest-neighbour matching
+- compute_offsets: the offset search of a pair, for each solver
+- detection: detect_sources on an image
+- solve: the planning, matching and solving of a whole set of
+  catalogues
+- pipeline: align_exposures on IMAGE_FOV and PIXTABLE_REDUCED files
+
+The set benchmarks run in each of the --modes: 'chain', the default of
+the actor, and 'global', with every exposure paired with its
+--max-neighbours closest exposures (the --max_pair_neighbours option of
+the actor, 0 for all the overlapping exposures). In 'chain' mode the
+errors of the pairs add up along the chain, and the last exposures of a
+large set drift (by 0.26" for 300 exposures).
+
+The scaling exponent of the time with the number of sources (or of
+exposures) is printed for each benchmark. The results can be saved as
+JSON and compared to a previous run, to catch regressions:
+
+    python -m reflexy.muse.benchmark --output new.json --baseline old.json
+"""
+
+from __future__ import print_function
+
+import json
+import multiprocessing
+import optparse
+import shutil
+import sys
+import tempfile
+import timeit
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+import numpy as np
+
+from reflexy.muse import alignment
+from reflexy.muse.metrics import peak_memory
+from reflexy.muse.synthetic import ARCSEC, ExposureSet
+
+BENCHMARKS = ['find_closest', 'find_matches', 'compute_offsets', 'detection',
+              'solve', 'pipeline']
+
+
+def _best_time(function, repeat):
+    times = []
+    for i in range(repeat):
+        start = timeit.default_timer()
+        result = function()
+        times.append(timeit.default_timer() - start)
+    return min(times), result
+
+
+def _offset_error(offsets, expected, dec):
+    """
+    Largest distance between offsets and expected offsets (arcsec), at
+    the declination dec (deg) of the exposures.
+    """
+    d_ra = (np.asarray(offsets[0]) - expected[0]) * np.cos(np.radians(dec))
+    d_dec = np.asarray(offsets[1]) - expected[1]
+    return float(np.max(np.hypot(d_ra, d_dec)) / ARCSEC)
+
+
+def _pair(params):
+    exposures = ExposureSet(2, params['n_sources'], seed=params['seed'])
+    expected = exposures.expected_offsets()
+    # compute_offsets(catalogue i, catalogue j) is the correction of j
+    # relative to i
+    return (exposures.catalogue(0), exposures.catalogue(1),
+            (expected[0][1], expected[1][1]), exposures.dec)
+
+
+def bench_find_closest(params):
+    catalogue, catalogue_ref, expected, dec = _pair(params)
+    id_ref, x_ref, y_ref = catalogue_ref
+    dist_max = 1.12 * ARCSEC
+
+    def run():
+        offsets = []
+        for x, y in zip(catalogue[1] - expected[0],
+                        catalogue[2] - expected[1]):
+            closest = alignment.find_closest(0, x, y, id_ref, x_ref, y_ref,
+                                             dist_max)
+            if np.size(closest[2]):
+                offsets.append(closest[:2])
+        return np.median(offsets, axis=0) + expected
+    seconds, offsets = _best_time(run, params['repeat'])
+    return seconds, _offset_error(offsets, expected, dec)
+
+
+def bench_find_matches(params):
+    catalogue, catalogue_ref, expected, dec = _pair(params)
+    shifted = [catalogue[0], catalogue[1] - expected[0],
+               catalogue[2] - expected[1]]
+    seconds, result = _best_time(
+        lambda: alignment.find_matches(*(shifted + catalogue_ref +
+                                         [1.12 * ARCSEC])),
+        params['repeat'])
+    return seconds, _offset_error(np.add(result[:2], expected), expected,
+                                  dec)
+
+
+def bench_compute_offsets(params):
+    catalogue, catalogue_ref, expected, dec = _pair(params)
+    seconds, result = _best_time(
+        lambda: alignment.compute_offsets(*(catalogue + catalogue_ref),
+                                          method=params['method'],
+                                          fallback=None),
+        params['repeat'])
+    return seconds, _offset_error(result[:2], expected, dec)
+
+
+def bench_detection(params):
+    exposures = ExposureSet(1, params['n_sources'], noise=0.,
+                            completeness=1., seed=params['seed'])
+    header, image = exposures.image(0)
+    seconds, sources = _best_time(
+        lambda: alignment.detect_sources(image,
+                                         method=params['detection_method']),
+        params['repeat'])
+    # the detections are compared to the brightest stars of the image
+    id_, ra, dec = exposures.catalogue(0)
+    star_x, star_y = alignment.pywcs.WCS(header).wcs_world2pix(ra, dec, 0)
+    distances = np.hypot(np.asarray(sources['xcentroid'])[:, None] -
+                         star_x[None, :],
+                         np.asarray(sources['ycentroid'])[:, None] -
+                         star_y[None, :])
+    # in arcsec, for the default 0.2" pixels
+    return seconds, float(np.median(distances.min(axis=1)) * 0.2)
+
+
+def bench_solve(params):
+    exposures = ExposureSet(params['n_exposures'], params['n_sources'],
+                            seed=params['seed'])
+    # as build_catalogue, keep the brightest sources
+    catalogues = [[column[:80] for column in exposures.catalogue(k)]
+                  for k in range(len(exposures))]
+    ra, dec = exposures.pointings()
+
+    def run():
+        if params['mode'] == 'global':
+            pairs = alignment.find_overlapping_pairs(
+                ra, dec, max_neighbours=params['max_neighbours'] or None)
+        else:
+            pairs = alignment.plan_alignment(ra, dec)
+        results = alignment.match_pairs(catalogues, pairs, params['processes'],
+                                        params['method'])
+        offsets = np.zeros((2, len(exposures)))
+        for j, offset_ra, offset_dec, n_match, rms_ra, rms_dec in \
+                alignment.iter_solutions(len(exposures), pairs,
+                                         enumerate(results),
+                                         mode=params['mode']):
+            offsets[:, j] = offset_ra, offset_dec
+        return offsets
+    seconds, offsets = _best_time(run, params['repeat'])
+    return seconds, _offset_error(offsets, exposures.expected_offsets(),
+                                  exposures.dec)
+
+
+def bench_pipeline(params):
+    exposures = ExposureSet(params['n_exposures'], params['n_sources'],
+                            seed=params['seed'])
+    directory = tempfile.mkdtemp()
+    try:
+        images, tables = exposures.write(directory)
+        seconds, result = _best_time(
+            lambda: alignment.align_exposures(
+                images, tables, mode=params['mode'], method=params['method'],
+                detection_method=params['detection_method'],
+                max_pair_neighbours=params['max_neighbours'] or None,
+                processes=params['processes']),
+            params['repeat'])
+    finally:
+        shutil.rmtree(directory)
+    return seconds, _offset_error((result['offset_ra'], result['offset_dec']),
+                                  exposures.expected_offsets(), exposures.dec)
+
+
+def run_case(case):
+    """
+    Run a benchmark case in the current process.
+
+    :param case: dict of the parameters, with the name of the benchmark
+     in 'benchmark'
+
+    :return: the case, with its time (s), the peak memory of the process
+     (MB) and the largest error on the offsets (arcsec; for detection,
+     the median distance of the detections to the stars)
+    """
+    function = globals()['bench_' + case['benchmark']]
+    seconds, error = function(case)
+    return dict(case, seconds=seconds, peak_memory=peak_memory(), error=error)
+
+
+def _run_case_to_queue(case, queue):
+    queue.put(run_case(case))
+
+
+def _run_isolated(case):
+    # a fresh process per case, so that peak_memory is the case's own; a
+    # Process rather than a Pool, whose daemonic workers could not start
+    # the pools of the alignment
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_case_to_queue,
+                                      args=(case, queue))
+    process.start()
+    try:
+        while True:
+            try:
+                return queue.get(timeout=1.)
+            except Empty:
+                if not process.is_alive():
+                    # killed, for example when out of memory
+                    return dict(case, seconds=np.nan, peak_memory=np.nan,
+                                error=np.nan,
+                                failure='exit code %s' % process.exitcode)
+    finally:
+        process.join()
+
+
+def make_cases(benchmarks, n_sources, n_exposures, methods, options):
+    """
+    Cases of the benchmarks: the catalogue and detection ones for every
+    number of sources, the set ones for every number of exposures with
+    options.set_sources sources and every mode of options.modes.
+    """
+    common = dict(seed=options.seed, repeat=options.repeat,
+                  processes=options.processes,
+                  detection_method=options.detection_method,
+                  method=methods[0], max_neighbours=options.max_neighbours)
+    cases = []
+    for benchmark in benchmarks:
+        if benchmark in ('solve', 'pipeline'):
+            for mode in options.modes.split(','):
+                for n in n_exposures:
+                    cases.append(dict(common, benchmark=benchmark,
+                                      n_exposures=n, mode=mode,
+                                      n_sources=options.set_sources))
+        elif benchmark == 'compute_offsets':
+            for method in methods:
+                for n in n_sources:
+                    cases.append(dict(common, benchmark=benchmark,
+                                      n_sources=n, method=method))
+        else:
+            for n in n_sources:
+                cases.append(dict(common, benchmark=benchmark, n_sources=n))
+    return cases
+
+
+def case_key(case):
+    """
+    Identifier of a case, to compare runs.
+    """
+    if case['benchmark'] in ('solve', 'pipeline'):
+        mode = case['mode']
+        if mode == 'global' and case['max_neighbours']:
+            mode += '-%d' % case['max_neighbours']
+        return '%s/%s/%s/%d exposures' % (case['benchmark'], case['method'],
+                                          mode, case['n_exposures'])
+    if case['benchmark'] == 'compute_offsets':
+        return '%s/%s/%d sources' % (case['benchmark'], case['method'],
+                                     case['n_sources'])
+    return '%s/%d sources' % (case['benchmark'], case['n_sources'])
+
+
+def scaling(results):
+    """
+    Scaling exponents of the time of each benchmark: the slopes of
+    log(time) against log(size) between successive sizes.
+
+    :return: dict benchmark (and method) -> list of exponents
+    """
+    curves = dict()
+    for result in results:
+        key = case_key(result).rsplit('/', 1)[0]
+        size = result['n_sources']
+        if result['benchmark'] in ('solve', 'pipeline'):
+            size = result['n_exposures']
+        curves.setdefault(key, []).append((size, result['seconds']))
+    exponents = dict()
+    for key, curve in curves.items():
+        curve.sort()
+        exponents[key] = [np.log(t1 / t0) / np.log(float(n1) / n0)
+                          for (n0, t0), (n1, t1) in zip(curve[:-1], curve[1:])
+                          if t0 > 0 and t1 > 0 and n1 > n0]
+    return exponents
+
+
+def compare(results, baseline, max_slowdown=1.5):
+    """
+    Cases slower than max_slowdown times their time in baseline.
+
+    :return: list of (case key, time, baseline time)
+    """
+    previous = dict((case_key(result), result['seconds'])
+                    for result in baseline)
+    slower = []
+    for result in results:
+        key = case_key(result)
+        if key in previous and \
+                result['seconds'] > max_slowdown * previous[key]:
+            slower.append((key, result['seconds'], previous[key]))
+    return slower
+
+
+def _integers(text):
+    return [int(value) for value in text.split(',') if value]
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--benchmarks', default=','.join(BENCHMARKS),
+                      help='comma separated list among ' +
+                      ', '.join(BENCHMARKS))
+    parser.add_option('--sources', default='10,100,1000,10000',
+                      help='numbers of sources per exposure')
+    parser.add_option('--exposures', default='2,10,50,300',
+                      help='numbers of exposures of the solve and pipeline '
+                      'benchmarks')
+    parser.add_option('--set-sources', dest='set_sources', type='int',
+                      default=100, help='number of sources per exposure of '
+                      'the solve and pipeline benchmarks')
+    parser.add_option('--methods', default='grid,hierarchical,histogram,'
+                      'asterism', help='offset solvers; the first one is '
+                      'used by the solve and pipeline benchmarks')
+    parser.add_option('--modes', default='chain,global',
+                      help='alignment modes of the solve and pipeline '
+                      'benchmarks, among chain (the default of the actor) '
+                      'and global')
+    parser.add_option('--max-neighbours', dest='max_neighbours', type='int',
+                      default=4, help='neighbours of an exposure in '
+                      'global mode, 0 for all the overlapping exposures')
+    parser.add_option('--detection-method', dest='detection_method',
+                      default='builtin')
+    parser.add_option('--processes', type='int', default=1)
+    parser.add_option('--repeat', type='int', default=3)
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--max-error', dest='max_error', type='float',
+                      default=0.2, help='largest error on the offsets '
+                      '(arcsec) of a case that passes')
+    parser.add_option('--output', help='JSON file of the results')
+    parser.add_option('--baseline', help='JSON file of a previous run')
+    parser.add_option('--max-slowdown', dest='max_slowdown', type='float',
+                      default=1.5)
+    parser.add_option('--no-isolation', dest='isolate', action='store_false',
+                      default=True, help='run the cases in this process')
+    options, args = parser.parse_args(argv)
+
+    cases = make_cases(options.benchmarks.split(','),
+                       _integers(options.sources), _integers(options.exposures),
+                       options.methods.split(','), options)
+    results = []
+    failed = False
+    print('%-45s %10s %10s %10s' % ('case', 'time (s)', 'peak (MB)',
+                                    'error (")'))
+    for case in cases:
+        result = (_run_isolated if options.isolate else run_case)(case)
+        results.append(result)
+        status = ''
+        if 'failure' in result:
+            status = ' FAILED (%s)' % result['failure']
+            failed = True
+        elif result['error'] > options.max_error:
+            status = ' FAILED'
+            failed = True
+        print('%-45s %10.4f %10.1f %10.3f%s' % (
+            case_key(result), result['seconds'], result['peak_memory'],
+            result['error'], status))
+        sys.stdout.flush()
+
+    print()
+    for key, exponents in sorted(scaling(results).items()):
+        print('%-45s scaling %s' % (key, ' '.join('%.2f' % exponent
+                                                   for exponent in exponents)))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as f:
+            slower = compare(results, json.load(f), options.max_slowdown)
+        for key, seconds, previous in slower:
+            print('%s: %.4f s instead of %.4f s' % (key, seconds, previous))
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
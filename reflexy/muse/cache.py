@@ -0,0 +1,186 @@
+"""
+Persistent on-disk cache of the alignment catalogues and pair offsets.
+
+The catalogue of an exposure is stored under the path of its file and
+its identity, as computed by reflex.evalChecksum (modification time,
+size and the DATAMD5/CHECKSUM/DATASUM keywords), together with the
+detection parameters. The offsets of a pair of exposures are stored
+under the content of the two catalogues and the solver parameters, so
+they are reused exactly when both catalogues are.
+
+The cache directory is bounded in size: the least recently used entries
+are removed first. The size of the directory is scanned once, then kept
+up to date on every write, so that the directory is scanned again only
+when it has to be evicted.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from reflexy.base import reflex
+
+
+def _digest(*parts):
+    sha = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = part.encode('utf-8')
+        sha.update(part)
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def _params(params):
+    return json.dumps(params, sort_keys=True)
+
+
+class AlignmentCache(object):
+    """
+    Cache of the catalogues and pair offsets in a directory, holding at
+    most max_size bytes.
+    """
+
+    def __init__(self, directory, max_size=500 * 1024 ** 2):
+        self.directory = directory
+        self.max_size = max_size
+        # total size of the entries, None until the directory is scanned
+        self._size = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def _read(self, path, load):
+        try:
+            value = load(path)
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        # the modification time orders the entries for the eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def _write(self, path, save):
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        handle, tmp_path = tempfile.mkstemp(dir=self.directory,
+                                            suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as tmp_file:
+                save(tmp_file)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if self._size is None:
+            self._size = sum(size for mtime, size, name in self._entries())
+        else:
+            self._size += os.path.getsize(path) - replaced
+        if self._size > self.max_size:
+            # down to 90%, so that the next writes do not scan the
+            # directory again
+            self.evict(0.9 * self.max_size)
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self, max_size=None):
+        """
+        Remove the least recently used entries until the cache holds at
+        most max_size bytes, self.max_size by default.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        entries = self._entries()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._size = total
+
+    def catalogue_key(self, filename, params):
+        """
+        Key of the catalogue of a file, or None if the identity of the
+        file cannot be computed.
+        """
+        try:
+            identity = reflex.evalChecksum(reflex.FitsFile(filename, None))
+            stat = os.stat(filename)
+        except (IOError, OSError, ValueError):
+            return None
+        if identity is None:
+            return None
+        # the identity alone is the same for files of the same size
+        # written in the same second
+        return _digest('catalogue', os.path.abspath(filename), identity,
+                       repr(stat.st_mtime), str(stat.st_ino),
+                       _params(params))
+
+    def get_catalogue(self, key):
+        """
+        :return: [id, ra, dec] arrays, or None if not cached
+        """
+        if key is None:
+            return None
+
+        def load(path):
+            with np.load(path) as data:
+                return [data['id'], data['ra'], data['dec']]
+        return self._read(self._path(key, '.npz'), load)
+
+    def put_catalogue(self, key, catalogue):
+        if key is None:
+            return
+        id_, ra, dec = catalogue
+        self._write(self._path(key, '.npz'),
+                    lambda f: np.savez(f, id=id_, ra=ra, dec=dec))
+
+    def offsets_key(self, source, source_ref, params):
+        """
+        Key of the offsets between two catalogues.
+        """
+        parts = ['offsets', _params(params)]
+        for catalogue in (source, source_ref):
+            for column in catalogue:
+                parts.append(np.ascontiguousarray(column, float).tobytes())
+        return _digest(*parts)
+
+    def get_offsets(self, key):
+        """
+        :return: (offset_x, offset_y, n_match, rms_ra, rms_dec), or None
+         if not cached
+        """
+        def load(path):
+            with open(path) as f:
+                return tuple(json.load(f))
+        return self._read(self._path(key, '.json'), load)
+
+    def put_offsets(self, key, result):
+        values = [float(np.ravel(value)[0]) for value in result]
+        self._write(self._path(key, '.json'),
+                    lambda f: f.write(json.dumps(values).encode('ascii')))
@@ -0,0 +1,326 @@
+"""
+Detection of point sources for the alignment of MUSE exposures.
+
+The image is convolved only once with a Gaussian kernel matched to the
+seeing, the local maxima of the convolved image are found with
+vectorized filters, and the brightest sources are kept directly, instead
+of running a detection for each threshold of a search loop.
+"""
+
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from scipy import ndimage
+
+GAUSSIAN_SIGMA_TO_FWHM = 2. * np.sqrt(2. * np.log(2.))
+
+SOURCE_DTYPE = [('id', int), ('xcentroid', float), ('ycentroid', float),
+                ('peak', float), ('flux', float)]
+
+
+def sky_statistics(image, max_pixels=1000000, ignore=None):
+    """
+    Median and robust standard deviation of an image, estimated on a
+    regular subsample of at most max_pixels pixels. The NaN values, and
+    the values equal to ignore, are left out; an image without any other
+    value has a sky of 0.
+    """
+    step = max(1, int(np.sqrt(image.size / float(max_pixels))))
+    sample = np.asarray(image[::step, ::step], float).ravel()
+    valid = np.isfinite(sample)
+    if ignore is not None:
+        valid &= sample != ignore
+    sample = sample[valid]
+    if len(sample) == 0:
+        return 0., 0.
+    median = np.median(sample)
+    sigma = 1.4826 * np.median(np.abs(sample - median))
+    return median, sigma
+
+
+def fill_nan(image, value, chunk_size=4 * 1024**2):
+    """
+    Replace the NaN values of an image by value, in place.
+
+    The image is processed by blocks of rows of about chunk_size pixels,
+    so that no full size mask is allocated.
+    """
+    rows = max(1, chunk_size // max(1, image.shape[-1]))
+    for start in range(0, image.shape[0], rows):
+        block = image[start:start + rows]
+        block[np.isnan(block)] = value
+    return image
+
+
+def _box_flux(image, x, y, half_size):
+    """
+    Flux in boxes of (2 * half_size + 1) pixels centred on (x, y).
+    """
+    offsets = np.arange(-half_size, half_size + 1)
+    rows = np.clip(y[:, None, None] + offsets[None, :, None],
+                   0, image.shape[0] - 1)
+    columns = np.clip(x[:, None, None] + offsets[None, None, :],
+                      0, image.shape[1] - 1)
+    return image[rows, columns].sum(axis=(1, 2))
+
+
+def _peak_offsets(convolved, x, y):
+    """
+    Sub-pixel position of the peaks of a convolved image, from a
+    parabola through the peak pixel and its two neighbours along each
+    axis. convolved can also be a stack of cutouts, with one peak per
+    cutout.
+    """
+    n_y, n_x = convolved.shape[-2:]
+    if convolved.ndim == 3:
+        stack = (np.arange(len(x)),)
+    else:
+        stack = ()
+    centre = convolved[stack + (y, x)]
+    offsets = []
+    for minus, plus in (((y, np.clip(x - 1, 0, n_x - 1)),
+                         (y, np.clip(x + 1, 0, n_x - 1))),
+                        ((np.clip(y - 1, 0, n_y - 1), x),
+                         (np.clip(y + 1, 0, n_y - 1), x))):
+        minus = convolved[stack + minus]
+        plus = convolved[stack + plus]
+        curvature = minus - 2. * centre + plus
+        curvature[curvature == 0] = -1.
+        offsets.append(np.clip(0.5 * (minus - plus) / curvature, -0.5, 0.5))
+    return offsets
+
+
+def _brightest(values, n_max):
+    """
+    Indices of the n_max largest values, in decreasing order.
+    """
+    if n_max is not None and len(values) > n_max:
+        selected = np.argpartition(-values, n_max - 1)[:n_max]
+    else:
+        selected = np.arange(len(values))
+    return selected[np.argsort(-values[selected], kind='mergesort')]
+
+
+def _local_maxima(convolved, threshold, size, chunk_size=4 * 1024**2):
+    """
+    Positions, sub-pixel offsets and values of the local maxima of
+    convolved above threshold.
+
+    The maximum filter is applied by blocks of rows of about chunk_size
+    pixels, overlapping by half its size, so that no full size copy of
+    the image is allocated.
+    """
+    n_y = convolved.shape[0]
+    rows = max(1, chunk_size // max(1, convolved.shape[1]))
+    margin = size // 2
+    ys, xs = [], []
+    for start in range(0, n_y, rows):
+        stop = min(start + rows, n_y)
+        low, high = max(start - margin, 0), min(stop + margin, n_y)
+        block = convolved[low:high]
+        maxima = ((block == ndimage.maximum_filter(block, size=size)) &
+                  (block > threshold))[start - low:stop - low]
+        y, x = np.nonzero(maxima)
+        ys.append(y + start)
+        xs.append(x)
+    y = np.concatenate(ys) if ys else np.zeros(0, int)
+    x = np.concatenate(xs) if xs else np.zeros(0, int)
+    dx, dy = _peak_offsets(convolved, x, y)
+    return x, y, dx, dy, convolved[y, x]
+
+
+def _binned_candidates(image, sigma, nsigma, size, bin_factor, n_max):
+    """
+    Locate the bright sources on an image binned by bin_factor, then
+    find their peak on the full resolution image, convolving only a
+    cutout around each of them.
+    """
+    n_y = image.shape[0] // bin_factor
+    n_x = image.shape[1] // bin_factor
+    binned = image[:n_y * bin_factor, :n_x * bin_factor].reshape(
+        n_y, bin_factor, n_x, bin_factor).mean(axis=(1, 3))
+    binned_sigma = max(sigma / bin_factor, 0.5)
+    convolved = ndimage.gaussian_filter(binned, binned_sigma)
+    median, noise = sky_statistics(convolved, ignore=0.)
+    x, y, binned_dx, binned_dy, peak = _local_maxima(
+        convolved, median + nsigma * noise, max(3, size // bin_factor | 1))
+    # a few more candidates than needed, the ranking can change at full
+    # resolution
+    keep = _brightest(peak, None if n_max is None else 2 * n_max)
+    if len(keep) == 0:
+        # a blank or noise only image
+        return x, y, binned_dx, binned_dy, peak
+
+    half_size = bin_factor + int(np.ceil(3 * sigma))
+    offsets = np.arange(-half_size, half_size + 1)
+    x = x[keep] * bin_factor + bin_factor // 2
+    y = y[keep] * bin_factor + bin_factor // 2
+    rows = np.clip(y[:, None, None] + offsets[None, :, None],
+                   0, image.shape[0] - 1)
+    columns = np.clip(x[:, None, None] + offsets[None, None, :],
+                      0, image.shape[1] - 1)
+    cutouts = ndimage.gaussian_filter(image[rows, columns], (0, sigma, sigma))
+    # the peak is searched in the central region of each cutout only,
+    # where the convolution is not affected by the cutout border
+    inner = cutouts[:, half_size - bin_factor:half_size + bin_factor + 1,
+                    half_size - bin_factor:half_size + bin_factor + 1]
+    best = inner.reshape(len(inner), -1).argmax(axis=1)
+    dy, dx = np.unravel_index(best, inner.shape[1:])
+    index = np.arange(len(inner))
+    peak = cutouts[index, dy + half_size - bin_factor, dx + half_size - bin_factor]
+    sub_x, sub_y = _peak_offsets(cutouts, dx + half_size - bin_factor,
+                                 dy + half_size - bin_factor)
+    x = np.clip(x + dx - bin_factor, 0, image.shape[1] - 1)
+    y = np.clip(y + dy - bin_factor, 0, image.shape[0] - 1)
+
+    # the same source can be found from two neighbouring binned pixels
+    unique = np.unique(y * image.shape[1] + x, return_index=True)[1]
+    return x[unique], y[unique], sub_x[unique], sub_y[unique], peak[unique]
+
+
+def _tiles(shape, tile_size, margin):
+    """
+    Split an image in tiles of tile_size pixels.
+
+    :return: list of (core, extended) slice pairs, where core tiles the
+     image without overlap and extended is core enlarged by margin
+    """
+    tiles = []
+    for y0 in range(0, shape[0], tile_size):
+        for x0 in range(0, shape[1], tile_size):
+            y1 = min(y0 + tile_size, shape[0])
+            x1 = min(x0 + tile_size, shape[1])
+            core = (slice(y0, y1), slice(x0, x1))
+            extended = (slice(max(y0 - margin, 0), min(y1 + margin, shape[0])),
+                        slice(max(x0 - margin, 0), min(x1 + margin, shape[1])))
+            tiles.append((core, extended))
+    return tiles
+
+
+def _tiled_candidates(image, sigma, nsigma, size, tile_size, threads, n_max):
+    """
+    Convolve and search the local maxima of an image tile by tile, on a
+    pool of threads.
+
+    The tiles overlap by a margin larger than the convolution kernel and
+    the maximum filter, so the convolved values and the maxima in the
+    core of each tile are the same as on the whole image. A maximum in
+    the overlap of two tiles is kept only by the tile owning it in its
+    core, which merges the duplicates. The threshold is computed on the
+    assembled convolved image, as for a single tile.
+    """
+    # gaussian_filter truncates the kernel at 4 sigma
+    margin = int(np.ceil(4. * sigma)) + size
+    tiles = _tiles(image.shape, tile_size, margin)
+    convolved = np.empty(image.shape, image.dtype)
+
+    def convolve(tile):
+        core, extended = tile
+        result = ndimage.gaussian_filter(image[extended], sigma)
+        convolved[core] = result[core[0].start - extended[0].start:
+                                 core[0].stop - extended[0].start,
+                                 core[1].start - extended[1].start:
+                                 core[1].stop - extended[1].start]
+
+    def search(tile, threshold):
+        core, extended = tile
+        x, y, dx, dy, peak = _local_maxima(convolved[extended], threshold,
+                                           size)
+        x = x + extended[1].start
+        y = y + extended[0].start
+        owned, = np.where((x >= core[1].start) & (x < core[1].stop) &
+                          (y >= core[0].start) & (y < core[0].stop))
+        keep = owned[_brightest(peak[owned], n_max)]
+        return x[keep], y[keep], dx[keep], dy[keep], peak[keep]
+
+    if not threads:
+        threads = multiprocessing.cpu_count()
+    pool = ThreadPool(max(1, min(threads, len(tiles))))
+    try:
+        pool.map(convolve, tiles)
+        conv_median, conv_noise = sky_statistics(convolved, ignore=0.)
+        threshold = conv_median + nsigma * conv_noise
+        results = pool.map(lambda tile: search(tile, threshold), tiles)
+    finally:
+        pool.close()
+        pool.join()
+    return tuple(np.concatenate(column) for column in zip(*results))
+
+
+def find_sources(image, fwhm=5., n_max=80, nsigma=5., bin_factor=None,
+                 tile_size=None, threads=None, overwrite_input=False):
+    """
+    Detect the brightest point sources of an image.
+
+    :param image: ~numpy.ndarray
+     2D image; float32 images are processed in single precision. The NaN
+     values are left out of the sky statistics and replaced by the sky
+     level
+    :param fwhm: ~float
+     FWHM of the Gaussian kernel (pixels)
+    :param n_max: ~int
+     maximum number of sources returned; None to return all of them
+    :param nsigma: ~float
+     detection threshold, in units of the noise of the convolved image
+    :param bin_factor: ~int
+     if larger than 1, the bright sources are first located on the image
+     binned by this factor, and only cutouts around them are convolved
+     at full resolution; useful for large images
+    :param tile_size: ~int
+     if set, the full resolution search is split in overlapping tiles of
+     this size, processed on a pool of threads; the sources found are
+     the same as without tiles. Tiles cannot be combined with a
+     bin_factor, which convolves only cutouts at full resolution
+    :param threads: ~int
+     size of the pool of threads, all the CPUs by default
+    :param overwrite_input: ~bool
+     if True, the sky is subtracted and the NaN values are replaced in
+     image itself, when it has the processing type, which saves a copy
+     of the image
+
+    :return: ~numpy.ndarray
+     structured array with columns id, xcentroid, ycentroid (0-based
+     pixels), peak (of the convolved image) and flux (in the centroid
+     box), sorted by decreasing peak
+    """
+    if bin_factor is not None and bin_factor > 1 and tile_size:
+        raise ValueError("bin_factor and tile_size cannot be combined")
+    image = np.asarray(image)
+    # single precision images stay in single precision, which halves the
+    # memory of the convolved copies
+    dtype = np.float32 if image.dtype == np.float32 else np.float64
+    sky = dtype(sky_statistics(image)[0])
+    if overwrite_input and image.dtype == dtype:
+        image -= sky
+    else:
+        image = np.subtract(image, sky, dtype=dtype)
+    # the NaN values are replaced by the sky: far enough from the valid
+    # pixels, they remain exactly 0 after the convolution, and are left
+    # out of the statistics of the convolved image
+    fill_nan(image, 0.)
+    sigma = fwhm / GAUSSIAN_SIGMA_TO_FWHM
+    size = max(3, int(round(fwhm)) | 1)
+
+    if bin_factor is not None and bin_factor > 1:
+        x, y, dx, dy, peak = _binned_candidates(image, sigma, nsigma, size,
+                                                bin_factor, n_max)
+    elif tile_size is not None and tile_size > 0:
+        x, y, dx, dy, peak = _tiled_candidates(image, sigma, nsigma, size,
+                                               tile_size, threads, n_max)
+    else:
+        convolved = ndimage.gaussian_filter(image, sigma)
+        conv_median, conv_noise = sky_statistics(convolved, ignore=0.)
+        x, y, dx, dy, peak = _local_maxima(
+            convolved, conv_median + nsigma * conv_noise, size)
+
+    keep = _brightest(peak, n_max)
+    flux = _box_flux(image, x[keep], y[keep], size // 2)
+
+    sources = np.zeros(len(keep), dtype=SOURCE_DTYPE)
+    sources['id'] = np.arange(1, len(keep) + 1)
+    sources['xcentroid'] = x[keep] + dx[keep]
+    sources['ycentroid'] = y[keep] + dy[keep]
+    sources['peak'] = peak[keep]
+    sources['flux'] = flux
+    return sources
@@ -0,0 +1,122 @@
+"""
+Wall time, CPU time and peak memory of the stages of the alignment.
+
+The stages of align_exposures are chained generators, each one pulling
+items from the previous one: their execution is interleaved. A
+StageClock counts the time in the innermost running stage only, so that
+the time of each stage excludes the time spent waiting for its inputs,
+and the times of the stages add up.
+"""
+
+import contextlib
+import json
+import os
+import resource
+import sys
+import timeit
+
+
+def _megabytes(max_rss):
+    # ru_maxrss is in kilobytes on Linux, in bytes on Mac OS
+    if sys.platform == 'darwin':
+        return max_rss / 1024. ** 2
+    return max_rss / 1024.
+
+
+def peak_memory(children=False):
+    """
+    Peak resident memory of the current process (MB).
+
+    :param children: ~bool
+     peak of the largest of its terminated child processes instead, for
+     example the workers of a pool
+    """
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    return _megabytes(resource.getrusage(who).ru_maxrss)
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+class StageClock(object):
+    """
+    Accumulate the wall time, the CPU time of the current process and
+    the peak memory of named stages.
+
+    Stages can be nested; the time is counted in the innermost running
+    stage only. The peak memory of a stage is the peak of the process
+    when the stage last ran, so it includes the earlier stages.
+
+    :param timer: function returning the wall time (s)
+    :param cpu_timer: function returning the CPU time of the process (s)
+    """
+
+    def __init__(self, timer=timeit.default_timer, cpu_timer=_cpu_time):
+        self.stages = dict()
+        self._running = []
+        self._timer = timer
+        self._cpu_timer = cpu_timer
+        self._start = timer()
+        self._last = (self._start, cpu_timer())
+
+    def _account(self):
+        now = (self._timer(), self._cpu_timer())
+        if self._running:
+            stage = self.stages[self._running[-1]]
+            stage['wall_seconds'] += now[0] - self._last[0]
+            stage['cpu_seconds'] += now[1] - self._last[1]
+            stage['peak_memory_mb'] = peak_memory()
+        self._last = now
+
+    def enter(self, name):
+        self._account()
+        self.stages.setdefault(name, dict(wall_seconds=0., cpu_seconds=0.,
+                                          peak_memory_mb=0.))
+        self._running.append(name)
+
+    def leave(self):
+        self._account()
+        self._running.pop()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager timing a block as the stage name.
+        """
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.leave()
+
+    def timed(self, iterable, name):
+        """
+        Iterate over iterable, timing the production of its items as the
+        stage name.
+        """
+        iterator = iter(iterable)
+        while True:
+            self.enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.leave()
+            yield item
+
+    def elapsed(self):
+        """
+        Wall time since the creation of the clock (s).
+        """
+        return self._timer() - self._start
+
+
+def write_metrics(filename, metrics):
+    """
+    Write metrics, a dict of JSON serializable values, to a JSON file.
+    """
+    with open(filename, 'w') as f:
+        json.dump(metrics, f, indent=1, sort_keys=True)
@@ -0,0 +1,224 @@
+"""
+Synthetic star fields and exposure sets with known pointing errors.
+
+The stars are drawn uniformly on a patch of sky, with fluxes following a
+power law. Each exposure sees the stars of its field of view around a
+dithered pointing; its catalogue (or image) is made in the WCS of a
+pointing off by a known error, as for a real telescope, with centroid
+noise and some stars missed. The corrections the alignment should find
+are known exactly, see expected_offsets.
+"""
+
+import os
+
+import numpy as np
+from astropy import wcs as pywcs
+from astropy.io import fits
+
+ARCSEC = 1. / 3600
+
+
+def star_field(n_stars, size, index=1.5, random_state=None):
+    """
+    Positions and fluxes of stars spread uniformly on a square patch.
+
+    :param n_stars: ~int
+    :param size: ~float
+     side of the patch (arcsec), centred on (0, 0)
+    :param index: ~float
+     index of the power law of the number of stars brighter than a flux
+    :param random_state: ~numpy.random.RandomState
+
+    :return: x, y (arcsec, x towards the East) and flux (>= 1), sorted by
+     decreasing flux
+    """
+    rng = random_state or np.random
+    x = rng.uniform(-size / 2., size / 2., n_stars)
+    y = rng.uniform(-size / 2., size / 2., n_stars)
+    flux = rng.uniform(0., 1., n_stars) ** (-1. / index)
+    order = np.argsort(-flux, kind='mergesort')
+    return x[order], y[order], flux[order]
+
+
+def _to_sky(x, y, ra, dec):
+    return ra + x * ARCSEC / np.cos(np.radians(dec)), dec + y * ARCSEC
+
+
+class ExposureSet(object):
+    """
+    Pointings of a set of dithered exposures of the same star field, and
+    their pointing errors.
+
+    :param n_exposures: ~int
+    :param n_sources: ~int
+     mean number of stars in the field of view of an exposure
+    :param fov: ~float
+     side of the square field of view (arcsec)
+    :param dither: ~float
+     radius of the disc of the dithered pointings (arcsec)
+    :param pointing_error: ~float
+     standard deviation of the pointing errors (arcsec); the first
+     exposure, the reference of the alignment, has no error
+    :param noise: ~float
+     standard deviation of the centroids (arcsec)
+    :param completeness: ~float
+     probability for a star of the field of view to be detected
+    :param ra, dec: ~float
+     centre of the star field (deg)
+    :param seed: ~int
+    """
+
+    def __init__(self, n_exposures, n_sources, fov=60., dither=3.,
+                 pointing_error=2., noise=0.1, completeness=0.9, ra=150.,
+                 dec=2., seed=None):
+        self.random_state = np.random.RandomState(seed)
+        self.fov = fov
+        self.noise = noise
+        self.completeness = completeness
+        self.ra = ra
+        self.dec = dec
+        margin = dither + 4. * pointing_error
+        size = fov + 2. * margin
+        n_stars = int(round(n_sources * (size / fov) ** 2))
+        self.x, self.y, self.flux = star_field(n_stars, size,
+                                               random_state=self.random_state)
+
+        radius = dither * np.sqrt(self.random_state.uniform(0, 1, n_exposures))
+        angle = self.random_state.uniform(0, 2 * np.pi, n_exposures)
+        self.dither_x = radius * np.cos(angle)
+        self.dither_y = radius * np.sin(angle)
+        self.errors = self.random_state.normal(0., pointing_error,
+                                               (n_exposures, 2))
+        self.errors[0] = 0.
+
+    def __len__(self):
+        return len(self.errors)
+
+    def pointings(self):
+        """
+        Pointings written in the headers, including the errors.
+
+        :return: RA and DEC (deg) of every exposure
+        """
+        return _to_sky(self.dither_x + self.errors[:, 0],
+                       self.dither_y + self.errors[:, 1], self.ra, self.dec)
+
+    def visible(self, k, margin=0.):
+        """
+        Indices of the stars in the field of view of exposure k, reduced
+        by margin (arcsec) on every side, brightest first.
+        """
+        half = self.fov / 2. - margin
+        inside = ((np.abs(self.x - self.dither_x[k]) <= half) &
+                  (np.abs(self.y - self.dither_y[k]) <= half))
+        return np.where(inside)[0]
+
+    def catalogue(self, k):
+        """
+        Catalogue of exposure k, as returned by
+        reflexy.muse.alignment.build_catalogue: the detected stars,
+        brightest first, in the WCS of the erroneous pointing.
+
+        :return: [id, ra, dec] arrays
+        """
+        ind = self.visible(k)
+        ind = ind[self.random_state.uniform(0, 1, len(ind)) <
+                  self.completeness]
+        x = (self.x[ind] + self.errors[k, 0] +
+             self.random_state.normal(0., self.noise, len(ind)))
+        y = (self.y[ind] + self.errors[k, 1] +
+             self.random_state.normal(0., self.noise, len(ind)))
+        ra, dec = _to_sky(x, y, self.ra, self.dec)
+        return [np.arange(1, len(ind) + 1), ra, dec]
+
+    def catalogues(self):
+        return [self.catalogue(k) for k in range(len(self))]
+
+    def expected_offsets(self):
+        """
+        Corrections the alignment should find for every exposure, as in
+        the offset_ra and offset_dec columns of align_exposures.
+
+        :return: RA and DEC offsets (deg)
+        """
+        errors = self.errors - self.errors[0]
+        return (-errors[:, 0] * ARCSEC / np.cos(np.radians(self.dec)),
+                -errors[:, 1] * ARCSEC)
+
+    def image(self, k, scale=0.2, fwhm=4., amplitude=100., noise=1.):
+        """
+        Image of exposure k: the visible stars with Gaussian noise, and
+        the WCS of the erroneous pointing.
+
+        :param scale: ~float
+         pixel size (arcsec); the images have fov / scale pixels a side
+        :param fwhm: ~float
+         FWHM of the stars (pixels)
+        :param amplitude: ~float
+         peak of the faintest stars
+        :param noise: ~float
+         standard deviation of the background
+
+        :return: header with the pointing, MJD-OBS (one day apart for
+         successive exposures) and the WCS, float32 image
+        """
+        n_pixels = int(round(self.fov / scale))
+        sigma = fwhm / 2.3548
+        radius = int(np.ceil(4 * sigma))
+        ra, dec = self.pointings()
+        header = fits.Header()
+        header['RA'] = ra[k]
+        header['DEC'] = dec[k]
+        header['MJD-OBS'] = 57000. + k
+        header['CTYPE1'] = 'RA---TAN'
+        header['CTYPE2'] = 'DEC--TAN'
+        header['CRPIX1'] = (n_pixels + 1) / 2.
+        header['CRPIX2'] = (n_pixels + 1) / 2.
+        header['CRVAL1'] = ra[k]
+        header['CRVAL2'] = dec[k]
+        header['CD1_1'] = -scale * ARCSEC
+        header['CD2_2'] = scale * ARCSEC
+
+        ind = self.visible(k)
+        # the stars are seen where the erroneous WCS puts their true
+        # positions shifted by the error
+        star_ra, star_dec = _to_sky(self.x[ind] + self.errors[k, 0],
+                                    self.y[ind] + self.errors[k, 1],
+                                    self.ra, self.dec)
+        star_x, star_y = pywcs.WCS(header).wcs_world2pix(star_ra, star_dec, 0)
+        image = self.random_state.normal(
+            0., noise, (n_pixels, n_pixels)).astype(np.float32)
+        for x0, y0, flux in zip(star_x, star_y, self.flux[ind]):
+            i0, j0 = int(round(y0)), int(round(x0))
+            rows = slice(max(i0 - radius, 0), min(i0 + radius + 1, n_pixels))
+            columns = slice(max(j0 - radius, 0),
+                            min(j0 + radius + 1, n_pixels))
+            yy, xx = np.mgrid[rows, columns]
+            image[rows, columns] += amplitude * flux * np.exp(
+                -((xx - x0) ** 2 + (yy - y0) ** 2) / (2 * sigma ** 2))
+        return header, image
+
+    def write(self, directory, **kwargs):
+        """
+        Write the IMAGE_FOV and header-only PIXTABLE_REDUCED files of the
+        exposures.
+
+        :param kwargs: passed to image
+
+        :return: lists of the IMAGE_FOV and PIXTABLE_REDUCED file names
+        """
+        images, tables = [], []
+        for k in range(len(self)):
+            header, image = self.image(k, **kwargs)
+            image_name = os.path.join(directory, 'IMAGE_FOV_%04d.fits' % k)
+            fits.HDUList([fits.PrimaryHDU(header=header),
+                          fits.ImageHDU(image)]).writeto(image_name)
+            table_name = os.path.join(directory,
+                                      'PIXTABLE_REDUCED_%04d.fits' % k)
+            table_header = fits.Header()
+            for key in ('RA', 'DEC', 'MJD-OBS'):
+                table_header[key] = header[key]
+            fits.PrimaryHDU(header=table_header).writeto(table_name)
+            images.append(image_name)
+            tables.append(table_name)
+        return images, tables
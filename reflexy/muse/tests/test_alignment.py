@@ -1,5 +1,15 @@
 import pytest
-from reflexy.muse.alignment import find_matches
+from reflexy.muse.alignment import (find_matches, find_mutual_pairs,
+                                     evaluate_bias_grid, compute_offsets,
+                                     plan_alignment, match_pairs, solve_offsets,
+                                     detect_sources, build_catalogues,
+                                     update_alignment_header, write_offset_list,
+                                     load_image, read_metadata,
+                                     image_footprint, find_footprint_overlaps,
+                                     plan_footprint_alignment, clip_to_overlap,
+                                     align_exposures, iter_solutions,
+                                     read_alignment_state,
+                                     find_overlapping_pairs)
 import numpy as np
 
 @pytest.fixture
@@ -38,3 +48,813 @@ def test_find_matches(star_positions, offsets):
     assert np.isclose(rms_y_offset, 0.1, atol=0.1)
 
 
+
+
+def test_find_mutual_pairs_brute_force(star_positions, offsets):
+    x_ref, y_ref = star_positions
+    x_offset, y_offset = offsets
+    x_new = x_ref[::-1] + 5 * x_offset[::-1]
+    y_new = y_ref[::-1] + 5 * y_offset[::-1]
+
+    ind, ind_ref = find_mutual_pairs(x_new, y_new, x_ref, y_ref, 4.)
+
+    distances = np.hypot(x_new[:, None] - x_ref[None, :],
+                         y_new[:, None] - y_ref[None, :])
+    closest_ref = distances.argmin(axis=1)
+    closest_new = distances.argmin(axis=0)
+    expected, = np.where((closest_new[closest_ref] == np.arange(20)) &
+                         (distances.min(axis=1) <= 4.))
+    np.testing.assert_array_equal(ind, expected)
+    np.testing.assert_array_equal(ind_ref, closest_ref[expected])
+
+
+def test_find_matches_no_matches(star_positions):
+    x_ref, y_ref = star_positions
+    id = np.arange(20)
+
+    m_x_offset, m_y_offset, n_matches, rms_x_offset, rms_y_offset = find_matches(
+        id, x_ref + 1000., y_ref, id, x_ref, y_ref, 1.5)
+
+    assert n_matches == 0
+    assert m_x_offset == [0]
+
+
+@pytest.fixture
+def sky_catalogues():
+    np.random.seed(1312)
+    n_stars = 60
+    ra_ref = 150. + np.random.uniform(0, 1. / 60, n_stars)
+    dec_ref = 2. + np.random.uniform(0, 1. / 60, n_stars)
+    # 7.3" and -4.1" pointing offset, 0.1" centroid noise, a few
+    # sources only in one of the catalogues
+    ra = ra_ref + 7.3 / 3600 + np.random.normal(0, 0.1 / 3600, n_stars)
+    dec = dec_ref - 4.1 / 3600 + np.random.normal(0, 0.1 / 3600, n_stars)
+    return (np.arange(n_stars - 5), ra[5:], dec[5:],
+            np.arange(n_stars - 5), ra_ref[:-5], dec_ref[:-5])
+
+
+def test_evaluate_bias_grid_matches_loop(sky_catalogues):
+    id_, ra, dec, id_ref, ra_ref, dec_ref = sky_catalogues
+    ra_bias = (np.arange(11) * 1.4 - 12.) / 3600.
+    dec_bias = (np.arange(11) * 1.4 - 2.) / 3600.
+    max_dist = 1.12 / 3600.
+
+    matrices = evaluate_bias_grid(ra, dec, ra_ref, dec_ref, ra_bias,
+                                  dec_bias, max_dist)
+    assert matrices[0].max() > 40
+
+    for I_RA in range(11):
+        for I_DEC in range(11):
+            off_x, off_y, n_matches, rms_x, rms_y = find_matches(
+                id_, ra + ra_bias[I_RA], dec + dec_bias[I_DEC], id_ref,
+                ra_ref, dec_ref, max_dist)
+            assert matrices[0][I_RA, I_DEC] == n_matches
+            assert matrices[1][I_RA, I_DEC] == ra_bias[I_RA] - off_x
+            assert matrices[2][I_RA, I_DEC] == dec_bias[I_DEC] - off_y
+            assert np.isclose(matrices[3][I_RA, I_DEC], rms_x, rtol=1e-12,
+                              atol=0)
+            assert np.isclose(matrices[4][I_RA, I_DEC], rms_y, rtol=1e-12,
+                              atol=0)
+
+
+def test_evaluate_bias_grid_blocks(sky_catalogues):
+    id_, ra, dec, id_ref, ra_ref, dec_ref = sky_catalogues
+    bias = (np.arange(31) * 1.4 - 21.) / 3600.
+    max_dist = 1.12 / 3600.
+
+    matrices = evaluate_bias_grid(ra, dec, ra_ref, dec_ref, bias, bias,
+                                  max_dist)
+    # a few hundred candidate pairs per block of cells
+    blocks = evaluate_bias_grid(ra, dec, ra_ref, dec_ref, bias, bias,
+                                max_dist, max_pairs=200)
+    for matrix, block_matrix in zip(matrices, blocks):
+        assert np.array_equal(matrix, block_matrix)
+
+
+def test_compute_offsets(sky_catalogues):
+    offset_x, offset_y, n_match, rms_ra, rms_dec = compute_offsets(
+        *sky_catalogues)
+
+    assert np.isclose(offset_x * 3600, 7.3, atol=0.1)
+    assert np.isclose(offset_y * 3600, -4.1, atol=0.1)
+    assert n_match == 50
+
+
+def test_compute_offsets_histogram(sky_catalogues):
+    offset_x, offset_y, n_match, rms_ra, rms_dec = compute_offsets(
+        *sky_catalogues, method='histogram')
+
+    assert np.isclose(offset_x * 3600, 7.3, atol=0.1)
+    assert np.isclose(offset_y * 3600, -4.1, atol=0.1)
+    assert n_match == 50
+
+
+def test_compute_offsets_histogram_wide_search(sky_catalogues):
+    id_, ra, dec, id_ref, ra_ref, dec_ref = sky_catalogues
+    offset_x, offset_y, n_match, rms_ra, rms_dec = compute_offsets(
+        id_, ra + 40. / 3600, dec, id_ref, ra_ref, dec_ref,
+        method='histogram', search_radius=60.)
+
+    assert np.isclose(offset_x * 3600, 47.3, atol=0.1)
+    assert np.isclose(offset_y * 3600, -4.1, atol=0.1)
+    assert n_match >= 30
+
+
+def test_compute_offsets_histogram_dense_catalogues():
+    from reflexy.muse.synthetic import ExposureSet
+    # voting with all the sources found the overlap of the fields, about
+    # 1.5" off, instead of the offset
+    exposures = ExposureSet(2, 3000, seed=2)
+    expected_ra, expected_dec = exposures.expected_offsets()
+    offset_x, offset_y, n_match, rms_ra, rms_dec = compute_offsets(
+        *(exposures.catalogue(0) + exposures.catalogue(1)),
+        method='histogram', fallback=None)
+
+    assert np.isclose(offset_x, expected_ra[1], atol=0.1 / 3600)
+    assert np.isclose(offset_y, expected_dec[1], atol=0.1 / 3600)
+
+
+def test_compute_offsets_asterism_fallback(sky_catalogues):
+    id_, ra, dec, id_ref, ra_ref, dec_ref = sky_catalogues
+    # 45" is outside the 21" search radius of the grid
+    ra = ra + 45. / 3600
+
+    offset_x, offset_y, n_match, rms_ra, rms_dec = compute_offsets(
+        id_, ra, dec, id_ref, ra_ref, dec_ref)
+    assert np.isclose(offset_x * 3600, 52.3, atol=0.1)
+    assert np.isclose(offset_y * 3600, -4.1, atol=0.1)
+    assert n_match == 50
+
+    assert compute_offsets(id_, ra, dec, id_ref, ra_ref, dec_ref,
+                           fallback=None)[2] < 5
+    assert compute_offsets(id_, ra, dec, id_ref, ra_ref, dec_ref,
+                           method='asterism')[2] == 50
+
+
+def test_compute_offsets_fallback_dense_catalogues():
+    np.random.seed(25)
+    n_stars = 80
+    ra_ref = 150. + np.random.uniform(0, 1. / 60, n_stars)
+    dec_ref = 2. + np.random.uniform(0, 1. / 60, n_stars)
+    # 30" is outside the 21" search radius of the grid, where the best
+    # cell has a few chance matches
+    ra = ra_ref + np.random.normal(0, 0.1 / 3600, n_stars)
+    dec = dec_ref - 30. / 3600 + np.random.normal(0, 0.1 / 3600, n_stars)
+    # sorted along DEC, as the daofind output before its sorting
+    order = np.argsort(dec)
+    order_ref = np.argsort(dec_ref)
+    catalogues = (np.arange(n_stars), ra[order], dec[order],
+                  np.arange(n_stars), ra_ref[order_ref], dec_ref[order_ref])
+
+    assert compute_offsets(*catalogues, fallback=None)[2] >= 5
+    stats = dict()
+    offset_x, offset_y, n_match, rms_ra, rms_dec = compute_offsets(
+        *catalogues, stats=stats)
+    assert stats['method'] == 'asterism'
+    assert np.isclose(offset_x * 3600, 0., atol=0.1)
+    assert np.isclose(offset_y * 3600, -30., atol=0.1)
+    assert n_match == n_stars
+
+
+def test_compute_offsets_unknown_method(sky_catalogues):
+    with pytest.raises(ValueError):
+        compute_offsets(*sky_catalogues, method='unknown')
+
+
+def test_compute_offsets_hierarchical(sky_catalogues):
+    offset_x, offset_y, n_match, rms_ra, rms_dec = compute_offsets(
+        *sky_catalogues, method='hierarchical')
+
+    assert np.isclose(offset_x * 3600, 7.3, atol=0.1)
+    assert np.isclose(offset_y * 3600, -4.1, atol=0.1)
+    assert n_match == 50
+
+
+def test_compute_offsets_hierarchical_wide_search(sky_catalogues):
+    id_, ra, dec, id_ref, ra_ref, dec_ref = sky_catalogues
+    offset_x, offset_y, n_match, rms_ra, rms_dec = compute_offsets(
+        id_, ra - 35. / 3600, dec + 20. / 3600, id_ref, ra_ref, dec_ref,
+        method='hierarchical', search_radius=60., n_levels=4)
+
+    assert np.isclose(offset_x * 3600, -27.7, atol=0.1)
+    assert np.isclose(offset_y * 3600, 15.9, atol=0.1)
+    assert n_match >= 30
+
+
+def test_compute_offsets_hierarchical_less_work_than_grid():
+    from reflexy.muse.synthetic import ExposureSet
+    exposures = ExposureSet(2, 1000, pointing_error=7., seed=4)
+    catalogues = exposures.catalogue(0) + exposures.catalogue(1)
+    expected_ra, expected_dec = exposures.expected_offsets()
+
+    work = dict()
+    for method in ('grid', 'hierarchical'):
+        stats = dict()
+        offset_x, offset_y, n_match, rms_ra, rms_dec = compute_offsets(
+            *catalogues, method=method, fallback=None, stats=stats)
+        work[method] = stats
+        assert np.isclose(offset_x, expected_ra[1], atol=0.2 / 3600)
+        assert np.isclose(offset_y, expected_dec[1], atol=0.2 / 3600)
+    # the time is about proportional to the pairs of sources compared;
+    # the timings are in the benchmark
+    assert work['hierarchical']['cells'] < work['grid']['cells'] / 3.
+    assert work['hierarchical']['pairs'] < work['grid']['pairs'] / 3.
+
+
+def greedy_alignment_order(ra, dec):
+    # the nested-loop selection plan_alignment replaces
+    n_images = len(ra)
+    distances = np.zeros([n_images, n_images])
+    for i in range(n_images):
+        for j in range(n_images):
+            distances[i, j] = ((ra[i] - ra[j])**2. +
+                               (dec[i] - dec[j])**2.)**0.5
+    flags = np.zeros(n_images)
+    flags[0] = 1.
+    edges = []
+    for i in range(1, n_images):
+        processed, = np.where(flags == 1.)
+        not_processed, = np.where(flags == 0.)
+        replace = distances * 0 - 1.
+        for k1 in processed:
+            for k2 in not_processed:
+                replace[k1, k2] = distances[k1, k2]
+        min_dist = distances[processed][:, [not_processed]].min()
+        ic, jc = np.where((replace == min_dist) & (replace >= 0))
+        flags[jc[0]] = 1.
+        edges.append((ic[0], jc[0]))
+    return edges
+
+
+def test_plan_alignment_same_as_greedy_order():
+    np.random.seed(4711)
+    ra = np.random.uniform(0, 0.1, 40)
+    dec = np.random.uniform(0, 0.1, 40)
+    # repeated pointings give ties
+    ra[10:15] = ra[3]
+    dec[10:15] = dec[3]
+    ra[30] = ra[0]
+    dec[30] = dec[0]
+
+    assert plan_alignment(ra, dec) == greedy_alignment_order(ra, dec)
+
+
+def test_plan_alignment_single_exposure():
+    assert plan_alignment([10.], [20.]) == []
+
+
+def test_find_overlapping_pairs_max_neighbours():
+    # a dense dither pattern: every exposure overlaps every other one
+    np.random.seed(11)
+    ra = np.random.uniform(0, 3, 100) / 3600
+    dec = np.random.uniform(0, 3, 100) / 3600
+
+    assert len(find_overlapping_pairs(ra, dec)) == 100 * 99 // 2
+    pairs = find_overlapping_pairs(ra, dec, max_neighbours=4)
+    assert len(pairs) <= 4 * 100
+    assert all(i < j for i, j in pairs)
+    assert len(set(pairs)) == len(pairs)
+    degree = np.bincount(np.ravel(pairs), minlength=100)
+    assert degree.min() >= 4
+    # the edges of plan_alignment keep the exposures connected
+    assert set((min(i, j), max(i, j))
+               for i, j in plan_alignment(ra, dec)) <= set(pairs)
+    # far away exposures stay unpaired
+    ra[0] = 1.
+    pairs = find_overlapping_pairs(ra, dec, max_neighbours=4)
+    assert not any(0 in pair for pair in pairs)
+
+
+def test_solve_offsets():
+    true_ra = np.array([0., 2., 5., -1., 3.]) / 3600.
+    true_dec = np.array([0., -1., 1., 4., 2.]) / 3600.
+    pairs = [(0, 1), (1, 2), (0, 2), (2, 3), (0, 3)]
+    results = [(true_ra[j] - true_ra[i], true_dec[j] - true_dec[i], 30.,
+                0.2 / 3600, 0.2 / 3600) for i, j in pairs]
+    # a poorly matched pair with a wrong offset barely moves the solution
+    pairs.append((1, 3))
+    results.append((10. / 3600, 10. / 3600, 2., 5. / 3600, 5. / 3600))
+    # a pair without matches is ignored, exposure 4 stays at (0,0)
+    pairs.append((3, 4))
+    results.append(([0], [0], 0, [0], [0]))
+
+    offsets_ra, offsets_dec = solve_offsets(5, pairs, results)
+
+    assert np.allclose(offsets_ra[:4] * 3600, true_ra[:4] * 3600, atol=0.1)
+    assert np.allclose(offsets_dec[:4] * 3600, true_dec[:4] * 3600, atol=0.1)
+    assert offsets_ra[0] == 0.
+    assert offsets_ra[4] == 0.
+    assert offsets_dec[4] == 0.
+
+
+def test_solve_offsets_wrong_pair():
+    # a 4x4 grid of exposures, each matched with its neighbours
+    np.random.seed(3)
+    true = np.random.uniform(-5, 5, (2, 16)) / 3600.
+    true[:, 0] = 0.
+    pairs = ([(k, k + 1) for k in range(16) if k % 4 != 3] +
+             [(k, k + 4) for k in range(12)])
+    results = []
+    for i, j in pairs:
+        offset = true[:, j] - true[:, i] + np.random.normal(0., 0.03, 2) / 3600
+        results.append((offset[0], offset[1], 30., 0.2 / 3600, 0.2 / 3600))
+    # a wrong offset from a well matched pair
+    results[5] = (results[5][0] + 3. / 3600,) + results[5][1:]
+    expected = np.array(solve_offsets(16, pairs[:5] + pairs[6:],
+                                      results[:5] + results[6:]))
+
+    # the same solution as without the pair
+    offsets = np.array(solve_offsets(16, pairs, results))
+    assert np.allclose(offsets * 3600, expected * 3600, atol=1e-4)
+    assert np.allclose(offsets * 3600, true * 3600, atol=0.1)
+    # spread over the other exposures without the reweighting
+    offsets = np.array(solve_offsets(16, pairs, results, huber=None))
+    assert np.max(np.abs(offsets - expected)) * 3600 > 0.5
+
+
+def test_iter_solutions_global_unconnected():
+    pairs = [(0, 1), (1, 2), (2, 3)]
+    results = [(1. / 3600, 0., 30., 0.1 / 3600, 0.1 / 3600),
+               (1. / 3600, 0., 30., 0.1 / 3600, 0.1 / 3600),
+               (0., 0., 0, 0., 0.)]
+    # exposure 3 has no matched pair, exposure 4 no pair at all
+    solutions = list(iter_solutions(5, pairs, enumerate(results),
+                                    mode='global'))
+    assert [solution[0] for solution in solutions] == [1, 2]
+    assert np.allclose([solution[1] * 3600 for solution in solutions],
+                       [1., 2.])
+
+
+def test_match_pairs_process_pool(sky_catalogues):
+    id_, ra, dec, id_ref, ra_ref, dec_ref = sky_catalogues
+    sources = [[id_ref, ra_ref, dec_ref], [id_, ra, dec],
+               [id_, ra + 3. / 3600, dec]]
+    pairs = [(0, 1), (0, 2), (1, 2)]
+
+    results = match_pairs(sources, pairs, processes=2)
+
+    assert results == match_pairs(sources, pairs, processes=1)
+    assert np.isclose(results[0][0] * 3600, -7.3, atol=0.1)
+    assert np.isclose(results[2][0] * 3600, -3., atol=0.01)
+
+
+def test_detect_sources_builtin():
+    np.random.seed(0)
+    image = np.random.normal(0., 1., (100, 100))
+    image[48:53, 48:53] += 100.
+    junk = detect_sources(image, method='builtin')
+
+    assert len(junk) == 1
+    assert np.isclose(junk['xcentroid'][0], 50., atol=0.1)
+    assert np.isclose(junk['ycentroid'][0], 50., atol=0.1)
+    with pytest.raises(ValueError):
+        detect_sources(image, method='unknown')
+
+
+def test_detect_sources_brightest_first():
+    np.random.seed(0)
+    image = np.random.normal(0., 1., (100, 100))
+    yy, xx = np.mgrid[0:100, 0:100]
+    for x0, y0, amplitude in [(20, 20, 50.), (50, 50, 300.), (80, 80, 150.)]:
+        image += amplitude * np.exp(-((xx - x0)**2 + (yy - y0)**2) / 8.)
+    for method in ('daofind', 'builtin'):
+        junk = detect_sources(image, method=method)
+        assert len(junk) == 3
+        assert np.allclose(junk['xcentroid'], [50., 80., 20.], atol=0.2)
+
+
+def write_image_fov(filename, x, y, shape=(120, 120), ra=150., dec=2.):
+    from astropy.io import fits
+    header = fits.Header()
+    header['RA'] = ra
+    header['DEC'] = dec
+    header['MJD-OBS'] = 57000.
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRPIX1'] = shape[1] / 2.
+    header['CRPIX2'] = shape[0] / 2.
+    header['CRVAL1'] = ra
+    header['CRVAL2'] = dec
+    header['CD1_1'] = -0.2 / 3600
+    header['CD2_2'] = 0.2 / 3600
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+    image = np.random.normal(0., 1., shape).astype(np.float32)
+    for x0, y0 in zip(x, y):
+        image += 100. * np.exp(-((xx - x0)**2 + (yy - y0)**2) / 8.)
+    image[:3] = np.nan
+    fits.HDUList([fits.PrimaryHDU(header=header),
+                  fits.ImageHDU(image)]).writeto(str(filename))
+
+
+def test_build_catalogues(tmpdir):
+    np.random.seed(7)
+    x = np.array([20., 50., 90., 40.])
+    y = np.array([30., 70., 60., 100.])
+    write_image_fov(tmpdir.join('stars.fits'), x, y)
+    write_image_fov(tmpdir.join('blank.fits'), [], [])
+    images = [str(tmpdir.join('stars.fits')), str(tmpdir.join('blank.fits'))]
+
+    sources = build_catalogues(images, processes=2, method='builtin')
+
+    assert len(sources[0][0]) == 4
+    # the 0-based centroids are converted with origin=1, as daofind's
+    ra_expected = 150. - (x - 60.) * 0.2 / 3600 / np.cos(np.radians(2.))
+    assert np.allclose(np.sort(sources[0][1]), np.sort(ra_expected),
+                       rtol=0, atol=0.02 / 3600)
+    assert [list(column) for column in sources[1]] == [[-1], [-999], [-999]]
+    serial = build_catalogues(images, processes=1, method='builtin')
+    for parallel_catalogue, serial_catalogue in zip(sources, serial):
+        for parallel_column, serial_column in zip(parallel_catalogue,
+                                                  serial_catalogue):
+            np.testing.assert_array_equal(parallel_column, serial_column)
+
+
+def test_build_catalogues_threads_per_process(tmpdir, monkeypatch):
+    from reflexy.muse import alignment
+    images = []
+    for k in range(3):
+        images.append(str(tmpdir.join('stars%d.fits' % k)))
+        write_image_fov(images[-1], [60.], [60.])
+
+    def detect_sources(image, threads=None, **kwargs):
+        # the number of threads is returned as the id of a source
+        sources = np.zeros(1, [('id', int), ('xcentroid', float),
+                               ('ycentroid', float)])
+        sources['id'] = threads or 0
+        return sources
+    monkeypatch.setattr(alignment, 'detect_sources', detect_sources)
+    monkeypatch.setattr(alignment.multiprocessing, 'cpu_count', lambda: 8)
+
+    assert [list(catalogue[0]) for catalogue in
+            build_catalogues(images, processes=2)] == [[4]] * 3
+    assert [list(catalogue[0]) for catalogue in
+            build_catalogues(images, processes=1)] == [[0]] * 3
+
+
+def test_update_alignment_header(tmpdir):
+    from astropy.io import fits
+    filename = str(tmpdir.join('stars.fits'))
+    write_image_fov(filename, [20.], [30.])
+    data = fits.getdata(filename, 1)
+
+    update_alignment_header(filename, 'CRVAL1', 'CRVAL2', 1. / 3600,
+                            -2. / 3600, 0.1 / 3600, 0.2 / 3600, 12)
+
+    header = fits.getheader(filename)
+    assert header['CRVAL1'] == 150. + 1. / 3600
+    assert header['CRVAL2'] == 2. - 2. / 3600
+    assert header['RA'] == 150.
+    assert header['HIERARCH REFLEX ALIGNED'] == 1
+    assert header['HIERARCH REFLEX APPOFFDEC'] == -2. / 3600
+    assert header['HIERARCH REFLEX NUMSTARS'] == 12
+    np.testing.assert_array_equal(fits.getdata(filename, 1), data)
+
+
+def test_write_offset_list(tmpdir):
+    from astropy.io import fits
+    filename = str(tmpdir.join('OFFSET_LIST.fits'))
+    tmpdir.join('OFFSET_LIST.fits').write('old')
+    offsets_ra = np.array([0., 1.5 / 3600, -0.5 / 3600])
+    offsets_dec = np.array([0., 0.25 / 3600, 2. / 3600])
+
+    write_offset_list(filename, ['PIXTABLE_REDUCED_0001.fits',
+                                 'PIXTABLE_REDUCED_0002.fits', 'P3.fits'],
+                      ['2014-12-09T01:00:00.000'] * 3,
+                      np.array([57000.1, 57000.2, 57000.3]),
+                      offsets_ra, offsets_dec, np.array([0., 25., 12.]),
+                      np.zeros(3), np.ones(3) / 3600)
+
+    with fits.open(filename) as hdulist:
+        assert hdulist[0].header['HIERARCH ESO PRO CATG'] == 'OFFSET_LIST'
+        table = hdulist['OFFSET_LIST'].data
+        assert list(table['EXPOSURE']) == ['PIXTABLE_REDUCED_0001.fits',
+                                           'PIXTABLE_REDUCED_0002.fits',
+                                           'P3.fits']
+        np.testing.assert_array_equal(table['RA_OFFSET'], offsets_ra)
+        np.testing.assert_array_equal(table['DEC_OFFSET'], offsets_dec)
+        np.testing.assert_array_equal(table['N_MATCH'], [0, 25, 12])
+        assert table['MJD_OBS'][2] == 57000.3
+
+
+def test_load_image(tmpdir):
+    from astropy.io import fits
+    filename = str(tmpdir.join('stars.fits'))
+    write_image_fov(filename, [20.], [30.], shape=(50, 40))
+    expected = fits.getdata(filename, 1)
+
+    image, header = load_image(filename, chunk_size=333)
+
+    assert image.dtype == np.float32
+    assert header['CRVAL1'] == 150.
+    # the NaN rows are filled with the sky, not with 0
+    assert np.all(image[:3] == np.float32(np.median(expected[3:])))
+    np.testing.assert_array_equal(image[3:], expected[3:])
+
+
+def test_read_metadata(tmpdir):
+    from astropy.io import fits
+    from reflexy.base import fits_header
+    images, tables = [], []
+    for i, mjd in enumerate([57000.3, 57000.1, 57000.2]):
+        image = str(tmpdir.join('image%d.fits' % i))
+        write_image_fov(image, [], [], shape=(10, 10), ra=150. + i)
+        fits_header.update_header(image, [('MJD-OBS', mjd, None)])
+        images.append(image)
+        table = str(tmpdir.join('table%d.fits' % i))
+        header = fits.Header()
+        # the tables are listed in a different order than the images
+        header['MJD-OBS'] = mjd + 1e-5 * (i == 0) - 0.05 * (i == 2)
+        header['DATE-OBS'] = 'date%d' % i
+        fits.PrimaryHDU(header=header).writeto(table)
+        tables.append(table)
+
+    metadata = read_metadata(images, tables[::-1], threads=3)
+
+    assert list(metadata['image']) == [images[1], images[2], images[0]]
+    assert list(metadata['table']) == [tables[1], tables[2], tables[0]]
+    np.testing.assert_array_equal(metadata['ra'], [151., 152., 150.])
+    np.testing.assert_array_equal(metadata['mjd'],
+                                  [57000.1, 57000.2, 57000.3])
+    assert list(metadata['date_obs']) == ['date1', 'date2', 'date0']
+
+
+def test_image_footprint(tmpdir):
+    filename = str(tmpdir.join('image.fits'))
+    write_image_fov(filename, [], [], shape=(50, 100))
+
+    ra, dec = image_footprint(filename)
+
+    # CRPIX is (50, 25) and the corners are at the pixel edges
+    scale = 0.2 / 3600
+    np.testing.assert_allclose(np.sort(ra)[[0, -1]],
+                               [150. - 50.5 * scale / np.cos(np.radians(2.)),
+                                150. + 49.5 * scale / np.cos(np.radians(2.))],
+                               rtol=0, atol=1e-8)
+    np.testing.assert_allclose(np.sort(dec)[[0, -1]],
+                               [2. - 24.5 * scale, 2. + 25.5 * scale],
+                               rtol=0, atol=1e-8)
+    assert np.all(np.isnan(image_footprint(str(tmpdir.join('none.fits')))))
+
+
+def box_corners(ra, dec, size):
+    ra_corners = ra[:, None] + np.array([-1, 1, 1, -1]) * size[:, None] / 2
+    dec_corners = dec[:, None] + np.array([-1, -1, 1, 1]) * size[:, None] / 2
+    return ra_corners, dec_corners
+
+
+def test_find_footprint_overlaps_brute_force():
+    np.random.seed(3)
+    ra = np.random.uniform(-0.1, 0.1, 200) % 360.
+    dec = np.random.uniform(-0.1, 0.1, 200)
+    size = np.random.uniform(0.005, 1. / 60, 200)
+    ra_corners, dec_corners = box_corners(ra, dec, size)
+
+    pairs, areas = find_footprint_overlaps(ra_corners, dec_corners)
+
+    # the boxes are compared on the plane tangent at the first one
+    x = ((ra - ra[0] + 180.) % 360. - 180.) * np.cos(np.radians(dec[0]))
+    size_x = size * np.cos(np.radians(dec[0]))
+    expected = {}
+    for i in range(200):
+        for j in range(i + 1, 200):
+            width = (min(x[i] + size_x[i] / 2, x[j] + size_x[j] / 2) -
+                     max(x[i] - size_x[i] / 2, x[j] - size_x[j] / 2))
+            height = (min(dec[i] + size[i] / 2, dec[j] + size[j] / 2) -
+                      max(dec[i] - size[i] / 2, dec[j] - size[j] / 2))
+            if width > 0 and height > 0:
+                expected[(i, j)] = width * height
+    assert len(expected) > 100
+    assert sorted(expected) == pairs
+    np.testing.assert_allclose(areas, [expected[pair] for pair in pairs],
+                               rtol=1e-3)
+
+
+def test_plan_footprint_alignment():
+    # a row of overlapping exposures, and one far away
+    ra = np.array([0., 2., 1., 3., 10.]) * 0.5 / 60
+    dec = np.zeros(5)
+    size = np.ones(5) / 60
+    pairs, areas = find_footprint_overlaps(*box_corners(ra, dec, size))
+
+    edges = plan_footprint_alignment(5, pairs, areas)
+
+    assert edges == [(0, 2), (2, 1), (1, 3)]
+    assert plan_footprint_alignment(5, pairs, areas,
+                                    solved=[0, 2]) == [(2, 1), (1, 3)]
+    assert plan_footprint_alignment(5, [], np.zeros(0)) == []
+
+
+def test_clip_to_overlap(sky_catalogues):
+    id_, ra, dec, id_ref, ra_ref, dec_ref = sky_catalogues
+    # the footprint of the exposure covers only the east half of the
+    # field of the reference
+    footprints = box_corners(np.array([150. + 1. / 60, 150. + 0.5 / 60]),
+                             np.array([2. + 0.5 / 60, 2. + 0.5 / 60]),
+                             np.array([1., 1.]) / 60)
+    source = [id_, ra, dec]
+    source_ref = [id_ref, ra_ref, dec_ref]
+
+    clipped, clipped_ref = clip_to_overlap(
+        source, source_ref, (footprints[0][0], footprints[1][0]),
+        (footprints[0][1], footprints[1][1]), margin=5. / 3600)
+
+    ra_min = 150. + 0.5 / 60 - 5. / 3600 / np.cos(np.radians(2. + 0.5 / 60))
+    assert np.all(clipped_ref[1] >= ra_min)
+    assert np.all(clipped[1] >= ra_min)
+    assert len(clipped_ref[0]) == np.sum(ra_ref >= ra_min + 1e-9)
+    assert 10 < len(clipped[0]) < len(id_)
+    offset_x, offset_y, n_match, rms_ra, rms_dec = compute_offsets(
+        clipped[0], clipped[1], clipped[2], *clipped_ref)
+    assert np.isclose(offset_x * 3600, 7.3, atol=0.1)
+    assert np.isclose(offset_y * 3600, -4.1, atol=0.1)
+
+    unknown = (np.zeros(4) + np.nan, np.zeros(4) + np.nan)
+    assert clip_to_overlap(source, source_ref, unknown,
+                           unknown) == (source, source_ref)
+
+
+def test_match_pairs_footprints(sky_catalogues):
+    id_, ra, dec, id_ref, ra_ref, dec_ref = sky_catalogues
+    sources = [[id_ref, ra_ref, dec_ref], [id_, ra, dec]]
+    footprints = box_corners(np.array([150., 150.]) + 0.5 / 60,
+                             np.array([2., 2.]) + 0.5 / 60,
+                             np.array([1., 1.]) / 60)
+
+    results = match_pairs(sources, [(0, 1)], footprints=footprints,
+                          overlap_margin=21. / 3600)
+
+    assert results == match_pairs(sources, [(0, 1)])
+
+
+def write_exposures(tmpdir, pointing_errors, dither=3., n_stars=12):
+    """
+    IMAGE_FOV and PIXTABLE_REDUCED files of dithered exposures of the
+    same stars, with errors (arcsec) on the RA of their pointings.
+    """
+    from astropy.io import fits
+    from reflexy.base import fits_header
+    scale = 0.2 / 3600
+    cos_dec = np.cos(np.radians(2.))
+    star_x = np.random.uniform(25, 95, n_stars)
+    star_y = np.random.uniform(25, 95, n_stars)
+    images, tables = [], []
+    for k, error in enumerate(pointing_errors):
+        shift = k * dither / 0.2
+        ra = 150. + (error / 3600 - shift * scale) / cos_dec
+        dec = 2. + shift * scale
+        image = str(tmpdir.join('IMAGE_FOV_%d.fits' % k))
+        write_image_fov(image, star_x - shift, star_y - shift, ra=ra, dec=dec)
+        fits_header.update_header(image, [('MJD-OBS', 57000. + k, None)])
+        table = str(tmpdir.join('PIXTABLE_REDUCED_%d.fits' % k))
+        header = fits.Header()
+        header['RA'] = ra
+        header['DEC'] = dec
+        header['MJD-OBS'] = 57000. + k
+        fits.PrimaryHDU(header=header).writeto(table)
+        images.append(image)
+        tables.append(table)
+    return images, tables
+
+
+@pytest.mark.parametrize('mode', ['chain', 'global'])
+def test_align_exposures(tmpdir, mode):
+    from astropy.io import fits
+    np.random.seed(11)
+    errors = np.array([0., 1.5, -2.])
+    images, tables = write_exposures(tmpdir, errors)
+    offset_list = str(tmpdir.join('OFFSET_LIST.fits'))
+
+    alignment = align_exposures(images[::-1], tables, mode=mode,
+                                detection_method='builtin', processes=2,
+                                update_headers=True, offset_list=offset_list)
+
+    assert list(alignment['image']) == images
+    assert list(alignment['aligned']) == [False, True, True]
+    expected = -errors / 3600 / np.cos(np.radians(2.))
+    np.testing.assert_allclose(alignment['offset_ra'], expected, rtol=0,
+                               atol=0.05 / 3600)
+    np.testing.assert_allclose(alignment['offset_dec'], 0., rtol=0,
+                               atol=0.05 / 3600)
+    # the dither moves some of the stars out of the last exposure
+    assert np.all(alignment['n_match'][1:] >= 5)
+    header = fits.getheader(tables[1])
+    assert header['HIERARCH REFLEX ALIGNED'] == 1
+    assert header['RA'] == alignment['ra'][1] + alignment['offset_ra'][1]
+    assert 'HIERARCH REFLEX ALIGNED' not in fits.getheader(tables[0])
+    np.testing.assert_array_equal(fits.getdata(offset_list)['RA_OFFSET'],
+                                  alignment['offset_ra'])
+
+
+def test_align_exposures_global_unconnected(tmpdir):
+    from astropy.io import fits
+    np.random.seed(11)
+    # the last exposure is 10' away from the others
+    images, tables = write_exposures(tmpdir, np.array([0., 1.5, -2., 600.]))
+
+    alignment = align_exposures(images, tables, mode='global',
+                                detection_method='builtin',
+                                update_headers=True)
+
+    assert list(alignment['aligned']) == [False, True, True, False]
+    assert 'HIERARCH REFLEX ALIGNED' not in fits.getheader(tables[3])
+
+
+def test_align_exposures_clip_overlap(tmpdir):
+    np.random.seed(11)
+    images, tables = write_exposures(tmpdir, np.array([0., 1.5, -2.]))
+
+    alignment = align_exposures(images, tables, detection_method='builtin',
+                                clip_overlap=True)
+
+    assert list(alignment['aligned']) == [False, True, True]
+    expected = -np.array([0., 1.5, -2.]) / 3600 / np.cos(np.radians(2.))
+    np.testing.assert_allclose(alignment['offset_ra'], expected, rtol=0,
+                               atol=0.05 / 3600)
+
+
+def test_align_exposures_binning_and_tiles(tmpdir):
+    np.random.seed(11)
+    images, tables = write_exposures(tmpdir, np.array([0., 1.5]))
+    with pytest.raises(ValueError):
+        align_exposures(images, tables, detection_method='builtin',
+                        detection_binning=2, detection_tile_size=64)
+
+
+def test_iter_solutions_chain_order():
+    pairs = [(0, 1), (1, 2), (0, 3)]
+    results = [(1., 0., 10, 0., 0.), (2., 1., 11, 0., 0.),
+               (-1., 0., 12, 0., 0.)]
+    # the pair (1, 2) is finished before the pair (0, 1) it depends on
+    solutions = list(iter_solutions(4, pairs, [(1, results[1]),
+                                               (2, results[2]),
+                                               (0, results[0])]))
+    assert solutions == [(3, -1., 0., 12, 0., 0.), (1, 1., 0., 10, 0., 0.),
+                         (2, 3., 1., 11, 0., 0.)]
+
+
+def test_plan_alignment_continues_from_solved():
+    np.random.seed(5)
+    ra = np.random.uniform(0, 1, 30)
+    dec = np.random.uniform(0, 1, 30)
+    edges = plan_alignment(ra, dec)
+
+    for n_solved in (1, 7, 20):
+        solved = [0] + [j for i, j in edges[:n_solved]]
+        assert plan_alignment(ra, dec, solved=solved) == edges[n_solved:]
+
+
+@pytest.mark.parametrize('update_headers', [True, False])
+def test_align_exposures_incremental(tmpdir, update_headers):
+    np.random.seed(11)
+    errors = np.array([0., 1.5, -2., 1.])
+    images, tables = write_exposures(tmpdir, errors, dither=1.5)
+    state_file = str(tmpdir.join('state.json'))
+    kwargs = dict(detection_method='builtin', update_headers=update_headers,
+                  state_file=state_file, incremental=True)
+
+    first = align_exposures(images[:3], tables[:3], **kwargs)
+    assert sorted(read_alignment_state(state_file)) == [
+        'IMAGE_FOV_0.fits', 'IMAGE_FOV_1.fits', 'IMAGE_FOV_2.fits']
+    second = align_exposures(images, tables, **kwargs)
+
+    for name in ('offset_ra', 'offset_dec', 'n_match', 'rms_ra', 'rms_dec',
+                 'aligned'):
+        np.testing.assert_array_equal(second[name][:3], first[name])
+    assert second['aligned'][3]
+    assert np.isclose(second['offset_ra'][3] * 3600,
+                      -1. / np.cos(np.radians(2.)), atol=0.05)
+    assert np.isclose(second['offset_dec'][3] * 3600, 0., atol=0.05)
+
+
+def test_align_exposures_metrics(tmpdir):
+    from reflexy.muse.cache import AlignmentCache
+    np.random.seed(11)
+    images, tables = write_exposures(tmpdir, np.array([0., 1.5, -2.]))
+    cache = AlignmentCache(str(tmpdir.join('cache')))
+    metrics = dict()
+    alignment = align_exposures(images, tables, detection_method='builtin',
+                                processes=2, cache=cache, metrics=metrics)
+
+    assert metrics['n_exposures'] == 3
+    assert metrics['n_pairs'] == 2
+    assert sorted(metrics['stages']) == ['detection', 'matching', 'metadata',
+                                         'output', 'planning', 'solving']
+    assert metrics['stages']['matching']['cells'] == 2 * 31 ** 2
+    assert metrics['stages']['detection']['worker_detect_seconds'] > 0
+    assert [exposure['n_sources'] for exposure in metrics['exposures']] == \
+        [len(catalogue[0]) for catalogue in
+         build_catalogues(images, method='builtin')]
+    for pair in metrics['pairs']:
+        j = images.index(str(tmpdir.join(pair['images'][1])))
+        assert pair['n_match'] == alignment['n_match'][j]
+        assert pair['method'] == 'grid'
+        assert not pair['cached']
+
+    # a second run finds the catalogues and offsets in the cache
+    metrics = dict()
+    align_exposures(images, tables, detection_method='builtin', cache=cache,
+                    update_headers=True, metrics=metrics)
+    assert 'headers' in metrics['stages']
+    assert all(exposure['cached'] for exposure in metrics['exposures'])
+    assert all(pair['cached'] for pair in metrics['pairs'])
+    assert metrics['stages']['matching']['cells'] == 0
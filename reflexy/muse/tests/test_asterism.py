@@ -0,0 +1,79 @@
+import pytest
+from reflexy.muse.asterism import match_asterisms, fit_similarity
+import numpy as np
+
+
+@pytest.fixture
+def field():
+    np.random.seed(2718)
+    n_stars = 50
+    x_ref = np.random.uniform(0, 300, n_stars)
+    y_ref = np.random.uniform(0, 300, n_stars)
+    return x_ref, y_ref
+
+
+def transform(x, y, angle, scale, shift):
+    c, s = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+    return (scale * (c * x - s * y) + shift[0],
+            scale * (s * x + c * y) + shift[1])
+
+
+def test_fit_similarity(field):
+    x, y = field
+    x_ref, y_ref = transform(x, y, 3., 1.02, (40., -25.))
+    matrix, translation = fit_similarity(np.column_stack([x, y]),
+                                         np.column_stack([x_ref, y_ref]))
+    np.testing.assert_allclose(np.dot(matrix, [x, y]).T + translation,
+                               np.column_stack([x_ref, y_ref]), atol=1e-9)
+    assert np.isclose(np.degrees(np.arctan2(matrix[1, 0], matrix[0, 0])), 3.)
+
+
+def test_match_asterisms(field):
+    x_ref, y_ref = field
+    # the catalogue misses some of the reference sources, has some of
+    # its own, is rotated by 2 degrees and shifted by far more than the
+    # typical search radius of the grid
+    x, y = transform(x_ref[5:], y_ref[5:], -2., 1., (500., -300.))
+    x = np.concatenate([x + np.random.normal(0, 0.05, len(x)),
+                        np.random.uniform(500, 800, 5)])
+    y = np.concatenate([y + np.random.normal(0, 0.05, len(y)),
+                        np.random.uniform(-300, 0, 5)])
+
+    matrix, translation, ind, ind_ref = match_asterisms(x, y, x_ref, y_ref,
+                                                        1.)
+
+    assert len(ind) == 45
+    np.testing.assert_array_equal(ind_ref, ind + 5)
+    assert np.isclose(np.degrees(np.arctan2(matrix[1, 0], matrix[0, 0])),
+                      2., atol=0.01)
+    x_back, y_back = np.dot(matrix, [x[:45], y[:45]]) + translation[:, None]
+    assert np.all(np.hypot(x_back - x_ref[5:], y_back - y_ref[5:]) < 0.3)
+
+
+def test_match_asterisms_unrelated(field):
+    x_ref, y_ref = field
+    x = np.random.uniform(0, 300, 50)
+    y = np.random.uniform(0, 300, 50)
+    assert match_asterisms(x, y, x_ref, y_ref, 0.5) is None
+    assert match_asterisms(x[:2], y[:2], x_ref, y_ref, 0.5) is None
+
+
+def test_match_asterisms_dense_field():
+    from reflexy.muse.synthetic import ARCSEC, ExposureSet
+    # the triangles of the 80 brightest sources are often built from
+    # different neighbours in the two fields of view, so most pairs of
+    # triangles of the same shape match by chance
+    exposures = ExposureSet(2, 1000, seed=1)
+    (id_, ra, dec), (id_ref, ra_ref, dec_ref) = exposures.catalogues()
+    cos_dec = np.cos(np.radians(exposures.dec))
+    expected_ra, expected_dec = exposures.expected_offsets()
+
+    matrix, translation, ind, ind_ref = match_asterisms(
+        ra * cos_dec / ARCSEC, dec / ARCSEC, ra_ref * cos_dec / ARCSEC,
+        dec_ref / ARCSEC, 1.12, n_max=80)
+
+    assert len(ind) > 600
+    offset_ra = np.median(ra[ind] - ra_ref[ind_ref])
+    offset_dec = np.median(dec[ind] - dec_ref[ind_ref])
+    assert np.isclose(offset_ra, expected_ra[1], atol=0.05 * ARCSEC)
+    assert np.isclose(offset_dec, expected_dec[1], atol=0.05 * ARCSEC)
@@ -0,0 +1,115 @@
+import os
+import time
+
+import numpy as np
+
+from reflexy.muse.cache import AlignmentCache
+from reflexy.muse import alignment
+
+
+def catalogue(seed, n_sources=30):
+    np.random.seed(seed)
+    return [np.arange(n_sources), np.random.uniform(150., 150.01, n_sources),
+            np.random.uniform(2., 2.01, n_sources)]
+
+
+def test_catalogue_round_trip(tmpdir):
+    cache = AlignmentCache(str(tmpdir.join('cache')))
+    assert cache.get_catalogue('missing') is None
+
+    cache.put_catalogue('key', catalogue(1))
+    cached = cache.get_catalogue('key')
+    for column, expected in zip(cached, catalogue(1)):
+        np.testing.assert_array_equal(column, expected)
+
+
+def test_offsets_key(tmpdir):
+    cache = AlignmentCache(str(tmpdir))
+    key = cache.offsets_key(catalogue(1), catalogue(2), {'method': 'grid'})
+    assert key == cache.offsets_key(catalogue(1), catalogue(2),
+                                    {'method': 'grid'})
+    assert key != cache.offsets_key(catalogue(2), catalogue(1),
+                                    {'method': 'grid'})
+    assert key != cache.offsets_key(catalogue(1), catalogue(2),
+                                    {'method': 'histogram'})
+
+
+def test_offsets_round_trip(tmpdir):
+    cache = AlignmentCache(str(tmpdir))
+    cache.put_offsets('key', (1e-3, np.float64(2e-3), 10., [0], 4e-5))
+    assert cache.get_offsets('key') == (1e-3, 2e-3, 10., 0., 4e-5)
+
+
+def test_eviction(tmpdir):
+    cache = AlignmentCache(str(tmpdir), max_size=20000)
+    for k in range(3):
+        cache.put_catalogue('key%d' % k, catalogue(k, 200))
+        os.utime(str(tmpdir.join('key%d.npz' % k)),
+                 (time.time() - 100 + k, time.time() - 100 + k))
+    size = os.path.getsize(str(tmpdir.join('key0.npz')))
+    cache.max_size = 2 * size
+    # reading key0 makes it the most recently used entry
+    assert cache.get_catalogue('key0') is not None
+    cache.evict()
+    assert sorted(os.listdir(str(tmpdir))) == ['key0.npz', 'key2.npz']
+
+
+def test_eviction_on_write(tmpdir, monkeypatch):
+    size = len(catalogue(0, 200)[0]) * 3 * 8
+    cache = AlignmentCache(str(tmpdir), max_size=20 * size)
+    scans = []
+    listdir = os.listdir
+
+    def count_listdir(path):
+        scans.append(path)
+        return listdir(path)
+    monkeypatch.setattr(os, 'listdir', count_listdir)
+
+    for k in range(40):
+        cache.put_catalogue('key%d' % k, catalogue(k, 200))
+        assert sum(os.path.getsize(str(tmpdir.join(name)))
+                   for name in listdir(str(tmpdir))) <= cache.max_size
+    # one scan to start, then one per eviction only
+    assert 2 <= len(scans) <= 10
+    assert 'key39.npz' in listdir(str(tmpdir))
+    assert 'key0.npz' not in listdir(str(tmpdir))
+
+
+def test_match_pairs_uses_cache(tmpdir, monkeypatch):
+    cache = AlignmentCache(str(tmpdir))
+    sources = [catalogue(1), catalogue(1)]
+    sources[1][1] = sources[1][1] + 2. / 3600
+    results = alignment.match_pairs(sources, [(0, 1)], cache=cache)
+    assert np.isclose(results[0][0] * 3600, -2.)
+
+    def fail(args):
+        raise AssertionError('pair matched again')
+    monkeypatch.setattr(alignment, '_compute_pair_offsets', fail)
+    cached = alignment.match_pairs(sources, [(0, 1)], cache=cache)
+    assert np.allclose(cached[0], results[0])
+
+
+def test_catalogue_key(tmpdir, monkeypatch):
+    from reflexy.base import reflex
+    cache = AlignmentCache(str(tmpdir.join('cache')))
+    names = [str(tmpdir.join('IMAGE_FOV_%d.fits' % k)) for k in range(2)]
+    for name in names:
+        with open(name, 'w') as f:
+            f.write('SIMPLE  =                    T')
+    # files of the same size written in the same second have the same
+    # Reflex identity
+    monkeypatch.setattr(reflex, 'evalChecksum',
+                        lambda fits_file: '1400000000;30;None;None;None')
+    params = {'method': 'builtin'}
+    key = cache.catalogue_key(names[0], params)
+    assert key is not None
+    assert key == cache.catalogue_key(names[0], {'method': 'builtin'})
+    assert key != cache.catalogue_key(names[1], params)
+    assert key != cache.catalogue_key(names[0], {'method': 'daofind'})
+    assert cache.catalogue_key(names[0], {'method': 'builtin',
+                                          'bin_factor': 2}) != key
+    assert cache.catalogue_key(str(tmpdir.join('missing.fits')),
+                               params) is None
+
+    monkeypatch.setattr(reflex, 'evalChecksum', lambda fits_file: None)
+    assert cache.catalogue_key(names[0], params) is None
@@ -0,0 +1,144 @@
+import pytest
+from reflexy.muse.detection import find_sources
+import numpy as np
+
+
+def star_field(shape, x, y, amplitude, fwhm=4., noise=1.):
+    sigma = fwhm / 2.3548
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+    image = np.random.normal(10., noise, shape)
+    for x0, y0, a in zip(x, y, amplitude):
+        image += a * np.exp(-((xx - x0)**2 + (yy - y0)**2) / (2 * sigma**2))
+    return image
+
+
+@pytest.fixture
+def stars():
+    np.random.seed(90210)
+    n_stars = 30
+    # a jittered grid, so that no two stars are blended
+    x = np.tile(np.arange(6) * 45. + 35, 5) + np.random.uniform(-5, 5, n_stars)
+    y = np.repeat(np.arange(5) * 35. + 30, 6) + np.random.uniform(-5, 5, n_stars)
+    amplitude = np.random.uniform(20, 500, n_stars)
+    return x, y, amplitude
+
+
+def check_detections(sources, x, y, amplitude, n_expected):
+    assert len(sources) == n_expected
+    assert np.all(np.diff(sources['peak']) <= 0)
+    np.testing.assert_array_equal(sources['id'],
+                                  np.arange(1, n_expected + 1))
+    brightest = np.argsort(-amplitude)[:n_expected]
+    distances = np.hypot(sources['xcentroid'][:, None] - x[None, brightest],
+                         sources['ycentroid'][:, None] - y[None, brightest])
+    assert np.all(distances.min(axis=1) < 0.1)
+
+
+def test_find_sources(stars):
+    x, y, amplitude = stars
+    image = star_field((200, 300), x, y, amplitude)
+
+    sources = find_sources(image, fwhm=4., n_max=None)
+    check_detections(sources, x, y, amplitude, 30)
+
+
+def test_find_sources_brightest(stars):
+    x, y, amplitude = stars
+    image = star_field((200, 300), x, y, amplitude)
+
+    sources = find_sources(image, fwhm=4., n_max=10)
+    check_detections(sources, x, y, amplitude, 10)
+
+
+def test_find_sources_binned(stars):
+    x, y, amplitude = stars
+    image = star_field((200, 300), x, y, amplitude)
+
+    sources = find_sources(image, fwhm=4., n_max=10, bin_factor=4)
+    check_detections(sources, x, y, amplitude, 10)
+
+
+def test_find_sources_empty():
+    np.random.seed(1)
+    sources = find_sources(np.random.normal(0., 1., (50, 50)), nsigma=20.)
+    assert len(sources) == 0
+    assert sources['xcentroid'].shape == (0,)
+
+
+@pytest.mark.parametrize('bin_factor', [None, 4])
+def test_find_sources_blank(bin_factor):
+    np.random.seed(2)
+    for image in (np.zeros((64, 64)), np.zeros((64, 64), np.float32),
+                  np.random.normal(10., 1., (64, 64))):
+        sources = find_sources(image, nsigma=20., bin_factor=bin_factor)
+        assert len(sources) == 0
+        assert sources.dtype.names == ('id', 'xcentroid', 'ycentroid',
+                                       'peak', 'flux')
+
+
+def test_find_sources_nan(stars):
+    x, y, amplitude = stars
+    image = star_field((200, 300), x, y, amplitude) + 100.
+    # the left half of the image is not covered by the exposure
+    image[:, :150] = np.nan
+    right = x > 155
+    expected = find_sources(image[:, 150:], fwhm=4., n_max=None)
+
+    for bin_factor in (None, 4):
+        for dtype in (np.float64, np.float32):
+            sources = find_sources(image.astype(dtype), fwhm=4., n_max=None,
+                                   bin_factor=bin_factor)
+            check_detections(sources, x[right], y[right], amplitude[right],
+                             right.sum())
+    sources = find_sources(image, fwhm=4., n_max=None)
+    np.testing.assert_allclose(sources['xcentroid'],
+                               expected['xcentroid'] + 150.)
+    assert not np.isnan(image[:, 150:]).any()
+
+
+def test_find_sources_overwrite_input(stars):
+    x, y, amplitude = stars
+    image = star_field((200, 300), x, y, amplitude).astype(np.float32)
+    image[:10] = np.nan
+    expected = find_sources(image.copy(), fwhm=4., n_max=None)
+
+    sources = find_sources(image, fwhm=4., n_max=None, overwrite_input=True)
+    np.testing.assert_array_equal(sources, expected)
+    # the sky is subtracted in place
+    assert abs(np.median(image)) < 0.1
+    assert not np.isnan(image).any()
+
+
+def test_find_sources_tiles(stars):
+    x, y, amplitude = stars
+    image = star_field((200, 300), x, y, amplitude)
+
+    sources = find_sources(image, fwhm=4., n_max=None)
+    tiled = find_sources(image, fwhm=4., n_max=None, tile_size=64,
+                         threads=3)
+    np.testing.assert_array_equal(tiled, sources)
+
+    tiled = find_sources(image, fwhm=4., n_max=10, tile_size=64, threads=3)
+    check_detections(tiled, x, y, amplitude, 10)
+
+
+def test_find_sources_single_precision(stars):
+    x, y, amplitude = stars
+    image = star_field((200, 300), x, y, amplitude).astype(np.float32)
+
+    sources = find_sources(image, fwhm=4., n_max=None)
+    check_detections(sources, x, y, amplitude, 30)
+    tiled = find_sources(image, fwhm=4., n_max=None, tile_size=64,
+                         threads=3)
+    np.testing.assert_array_equal(tiled, sources)
+
+
+def test_find_sources_binned_tiles(stars):
+    x, y, amplitude = stars
+    image = star_field((200, 300), x, y, amplitude)
+    with pytest.raises(ValueError):
+        find_sources(image, fwhm=4., bin_factor=4, tile_size=64)
+    # a bin_factor of 1 is no binning
+    np.testing.assert_array_equal(
+        find_sources(image, fwhm=4., bin_factor=1, tile_size=64),
+        find_sources(image, fwhm=4.))
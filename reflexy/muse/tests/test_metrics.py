@@ -0,0 +1,75 @@
+import json
+import time
+
+from reflexy.muse.metrics import StageClock, peak_memory, write_metrics
+
+
+class FakeTimer(object):
+    """
+    Wall and CPU times advancing only when sleep is called.
+    """
+
+    def __init__(self):
+        self.now = 100.
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def slow_items(n, seconds, sleep=time.sleep):
+    for i in range(n):
+        sleep(seconds)
+        yield i
+
+
+def test_stage_clock_nested_stages():
+    timer = FakeTimer()
+    clock = StageClock(timer=timer, cpu_timer=timer)
+    with clock.stage('first'):
+        timer.sleep(0.02)
+    inner = clock.timed(slow_items(3, 0.02, timer.sleep), 'inner')
+    outer = clock.timed((i for i in inner if not timer.sleep(0.01)), 'outer')
+    assert list(outer) == [0, 1, 2]
+
+    stages = clock.stages
+    assert sorted(stages) == ['first', 'inner', 'outer']
+    # the time of the inner stage is not counted in the outer one
+    assert abs(stages['inner']['wall_seconds'] - 0.06) < 1e-9
+    assert abs(stages['outer']['wall_seconds'] - 0.03) < 1e-9
+    assert abs(stages['first']['cpu_seconds'] - 0.02) < 1e-9
+    assert stages['first']['peak_memory_mb'] > 0
+    assert abs(clock.elapsed() - 0.11) < 1e-9
+
+
+def test_stage_clock_real_time():
+    clock = StageClock()
+    inner = clock.timed(slow_items(3, 0.01), 'inner')
+    outer = clock.timed((i for i in inner if not time.sleep(0.01)), 'outer')
+    assert list(outer) == [0, 1, 2]
+    stages = clock.stages
+    assert stages['inner']['wall_seconds'] > 0
+    assert stages['outer']['wall_seconds'] > 0
+    assert clock.elapsed() >= sum(stage['wall_seconds']
+                                  for stage in stages.values())
+
+
+def test_stage_clock_exception():
+    clock = StageClock()
+    try:
+        with clock.stage('failing'):
+            raise ValueError
+    except ValueError:
+        pass
+    with clock.stage('next'):
+        pass
+    assert sorted(clock.stages) == ['failing', 'next']
+
+
+def test_write_metrics(tmpdir):
+    filename = str(tmpdir.join('metrics.json'))
+    write_metrics(filename, dict(peak_memory_mb=peak_memory(), pairs=[]))
+    with open(filename) as f:
+        assert sorted(json.load(f)) == ['pairs', 'peak_memory_mb']
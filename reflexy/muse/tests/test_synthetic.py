@@ -0,0 +1,63 @@
+import numpy as np
+
+from reflexy.muse import benchmark
+from reflexy.muse.alignment import match_pairs, iter_solutions
+from reflexy.muse.detection import find_sources
+from reflexy.muse.synthetic import ARCSEC, ExposureSet
+
+
+def test_catalogues_have_the_injected_offsets():
+    exposures = ExposureSet(4, 50, fov=30., seed=3)
+    expected_ra, expected_dec = exposures.expected_offsets()
+    assert expected_ra[0] == 0 and expected_dec[0] == 0
+
+    pairs = [(0, 1), (1, 2), (1, 3)]
+    results = match_pairs(exposures.catalogues(), pairs)
+    for j, offset_ra, offset_dec, n_match, rms_ra, rms_dec in \
+            iter_solutions(4, pairs, enumerate(results)):
+        assert n_match >= 20
+        assert np.isclose(offset_ra, expected_ra[j], rtol=0,
+                          atol=0.1 * ARCSEC)
+        assert np.isclose(offset_dec, expected_dec[j], rtol=0,
+                          atol=0.1 * ARCSEC)
+
+
+def test_image_stars_in_wcs():
+    from astropy import wcs
+    exposures = ExposureSet(2, 20, fov=24., noise=0., completeness=1., seed=5)
+    header, image = exposures.image(1)
+    assert image.shape == (120, 120)
+    assert image.dtype == np.float32
+
+    sources = find_sources(image, fwhm=4., n_max=5)
+    ra, dec = wcs.WCS(header).wcs_pix2world(sources['xcentroid'],
+                                            sources['ycentroid'], 0)
+    id_, ra_expected, dec_expected = exposures.catalogue(1)
+    distances = np.hypot((ra[:, None] - ra_expected[None, :]) *
+                         np.cos(np.radians(exposures.dec)),
+                         dec[:, None] - dec_expected[None, :])
+    # a star on the edge of the image may be off
+    assert np.sum(distances.min(axis=1) < 0.05 * ARCSEC) >= 4
+
+
+def test_benchmark_cases(tmpdir):
+    output = str(tmpdir.join('results.json'))
+    status = benchmark.main(['--benchmarks', 'find_matches,compute_offsets,solve',
+                             '--sources', '20,40', '--exposures', '3',
+                             '--methods', 'grid,histogram', '--repeat', '1',
+                             '--no-isolation', '--output', output])
+    assert status == 0
+
+    status = benchmark.main(['--benchmarks', 'find_matches', '--sources',
+                             '20,40', '--repeat', '1', '--no-isolation',
+                             '--baseline', output, '--max-slowdown', '1e6'])
+    assert status == 0
+
+
+def test_benchmark_compare():
+    case = dict(benchmark='find_matches', n_sources=100)
+    slower = benchmark.compare([dict(case, seconds=2.)],
+                               [dict(case, seconds=1.)], max_slowdown=1.5)
+    assert slower == [('find_matches/100 sources', 2., 1.)]
+    assert benchmark.compare([dict(case, seconds=1.2)],
+                             [dict(case, seconds=1.)]) == []